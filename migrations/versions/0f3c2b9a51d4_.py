@@ -0,0 +1,28 @@
+"""Add projects.version.
+
+Revision ID: 0f3c2b9a51d4
+Revises: 7532ec679110
+Create Date: 2026-10-17 16:21:08.914302
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "0f3c2b9a51d4"
+down_revision = "7532ec679110"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "projects",
+        sa.Column("version", sa.BigInteger(), server_default="0", nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_column("projects", "version")
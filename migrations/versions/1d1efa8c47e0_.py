@@ -0,0 +1,35 @@
+"""Add nodes._vector_sum and nodes.prototypes_valid.
+
+Revision ID: 1d1efa8c47e0
+Revises: 762c3a983d96
+Create Date: 2026-10-17 09:12:41.203118
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "1d1efa8c47e0"
+down_revision = "762c3a983d96"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("nodes", sa.Column("_vector_sum", sa.PickleType(), nullable=True))
+    op.add_column(
+        "nodes",
+        sa.Column(
+            "prototypes_valid", sa.Boolean(), server_default="f", nullable=False
+        ),
+    )
+
+    # _vector_sum has to be calculated for all nodes
+    op.execute("UPDATE nodes SET cache_valid = FALSE")
+
+
+def downgrade():
+    op.drop_column("nodes", "prototypes_valid")
+    op.drop_column("nodes", "_vector_sum")
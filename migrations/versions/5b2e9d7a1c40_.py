@@ -0,0 +1,26 @@
+"""Add nodes._own_prototypes.
+
+Revision ID: 5b2e9d7a1c40
+Revises: e81b4d2c9f63
+Create Date: 2026-10-17 23:05:18.630417
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "5b2e9d7a1c40"
+down_revision = "e81b4d2c9f63"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "nodes", sa.Column("_own_prototypes", sa.LargeBinary(), nullable=True)
+    )
+
+
+def downgrade():
+    op.drop_column("nodes", "_own_prototypes")
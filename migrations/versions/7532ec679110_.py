@@ -0,0 +1,58 @@
+"""Add materialized path nodes.path_ids.
+
+Revision ID: 7532ec679110
+Revises: 1d1efa8c47e0
+Create Date: 2026-10-17 14:03:27.551620
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = "7532ec679110"
+down_revision = "1d1efa8c47e0"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "nodes", sa.Column("path_ids", postgresql.ARRAY(sa.BigInteger()), nullable=True)
+    )
+
+    # Backfill the paths of all existing nodes, starting at the roots
+    op.execute(
+        """
+        WITH RECURSIVE p AS
+        (
+            SELECT  n.node_id, ARRAY[n.node_id] AS path
+            FROM    nodes AS n
+            WHERE   n.parent_id IS NULL
+            UNION ALL
+            SELECT  c.node_id, p.path || c.node_id
+            FROM    p
+            JOIN    nodes AS c
+            ON      c.parent_id = p.node_id
+        )
+        UPDATE  nodes
+        SET     path_ids = p.path
+        FROM    p
+        WHERE   nodes.node_id = p.node_id
+        """
+    )
+
+    op.create_index(
+        "idx_nodes_path_ids",
+        "nodes",
+        ["path_ids"],
+        unique=False,
+        postgresql_using="gin",
+    )
+
+
+def downgrade():
+    op.drop_index("idx_nodes_path_ids", table_name="nodes")
+    op.drop_column("nodes", "path_ids")
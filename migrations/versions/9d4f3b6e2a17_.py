@@ -0,0 +1,70 @@
+"""Store objects.vector as float4[] if MORPHOCLUSTER_VECTOR_BACKEND=float4.
+
+With the default backend (cube), nothing is changed.
+To switch the backend of an existing deployment, downgrade to 5b2e9d7a1c40
+and upgrade again with the new setting.
+
+Revision ID: 9d4f3b6e2a17
+Revises: 5b2e9d7a1c40
+Create Date: 2026-10-17 23:41:09.512774
+
+"""
+
+import os
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "9d4f3b6e2a17"
+down_revision = "5b2e9d7a1c40"
+branch_labels = None
+depends_on = None
+
+
+def _vector_is_array():
+    columns = sa.inspect(op.get_bind()).get_columns("objects")
+    (vector,) = [c for c in columns if c["name"] == "vector"]
+    return isinstance(vector["type"], postgresql.ARRAY)
+
+
+def upgrade():
+    if os.environ.get("MORPHOCLUSTER_VECTOR_BACKEND", "cube") != "float4":
+        return
+
+    if _vector_is_array():
+        return
+
+    op.drop_index("idx_objects_vector", table_name="objects")
+
+    # "(1, 2, 3)" -> {1,2,3}
+    op.execute(
+        """
+        ALTER TABLE objects
+        ALTER COLUMN vector TYPE real[]
+        USING string_to_array(btrim(vector::text, '()'), ',')::real[]
+        """
+    )
+
+
+def downgrade():
+    if not _vector_is_array():
+        return
+
+    # Fails for vectors with more than 100 dimensions
+    op.execute(
+        """
+        ALTER TABLE objects
+        ALTER COLUMN vector TYPE cube
+        USING cube(vector::float8[])
+        """
+    )
+
+    op.create_index(
+        "idx_objects_vector",
+        "objects",
+        ["vector"],
+        unique=False,
+        postgresql_using="gist",
+    )
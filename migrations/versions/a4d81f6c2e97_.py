@@ -0,0 +1,125 @@
+"""Store _centroid, _vector_sum and _prototypes as raw float arrays instead of pickles.
+
+Revision ID: a4d81f6c2e97
+Revises: 0f3c2b9a51d4
+Create Date: 2026-10-17 18:47:52.106229
+
+"""
+
+import pickle
+import struct
+
+from alembic import op
+import numpy as np
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "a4d81f6c2e97"
+down_revision = "0f3c2b9a51d4"
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def _encode_prototypes(prototypes):
+    # Layout of Prototypes.to_bytes: k, d (uint32), prototypes_ (k*d float32), support_ (k float32)
+    if prototypes is None or not hasattr(prototypes, "prototypes_"):
+        return None
+
+    k, d = prototypes.prototypes_.shape
+    return (
+        struct.pack("<II", k, d)
+        + np.ascontiguousarray(prototypes.prototypes_, dtype="<f4").tobytes()
+        + np.ascontiguousarray(prototypes.support_, dtype="<f4").tobytes()
+    )
+
+
+def _decode_prototypes(value):
+    from morphocluster.processing.prototypes import Prototypes
+
+    k, d = struct.unpack_from("<II", value)
+    prototypes = Prototypes(None)
+    prototypes.prototypes_ = np.frombuffer(
+        value, dtype="<f4", count=k * d, offset=8
+    ).reshape((k, d))
+    prototypes.support_ = np.frombuffer(
+        value, dtype="<f4", count=k, offset=8 + 4 * k * d
+    )
+    return prototypes
+
+
+def _encode_array(value, dtype):
+    if value is None:
+        return None
+
+    return np.ascontiguousarray(value, dtype=dtype).tobytes()
+
+
+def _decode_array(value, dtype):
+    return np.frombuffer(value, dtype=dtype).copy()
+
+
+def _convert(converters):
+    """
+    Convert the cached values of all nodes in batches.
+
+    Parameters:
+        converters: Mapping of column names to a function converting a stored value.
+    """
+    connection = op.get_bind()
+
+    columns = list(converters.keys())
+
+    # Only stream this statement (Connection.execution_options would stream all following ones)
+    rows = connection.execute(
+        sa.text(
+            "SELECT node_id, {} FROM nodes WHERE {}".format(
+                ", ".join(columns),
+                " OR ".join("{} IS NOT NULL".format(c) for c in columns),
+            )
+        ).execution_options(stream_results=True)
+    )
+
+    stmt = sa.text(
+        "UPDATE nodes SET {} WHERE node_id = :node_id".format(
+            ", ".join("{0} = :{0}".format(c) for c in columns)
+        )
+    ).bindparams(*(sa.bindparam(c, type_=sa.LargeBinary) for c in columns))
+
+    while True:
+        batch = rows.fetchmany(BATCH_SIZE)
+
+        if not batch:
+            break
+
+        updates = []
+        for row in batch:
+            update = {"node_id": row.node_id}
+            for c, convert in converters.items():
+                value = getattr(row, c)
+                update[c] = None if value is None else convert(bytes(value))
+            updates.append(update)
+
+        connection.execute(stmt, updates)
+
+
+def upgrade():
+    _convert(
+        {
+            "_centroid": lambda v: _encode_array(pickle.loads(v), "<f4"),
+            "_vector_sum": lambda v: _encode_array(pickle.loads(v), "<f8"),
+            "_prototypes": lambda v: _encode_prototypes(pickle.loads(v)),
+        }
+    )
+
+
+def downgrade():
+    _convert(
+        {
+            "_centroid": lambda v: pickle.dumps(_decode_array(v, "<f4")),
+            "_vector_sum": lambda v: pickle.dumps(_decode_array(v, "<f8")),
+            "_prototypes": lambda v: pickle.dumps(_decode_prototypes(v)),
+        }
+    )
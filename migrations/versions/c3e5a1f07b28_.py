@@ -0,0 +1,30 @@
+"""Add projects.vectors_version.
+
+Revision ID: c3e5a1f07b28
+Revises: a4d81f6c2e97
+Create Date: 2026-10-17 21:12:40.527113
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "c3e5a1f07b28"
+down_revision = "a4d81f6c2e97"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "projects",
+        sa.Column(
+            "vectors_version", sa.BigInteger(), server_default="0", nullable=False
+        ),
+    )
+
+
+def downgrade():
+    op.drop_column("projects", "vectors_version")
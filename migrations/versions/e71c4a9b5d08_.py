@@ -0,0 +1,25 @@
+"""Add vectors_version_seq (global version of the object vectors).
+
+Revision ID: e71c4a9b5d08
+Revises: 9d4f3b6e2a17
+Create Date: 2026-10-18 10:04:52.318604
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e71c4a9b5d08"
+down_revision = "9d4f3b6e2a17"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(sa.schema.CreateSequence(sa.Sequence("vectors_version_seq")))
+
+
+def downgrade():
+    op.execute(sa.schema.DropSequence(sa.Sequence("vectors_version_seq")))
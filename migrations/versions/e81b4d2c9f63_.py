@@ -0,0 +1,29 @@
+"""Add a GiST index on objects.vector for nearest neighbour queries.
+
+Revision ID: e81b4d2c9f63
+Revises: c3e5a1f07b28
+Create Date: 2026-10-17 22:03:17.640385
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "e81b4d2c9f63"
+down_revision = "c3e5a1f07b28"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "idx_objects_vector",
+        "objects",
+        ["vector"],
+        unique=False,
+        postgresql_using="gist",
+    )
+
+
+def downgrade():
+    op.drop_index("idx_objects_vector", table_name="objects")
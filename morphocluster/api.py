@@ -8,6 +8,7 @@ import json
 import os
 import pathlib
 import traceback
+import time
 import uuid
 import warnings
 import zlib
@@ -42,6 +43,15 @@ from morphocluster.tree import Tree
 
 api = Blueprint("api", __name__)
 
+#: Interval (in seconds) for polling the validity of nodes that are being consolidated
+CONSOLIDATION_POLL_INTERVAL = 0.1
+
+#: Time (in seconds) after which pages that are still being calculated are given up
+PAGE_CACHE_PENDING_TIMEOUT = 600
+
+#: Number of object vectors that are read at once by post_node_classify
+CLASSIFY_CHUNK_SIZE = 10000
+
 from werkzeug.exceptions import HTTPException
 
 
@@ -228,11 +238,15 @@ def get_subtree(node_id):
         tree = Tree(connection)
 
         if flags["supertree"]:
-            children = tree.get_children(
-                node_id, supertree=True, include="starred", order_by="_n_children DESC"
+            children = _get_children(
+                tree,
+                node_id,
+                supertree=True,
+                include="starred",
+                order_by="_n_children DESC",
             )
         else:
-            children = tree.get_children(node_id, order_by="_n_children DESC")
+            children = _get_children(tree, node_id, order_by="_n_children DESC")
 
         result = [_tree_node(c, flags["supertree"]) for c in children]
 
@@ -1117,7 +1131,7 @@ def create_node():
 
         if project_id is None:
             # Retrieve project_id for the parent_id
-            project_id = tree.get_node(parent_id)["project_id"]
+            project_id = tree.get_node(parent_id, require_valid=False)["project_id"]
 
         print(data)
 
@@ -1136,11 +1150,100 @@ def create_node():
 
             print("Created node {}.".format(node_id))
 
+        _schedule_consolidation(tree)
+
         result = _node(tree, node)
 
         return jsonify(result)
 
 
+def _schedule_consolidation(tree):
+    """
+    Hand the nodes that were invalidated by tree over to the consolidation worker.
+
+    Must be called after the transaction was committed.
+    """
+    try:
+        background.schedule_consolidation(tree.dirty_node_ids)
+    except RedisError as exc:
+        # The nodes will be consolidated when they are read
+        warnings.warn("Could not schedule consolidation: {}".format(exc))
+
+    tree.dirty_node_ids.clear()
+
+
+def _consolidated(tree, fetch, refresh_prototypes=False):
+    """
+    Read nodes with valid cached values without consolidating them in the request.
+
+    Invalid nodes are handed over to the consolidation worker and re-read until
+    they are valid or CONSOLIDATION_WAIT seconds have passed.
+    After that, the last valid cached values are served and the node is flagged as stale.
+    Only nodes that were never consolidated are consolidated synchronously.
+
+    Parameters:
+        fetch: Callable returning a list of nodes (with possibly invalid cached values).
+    """
+
+    def invalid(nodes):
+        return [
+            n["node_id"]
+            for n in nodes
+            if not n["cache_valid"] or (refresh_prototypes and not n["prototypes_valid"])
+        ]
+
+    nodes = fetch()
+    invalid_ids = invalid(nodes)
+
+    if not invalid_ids:
+        return nodes
+
+    tree.dirty_node_ids.update(invalid_ids)
+    _schedule_consolidation(tree)
+
+    deadline = time.monotonic() + api.config["CONSOLIDATION_WAIT"]
+    while invalid_ids and time.monotonic() < deadline:
+        time.sleep(CONSOLIDATION_POLL_INTERVAL)
+        nodes = fetch()
+        invalid_ids = invalid(nodes)
+
+    never_consolidated = [
+        n["node_id"] for n in nodes if n["_n_objects_deep"] is None
+    ]
+    if never_consolidated:
+        for node_id in never_consolidated:
+            tree.consolidate_node(node_id, refresh_prototypes=refresh_prototypes)
+        nodes = fetch()
+        invalid_ids = invalid(nodes)
+
+    invalid_ids = set(invalid_ids)
+    for n in nodes:
+        n["stale"] = n["node_id"] in invalid_ids
+
+    return nodes
+
+
+def _get_node(tree, node_id, refresh_prototypes=False):
+    """
+    Get a node without consolidating it in the request (see _consolidated).
+    """
+    (node,) = _consolidated(
+        tree,
+        lambda: [tree.get_node(node_id, require_valid=False)],
+        refresh_prototypes,
+    )
+    return node
+
+
+def _get_children(tree, node_id, **kwargs):
+    """
+    Get the children of a node without consolidating them in the request (see _consolidated).
+    """
+    return _consolidated(
+        tree, lambda: tree.get_children(node_id, require_valid=False, **kwargs)
+    )
+
+
 def _node(tree, node, include_children=False):
     if node["name"] is None:
         node["name"] = node["node_id"]
@@ -1163,11 +1266,13 @@ def _node(tree, node, include_children=False):
         "parent_id": node["parent_id"],
         "project_id": node["project_id"],
         "filled": node["filled"],
+        # Cached values are outdated and currently being updated
+        "stale": node.get("stale", False),
     }
 
     if include_children:
         result["children"] = [
-            _node(tree, c) for c in tree.get_children(node["node_id"])
+            _node(tree, c) for c in _get_children(tree, node["node_id"])
         ]
 
     return result
@@ -1225,27 +1330,157 @@ def _members(tree, members):
     return [_node(tree, m) if "node_id" in m else _object(m) for m in members]
 
 
-def _load_or_calc(func, func_kwargs, request_id, page, page_size=100, compress=True):
+def _member_key(member):
+    """
+    Identify a member of a page (see _members).
+    """
+    if "node_id" in member:
+        return "n{}".format(member["node_id"])
+    return "o{}".format(member["object_id"])
+
+
+def _cache_key(func, request_id):
+    return "{}:{}".format(func.__name__, request_id)
+
+
+def _pending_key(cache_key):
+    return "{}:pending".format(cache_key)
+
+
+def _serialize_pages(result, page_size):
+    # Paginate full_result
+    pages = batch(result, page_size)
+
+    # Serialize individual pages
+    return [json_dumps(p) for p in pages]
+
+
+def _cache_pages(cache_key, pages, compress):
+    """
+    Append serialized pages to the cache.
+    """
+    if not pages:
+        return
+
+    if compress:
+        # raw_length = sum(len(p) for p in pages)
+        cache_pages = [zlib.compress(p.encode()) for p in pages]
+        # compressed_length = sum(len(p) for p in pages)
+
+        # print("Compressed pages. Ratio: {:.2%}".format(compressed_length / raw_length))
+    else:
+        cache_pages = pages
+
+    redis_lru.rpush(cache_key, *cache_pages)
+
+
+def _calc_first_page(func, func_kwargs, request_id, bound, page_size, compress):
+    """
+    Calculate only the first page (func(..., limit=page_size))
+    and leave the remaining pages to a background job (see complete_pages).
+
+    func must select the same candidates regardless of `limit`,
+    so that the first page is a prefix of the full result.
+
+    Returns:
+        (pages, pending) or None if the background job could not be queued.
+    """
+    cache_key = _cache_key(func, request_id)
+
+    result = func(**dict(func_kwargs, limit=page_size))[:page_size]
+
+    pages = _serialize_pages(result, page_size)
+
+    # A shorter first page is already the complete result
+    pending = len(result) == page_size
+
+    try:
+        if pending:
+            redis_lru.set(_pending_key(cache_key), 1, ex=PAGE_CACHE_PENDING_TIMEOUT)
+
+        _cache_pages(cache_key, pages, compress)
+
+        if pending:
+            background.complete_page_cache.queue(
+                func.__name__,
+                func_kwargs,
+                request_id,
+                bound,
+                page_size,
+                compress,
+                [_member_key(m) for m in result],
+                timeout=PAGE_CACHE_PENDING_TIMEOUT,
+            )
+    except RedisError as exc:
+        warnings.warn("Could not calculate pages progressively: {}".format(exc))
+        try:
+            redis_lru.delete(cache_key, _pending_key(cache_key))
+        except RedisError:
+            pass
+        return None
+
+    return pages, pending
+
+
+def complete_pages(func, func_kwargs, request_id, bound, page_size, compress, skip):
+    """
+    Calculate the full result and append it to the cached first page.
+
+    Members that are already on the first page are skipped.
+    """
+    cache_key = _cache_key(func, request_id)
+
+    try:
+        skip = set(skip)
+        max_n = func_kwargs[bound]
+
+        result = [m for m in func(**func_kwargs) if _member_key(m) not in skip]
+        result = result[: max_n - len(skip)]
+
+        pages = _serialize_pages(result, page_size)
+        _cache_pages(cache_key, pages, compress)
+    finally:
+        redis_lru.delete(_pending_key(cache_key))
+
+    print("Completed {} with {:d} pages.".format(cache_key, len(pages)))
+
+
+def _load_or_calc(
+    func,
+    func_kwargs,
+    request_id,
+    page,
+    page_size=100,
+    compress=True,
+    bound=None,
+    progressive=False,
+):
     print("Load or calc {}...".format(func.__name__))
 
     # If a request_id is given, load the result from the cache
     if request_id is not None:
-        cache_key = "{}:{}".format(func.__name__, request_id)
+        cache_key = _cache_key(func, request_id)
         try:
             print("Loading cache key {}...".format(cache_key))
+            pending = bool(redis_lru.exists(_pending_key(cache_key)))
+
             page_result = redis_lru.lindex(cache_key, page)
 
+            n_pages = redis_lru.llen(cache_key)
+
             if page_result is None:
-                raise ValueError("Unknown cache_key: {}".format(cache_key))
+                # The page may not be calculated yet
+                if pending:
+                    return "[]", n_pages, request_id, pending
 
-            n_pages = redis_lru.llen(cache_key)
+                raise ValueError("Unknown cache_key: {}".format(cache_key))
 
             if compress:
                 page_result = zlib.decompress(page_result).decode()
 
             # print("Returning page {} from cached result".format(page))
 
-            return page_result, n_pages, request_id
+            return page_result, n_pages, request_id, pending
 
         except RedisError as exc:
             raise ValueError(
@@ -1254,38 +1489,34 @@ def _load_or_calc(func, func_kwargs, request_id, page, page_size=100, compress=T
 
     # Otherwise calculate a result
     request_id = uuid.uuid4().hex
-    cache_key = "{}:{}".format(func.__name__, request_id)
-
-    # Calculate result
-    result = func(**func_kwargs)
-
-    # Paginate full_result
-    pages = batch(result, page_size)
+    cache_key = _cache_key(func, request_id)
 
-    # Serialize individual pages
-    pages = [json_dumps(p) for p in pages]
-
-    n_pages = len(pages)
+    first_page = None
+    if progressive and bound is not None and func_kwargs[bound] > page_size:
+        first_page = _calc_first_page(
+            func, func_kwargs, request_id, bound, page_size, compress
+        )
 
-    if n_pages:
-        if compress:
-            # raw_length = sum(len(p) for p in pages)
-            cache_pages = [zlib.compress(p.encode()) for p in pages]
-            # compressed_length = sum(len(p) for p in pages)
+    if first_page is not None:
+        pages, pending = first_page
+    else:
+        # Calculate result
+        result = func(**func_kwargs)
+        pending = False
 
-            # print("Compressed pages. Ratio: {:.2%}".format(compressed_length / raw_length))
-        else:
-            cache_pages = pages
+        pages = _serialize_pages(result, page_size)
 
         try:
-            redis_lru.rpush(cache_key, *cache_pages)
+            _cache_pages(cache_key, pages, compress)
         except RedisError as e:
             warnings.warn("RedisError: {}".format(e))
 
+    n_pages = len(pages)
+
     if 0 <= page < n_pages:
-        return pages[page], n_pages, request_id
+        return pages[page], n_pages, request_id, pending
 
-    return "[]", n_pages, request_id
+    return "[]", n_pages, request_id, pending
 
 
 def cache_serialize_page(endpoint, **kwargs):
@@ -1293,6 +1524,12 @@ def cache_serialize_page(endpoint, **kwargs):
     `func` is expected to return a json-serializable list.
     It gains the `page` and `request_id` parameter. The resulting list is split into batches of `page_size` items.
 
+    If `bound` names the parameter of `func` that limits the length of the result,
+    `func` additionally gains the `progressive` parameter:
+    The first page is then calculated with `limit=page_size` and the remaining pages
+    are calculated by a background job. Until they are cached, `meta.pending` is true.
+    `func` must then accept `limit` and return the first `limit` items of its full result.
+
     Decorated Function:
         func: func(**kwargs) -> list
 
@@ -1311,23 +1548,24 @@ def cache_serialize_page(endpoint, **kwargs):
 
     def decorator(func):
         @wraps(func)
-        def wrapper(page=None, request_id=None, **func_kwargs):
+        def wrapper(page=None, request_id=None, progressive=False, **func_kwargs):
             if page is None:
                 raise ValueError("page may not be None!")
 
-            raw_result, n_pages, request_id = _load_or_calc(
-                func, func_kwargs, request_id, page, **kwargs
+            raw_result, n_pages, request_id, pending = _load_or_calc(
+                func, func_kwargs, request_id, page, progressive=progressive, **kwargs
             )
 
             meta = {
                 "request_id": request_id,
                 "last_page": n_pages - 1,
+                "pending": pending,
             }
 
             if 0 < page < n_pages:
                 meta["previous_page"] = page - 1
 
-            if page + 1 < n_pages:
+            if page + 1 < n_pages or pending:
                 meta["next_page"] = page + 1
 
             link_parameters = func_kwargs.copy()
@@ -1356,7 +1594,7 @@ def cache_serialize_page(endpoint, **kwargs):
                 url = url_for(endpoint, **link_parameters)
                 link_header_fields.append('<{}>; rel="previous"'.format(url))
 
-            if page + 1 < n_pages:
+            if page + 1 < n_pages or pending:
                 # Link to next page
                 link_parameters["page"] = page + 1
                 url = url_for(endpoint, **link_parameters)
@@ -1429,14 +1667,16 @@ def _get_node_members(
         result = []
         if nodes:
             with timer.child("tree.get_children()"):
-                result.extend(tree.get_children(node_id, include=sorted_nodes_include))
+                result.extend(
+                    _get_children(tree, node_id, include=sorted_nodes_include)
+                )
         if objects:
             with timer.child("tree.get_objects()"):
                 result.extend(tree.get_objects(node_id))
 
         if arrange_by == "starred_sim" or starred_first:
             with timer.child("tree.get_children(starred)"):
-                starred = tree.get_children(node_id, include="starred")
+                starred = _get_children(tree, node_id, include="starred")
 
         if arrange_by != "":
             result = np.array(result, dtype=object)
@@ -1450,7 +1690,7 @@ def _get_node_members(
             elif arrange_by == "starred_sim":
                 with timer.child("starred_sim"):
                     # If no starred members yet, arrange by distance to regular children
-                    anchors = starred if len(starred) else tree.get_children(node_id)
+                    anchors = starred if len(starred) else _get_children(tree, node_id)
 
                     order = _arrange_by_starred_sim(result, anchors)
             elif arrange_by == "interleaved":
@@ -1574,6 +1814,8 @@ def post_node_members(node_id):
             tree.relocate_nodes(node_ids, node_id)
             tree.relocate_objects(object_ids, node_id)
 
+        _schedule_consolidation(tree)
+
     return jsonify("ok")
 
 
@@ -1584,7 +1826,7 @@ def get_node(node_id):
 
         flags = {k: request.args.get(k, 0, strtobool) for k in ("include_children",)}
 
-        node = tree.get_node(node_id)
+        node = _get_node(tree, node_id)
 
         log(connection, "get_node", node_id=node_id)
 
@@ -1619,7 +1861,9 @@ def patch_node(node_id):
                 node_id=node_id,
             )
 
-            node = tree.get_node(node_id, True)
+        _schedule_consolidation(tree)
+
+        node = _get_node(tree, node_id)
 
         result = _node(tree, node, **flags)
 
@@ -1652,6 +1896,8 @@ def node_adopt_members(parent_id):
             tree.relocate_nodes(node_ids, parent_id)
             tree.relocate_objects(object_ids, parent_id)
 
+        _schedule_consolidation(tree)
+
         print(
             "Node {} adopted {} nodes and {} objects.".format(
                 parent_id, len(node_ids), len(object_ids)
@@ -1747,6 +1993,8 @@ def accept_recommended_objects(node_id):
                 tree.relocate_objects(object_ids, node_id)
                 tree.reject_objects(node_id, rejected_object_ids)
 
+            _schedule_consolidation(tree)
+
             log(
                 connection,
                 "accept_recommended_objects",
@@ -1763,11 +2011,14 @@ def accept_recommended_objects(node_id):
         return jsonify({})
 
 
-@cache_serialize_page(".node_get_recommended_children", page_size=20)
-def _node_get_recommended_children(node_id, max_n):
+@cache_serialize_page(".node_get_recommended_children", page_size=20, bound="max_n")
+def _node_get_recommended_children(node_id, max_n, limit=None):
     with database.engine.connect() as connection:
         tree = Tree(connection)
-        result = [_node(tree, c) for c in tree.recommend_children(node_id, max_n=max_n)]
+        result = [
+            _node(tree, c)
+            for c in tree.recommend_children(node_id, max_n=max_n, limit=limit)
+        ]
         return result
 
 
@@ -1782,11 +2033,14 @@ def node_get_recommended_children(node_id):
     Request parameters (GET):
         page (int): Page number (default 0)
         request_id (str, optional): Identification string for the current request collection.
+        progressive (bool): Calculate the first page right away and the remaining pages
+            in the background (default 0). meta.pending is true until they are available.
     """
     parser = reqparse.RequestParser()
     parser.add_argument("page", type=int, default=0, location="args")
     parser.add_argument("max_n", type=int, default=100, location="args")
     parser.add_argument("request_id", default=None, location="args")
+    parser.add_argument("progressive", type=strtobool, default=0, location="args")
     arguments = parser.parse_args(strict=False)
 
     # Limit max_n
@@ -1795,12 +2049,20 @@ def node_get_recommended_children(node_id):
     return _node_get_recommended_children(node_id=node_id, **arguments)
 
 
-@cache_serialize_page(".node_get_recommended_objects", page_size=50)
-def _node_get_recommended_objects(node_id=None, max_n=None):
+@cache_serialize_page(".node_get_recommended_objects", page_size=50, bound="max_n")
+def _node_get_recommended_objects(node_id=None, max_n=None, limit=None):
     with database.engine.connect() as connection:
         tree = Tree(connection)
 
-        result = [_object(o) for o in tree.recommend_objects(node_id, max_n)]
+        result = [
+            _object(o)
+            for o in tree.recommend_objects(
+                node_id,
+                max_n,
+                method=api.config["RECOMMEND_OBJECTS_METHOD"],
+                limit=limit,
+            )
+        ]
 
         return result
 
@@ -1817,11 +2079,14 @@ def node_get_recommended_objects(node_id):
         page (int): Page number (default 0)
         request_id (str, optional): Identification string for the current request collection.
         max_n (int): Maximum number of recommended objects.
+        progressive (bool): Calculate the first page right away and the remaining pages
+            in the background (default 0). meta.pending is true until they are available.
     """
     parser = reqparse.RequestParser()
     parser.add_argument("page", type=int, default=0, location="args")
     parser.add_argument("max_n", type=int, default=100, location="args")
     parser.add_argument("request_id", default=None, location="args")
+    parser.add_argument("progressive", type=strtobool, default=0, location="args")
     arguments = parser.parse_args(strict=False)
 
     # Limit max_n
@@ -1851,16 +2116,16 @@ def node_get_next(node_id):
 
         # Descend if the successor is not approved
         # Rationale: Approval is for a whole subtree.
-        def recurse(_, s):
-            return s.c.approved == False
+        def descend(topology):
+            return ~topology.approved
 
         # Filter descendants that are not approved
-        def filter(subtree):
-            return subtree.c.approved == False
+        def filter(topology):
+            return ~topology.approved
 
         return jsonify(
             tree.get_next_node(
-                node_id, leaf=arguments["leaf"], recurse_cb=recurse, filter=filter
+                node_id, leaf=arguments["leaf"], descend_cb=descend, filter=filter
             )
         )
 
@@ -1886,18 +2151,14 @@ def node_get_next_unfilled(node_id):
     with database.engine.connect() as connection:
         tree = Tree(connection)
 
-        # Consolidate whole tree to populate cached values
-        node = tree.get_node(node_id)
-        root_id = tree.get_root_id(node["project_id"])
-        tree.consolidate_node(root_id, depth="full")
-
+        # The prototypes are taken from the last consolidation (see background.consolidate_dirty)
         # Filter descendants that are approved and unfilled
-        def filter(subtree):
-            return (
-                (subtree.c.approved == True)
-                & (subtree.c.filled == False)
-                & (subtree.c._prototypes != None)
-            )
+        def filter(topology):
+            return topology.approved & ~topology.filled
+
+        # ... and have prototypes
+        def where(nodes):
+            return nodes.c._prototypes != None
 
         return jsonify(
             tree.get_next_node(
@@ -1906,6 +2167,7 @@ def node_get_next_unfilled(node_id):
                 preferred_first=arguments["preferred_first"],
                 order_by=order_by,
                 filter=filter,
+                where=where,
             )
         )
 
@@ -1943,6 +2205,8 @@ def post_node_merge_into(node_id):
         # TODO: Unapprove
         tree.merge_node_into(node_id, data["dest_node_id"])
 
+        _schedule_consolidation(tree)
+
         log(
             connection,
             "merge_node_into({}, {})".format(node_id, data["dest_node_id"]),
@@ -2036,10 +2300,12 @@ def post_node_classify(node_id):
 
             if flags["objects"]:
                 # Predict objects
-                objects = tree.get_objects(node_id)
-                print("Predicting {} objects of {}...".format(len(objects), node_id))
-                object_vectors = np.array([o["vector"] for o in objects])
-                object_ids = np.array([o["object_id"] for o in objects])
+                chunks = list(
+                    tree.iter_object_vectors(node_id, CLASSIFY_CHUNK_SIZE)
+                )
+                object_ids = np.concatenate([c[0] for c in chunks] or [[]])
+                print("Predicting {} objects of {}...".format(len(object_ids), node_id))
+                object_vectors = np.concatenate([c[1] for c in chunks] or [[]])
 
                 type_predicted = classifier.classify(object_vectors, safe=flags["safe"])
 
@@ -2064,12 +2330,14 @@ def post_node_classify(node_id):
                 node_id=node_id,
             )
 
-            return jsonify(
-                {
-                    "n_predicted_children": int(n_predicted_children),
-                    "n_predicted_objects": int(n_predicted_objects),
-                }
-            )
+        _schedule_consolidation(tree)
+
+        return jsonify(
+            {
+                "n_predicted_children": int(n_predicted_children),
+                "n_predicted_objects": int(n_predicted_objects),
+            }
+        )
 
 
 @api.route("/log", methods=["POST"])
@@ -0,0 +1,215 @@
+"""
+Parallel extraction of members from zip archives.
+
+The central directory is read once into a dict, so that looking up a member does not scan the archive.
+The members are extracted by a pool of threads that each hold their own ZipFile handle,
+so that reading and decompressing (zlib releases the GIL) do not contend for a shared file position.
+(Opening a handle parses the central directory again, but only once per worker.)
+Every member is written directly to its target path.
+"""
+
+import os
+import shutil
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+#: Buffer size for copying the member data
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def member_target(target_dir, name):
+    """
+    Get the path of the member `name` below target_dir.
+
+    Unlike ZipFile.extract, the member name is used as is,
+    so names that would leave target_dir (absolute or with ``..`` components) are rejected.
+
+    Raises:
+        ValueError if the path does not lie inside of target_dir.
+    """
+    target_dir = os.path.abspath(target_dir)
+    target = os.path.abspath(os.path.join(target_dir, name))
+
+    if os.path.commonpath([target_dir, target]) != target_dir or target == target_dir:
+        raise ValueError(f"Member {name!r} lies outside of {target_dir}")
+
+    return target
+
+
+class ArchiveExtractor:
+    """
+    Extract members of a zip archive with a pool of threads.
+
+    Members are queued with `extract`. At most `max_pending` members are queued at a time,
+    so that arbitrarily many members can be extracted with constant memory.
+    The callback is called (in the submitting thread) at most every `callback_interval` seconds
+    and once all members are extracted.
+
+    Parameters:
+        archive_fn: Path of the zip archive.
+        n_workers: Number of threads.
+        max_pending: Maximum number of queued members (default: 64 per worker).
+        callback: Called as callback(extractor) to report the progress (see `stats`).
+        callback_interval: Minimum time (in seconds) between calls of callback.
+
+    Example:
+        with ArchiveExtractor(archive_fn, n_workers=4) as extractor:
+            for name in names:
+                if name in extractor:
+                    extractor.extract(name, os.path.join(target_dir, os.path.basename(name)))
+    """
+
+    def __init__(
+        self,
+        archive_fn,
+        n_workers=4,
+        max_pending=None,
+        callback=None,
+        callback_interval=1.0,
+    ):
+        self.archive_fn = archive_fn
+        self.n_workers = n_workers
+        self.max_pending = max_pending if max_pending is not None else 64 * n_workers
+        self.callback = callback
+        self.callback_interval = callback_interval
+
+        with zipfile.ZipFile(archive_fn) as zf:
+            self.members = {info.filename: info for info in zf.infolist()}
+
+        self.n_extracted = 0
+        self.n_bytes = 0
+
+        self._local = threading.local()
+        self._handles = []
+        self._handles_lock = threading.Lock()
+        self._executor = None
+        self._pending = set()
+        # Bounds the number of queued members, released when a member is done
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._done = deque()
+        self._start_time = None
+        self._last_callback = 0.0
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def __enter__(self):
+        self._executor = ThreadPoolExecutor(self.n_workers)
+        self._start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.wait()
+            else:
+                for future in self._pending:
+                    future.cancel()
+        finally:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+            with self._handles_lock:
+                for zf in self._handles:
+                    zf.close()
+                self._handles.clear()
+
+    def _get_handle(self):
+        zf = getattr(self._local, "zf", None)
+
+        if zf is None:
+            zf = self._local.zf = zipfile.ZipFile(self.archive_fn)
+            with self._handles_lock:
+                self._handles.append(zf)
+
+        return zf
+
+    def _extract(self, info, target):
+        target_dir = os.path.dirname(target)
+        if target_dir:
+            os.makedirs(target_dir, exist_ok=True)
+
+        with self._get_handle().open(info) as src, open(target, "wb") as dst:
+            shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+        return info.file_size
+
+    def _on_done(self, future):
+        self._done.append(future)
+        self._slots.release()
+
+    def _collect(self, final=False):
+        while self._done:
+            future = self._done.popleft()
+            self._pending.discard(future)
+            self.n_bytes += future.result()
+            self.n_extracted += 1
+
+        if self.callback is None:
+            return
+
+        now = time.perf_counter()
+        if final or now - self._last_callback >= self.callback_interval:
+            self._last_callback = now
+            self.callback(self)
+
+    def extract(self, name, target):
+        """
+        Queue a member for extraction.
+
+        Blocks while `max_pending` members are queued.
+
+        Parameters:
+            name: Name of the member.
+            target: Path of the extracted file. Missing directories are created.
+
+        Raises:
+            KeyError if the archive has no member `name`.
+            Any exception of a previously queued member.
+        """
+        if self._executor is None:
+            raise RuntimeError("ArchiveExtractor must be used as a context manager")
+
+        info = self.members[name]
+
+        self._slots.acquire()
+        self._collect()
+
+        future = self._executor.submit(self._extract, info, target)
+        self._pending.add(future)
+        future.add_done_callback(self._on_done)
+
+    def wait(self):
+        """
+        Wait until all queued members are extracted.
+        """
+        # All slots are free once the done callbacks of all members have run
+        for _ in range(self.max_pending):
+            self._slots.acquire()
+        for _ in range(self.max_pending):
+            self._slots.release()
+
+        self._collect(final=True)
+
+    def stats(self):
+        """
+        Returns:
+            Dict of n_extracted, n_bytes (uncompressed), elapsed (seconds),
+            files_per_second and bytes_per_second.
+        """
+        elapsed = (
+            time.perf_counter() - self._start_time
+            if self._start_time is not None
+            else 0.0
+        )
+
+        return {
+            "n_extracted": self.n_extracted,
+            "n_bytes": self.n_bytes,
+            "elapsed": elapsed,
+            "files_per_second": self.n_extracted / elapsed if elapsed else 0.0,
+            "bytes_per_second": self.n_bytes / elapsed if elapsed else 0.0,
+        }
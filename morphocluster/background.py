@@ -7,8 +7,11 @@ from pathlib import Path
 
 import flask_rq2
 from flask import current_app as app
+from sqlalchemy import func, select
 
 from morphocluster.extensions import database, rq
+from morphocluster.feature_store import get_feature_store, write_feature_store
+from morphocluster.models import nodes
 from morphocluster.processing.recluster import Recluster
 from morphocluster.processing.tree import Tree as ProcessingTree
 from morphocluster.tree import Tree
@@ -69,25 +72,168 @@ def add(x, y):
     return x + y
 
 
+#: Redis set of node_ids whose cached values need to be consolidated
+CONSOLIDATION_DIRTY_KEY = "morphocluster:consolidation:dirty"
+
+#: Redis key that is set while a consolidation job is queued
+CONSOLIDATION_QUEUED_KEY = "morphocluster:consolidation:queued"
+
+#: Queue of the consolidation worker (rq worker consolidate)
+CONSOLIDATION_QUEUE = "consolidate"
+
+#: Number of dirty nodes that are consolidated in one transaction
+CONSOLIDATION_BATCH_SIZE = 100
+
+#: Delay (in seconds) before a failed consolidation is retried, doubled with every attempt
+CONSOLIDATION_RETRY_DELAY = 10
+
+#: Maximum delay (in seconds) before a failed consolidation is retried
+CONSOLIDATION_RETRY_MAX_DELAY = 3600
+
+
+def _retry_delay(attempt):
+    return min(
+        CONSOLIDATION_RETRY_DELAY * 2 ** (attempt - 1), CONSOLIDATION_RETRY_MAX_DELAY
+    )
+
+
+def _begin(conn):
+    # A savepoint if the job runs inside of an outer transaction
+    return conn.begin_nested() if conn.in_transaction() else conn.begin()
+
+
+def schedule_consolidation(node_ids):
+    """
+    Hand nodes with invalid cached values over to the consolidation worker.
+
+    Must be called after the invalidation was committed.
+    """
+    node_ids = [int(node_id) for node_id in node_ids]
+
+    if not node_ids:
+        return
+
+    connection = rq.connection
+    connection.sadd(CONSOLIDATION_DIRTY_KEY, *node_ids)
+
+    # One queued job drains the whole set
+    if connection.set(CONSOLIDATION_QUEUED_KEY, 1, nx=True, ex=3600):
+        consolidate_dirty.queue(queue=CONSOLIDATION_QUEUE)
+
+
+@rq.job(timeout=3600)
+def consolidate_dirty(attempt=0):
+    """
+    Consolidate the dirty nodes in batches until none are left.
+
+    If the consolidation fails, the remaining nodes are retried by a new job
+    after an exponentially growing delay.
+
+    Parameters:
+        attempt: Number of the retry (0 for the first run).
+    """
+    connection = rq.connection
+
+    if attempt:
+        # The job is still marked as queued, so that new dirty nodes do not skip the delay
+        time.sleep(_retry_delay(attempt))
+
+    # Nodes that become dirty from now on queue a new job
+    connection.delete(CONSOLIDATION_QUEUED_KEY)
+
+    n_consolidated = 0
+    redirtied_node_ids = set()
+    try:
+        while True:
+            # The node_ids are only removed from the set once their consolidation was committed,
+            # so that they are not lost if it fails or the worker dies.
+            members = connection.srandmember(
+                CONSOLIDATION_DIRTY_KEY, CONSOLIDATION_BATCH_SIZE
+            )
+
+            if not members:
+                break
+
+            node_ids = [int(node_id) for node_id in members]
+
+            with database.engine.connect() as conn:
+                db_tree = Tree(conn)
+
+                # Consolidate shallow nodes first, this also covers their invalid descendants.
+                # (Deleted nodes are skipped.)
+                stmt = (
+                    select(nodes.c.node_id)
+                    .where(nodes.c.node_id.in_(node_ids))
+                    .order_by(func.cardinality(nodes.c.path_ids))
+                )
+
+                with _begin(conn):
+                    existing_node_ids = conn.execute(stmt).scalars().all()
+
+                    for node_id in existing_node_ids:
+                        db_tree.consolidate_node(node_id, refresh_prototypes=True)
+
+                connection.srem(CONSOLIDATION_DIRTY_KEY, *members)
+
+                # Nodes that were invalidated again in the meantime stay dirty
+                # (their own schedule_consolidation might have come before the SREM)
+                stmt = select(nodes.c.node_id).where(
+                    nodes.c.node_id.in_(node_ids)
+                    & ~(nodes.c.cache_valid & nodes.c.prototypes_valid)
+                )
+                with _begin(conn):
+                    redirtied_node_ids.update(conn.execute(stmt).scalars())
+
+            n_consolidated += len(existing_node_ids)
+
+        print("Consolidated {:d} dirty nodes.".format(n_consolidated))
+    except Exception:
+        # The node_ids of the failed batch are still in the set
+        delay = _retry_delay(attempt + 1)
+        print("Consolidation failed, retrying in {:d}s.".format(delay))
+
+        if connection.set(CONSOLIDATION_QUEUED_KEY, 1, nx=True, ex=delay + 3600):
+            consolidate_dirty.queue(
+                attempt + 1, queue=CONSOLIDATION_QUEUE, timeout=delay + 3600
+            )
+        raise
+    finally:
+        # Handed over to the next job
+        schedule_consolidation(redirtied_node_ids)
+
+
+@rq.job
+def complete_page_cache(
+    func_name, func_kwargs, request_id, bound, page_size, compress, skip
+):
+    """
+    Calculate the remaining pages of a progressive cache_serialize_page request.
+    """
+    from morphocluster import api
+
+    func = getattr(api, func_name).__wrapped__
+
+    api.complete_pages(func, func_kwargs, request_id, bound, page_size, compress, skip)
+
+
 @rq.job
 def export_project(project_id):
     config = app.config
 
-    # Dump the database tree
+    # Export the database tree
     with database.engine.connect() as conn:
         db_tree = Tree(conn)
         root_id = db_tree.get_root_id(project_id)
         project = db_tree.get_project(project_id)
-        tree = db_tree.dump_tree(root_id)
 
-    tree_fn = os.path.join(
-        config["FILES_DIR"],
-        "{:%Y-%m-%d-%H-%M-%S}--{}--{}.zip".format(
-            dt.datetime.now(), project["project_id"], project["name"]
-        ),
-    )
+        tree_fn = os.path.join(
+            config["FILES_DIR"],
+            "{:%Y-%m-%d-%H-%M-%S}--{}--{}.zip".format(
+                dt.datetime.now(), project["project_id"], project["name"]
+            ),
+        )
 
-    tree.save(tree_fn)
+        db_tree.export_tree(root_id, tree_fn)
 
     return tree_fn
 
@@ -113,8 +259,17 @@ def recluster_project(project_id, min_cluster_size):
     recluster = Recluster()
     recluster.load_tree(tree)
 
-    for features_fn in config["RECLUSTER_FEATURES"]:
-        recluster.load_features(features_fn)
+    if config.get("RECLUSTER_FEATURES"):
+        for features_fn in config["RECLUSTER_FEATURES"]:
+            recluster.load_features(features_fn)
+    else:
+        with database.engine.connect() as conn:
+            feature_store = get_feature_store(connection=conn)
+        if feature_store is None:
+            raise ValueError(
+                "Neither RECLUSTER_FEATURES nor an up-to-date feature store is available"
+            )
+        recluster.load_feature_store(feature_store)
 
     # Cluster 1M objects maximum
     # sample_size = int(1e6)
@@ -579,10 +734,11 @@ def initial_clustering_job(archive_name, feature_file, parameters=None):
             job.save_meta()
 
             import zipfile
+            import numpy as np
             import pandas as pd
             import h5py
-            import shutil
-            from morphocluster import models
+            from morphocluster.archive import ArchiveExtractor
+            from morphocluster.loading import get_vectors_version, insert_objects
 
             # Create images directory for this archive
             images_dir = Path(app_instance.config["IMAGES_DIR"])
@@ -596,18 +752,35 @@ def initial_clustering_job(archive_name, feature_file, parameters=None):
                         fp, dtype=str, usecols=["object_id", "path"]
                     )
 
-                # Extract image files
-                print(f"Extracting {len(archive_df)} images to {archive_images_dir}")
-                for _, row in archive_df.iterrows():
-                    image_path = row["path"]
-                    if image_path in zf.namelist():
-                        # Extract to the archive-specific directory
-                        extracted_path = zf.extract(image_path, archive_images_dir)
+            def update_extraction_progress(extractor):
+                """Update job progress during image extraction"""
+                # Map from 15% to 25% based on the number of extracted images
+                fraction = extractor.n_extracted / max(len(archive_df), 1)
+                job.meta["progress"] = 15 + int(fraction * 10)
+                job.meta["current_step"] = (
+                    f"Extracting images: {extractor.n_extracted}/{len(archive_df)}"
+                )
+                job.meta["extraction"] = extractor.stats()
+                job.save_meta()
 
-                        # Move to flat structure if needed (some archives have subdirectories)
-                        final_path = archive_images_dir / Path(image_path).name
-                        if Path(extracted_path) != final_path:
-                            shutil.move(extracted_path, final_path)
+            # Extract image files into a flat structure (some archives have subdirectories)
+            print(f"Extracting {len(archive_df)} images to {archive_images_dir}")
+            with ArchiveExtractor(
+                archive_path,
+                n_workers=app_instance.config["ARCHIVE_EXTRACT_WORKERS"],
+                callback=update_extraction_progress,
+            ) as extractor:
+                for image_path in archive_df["path"]:
+                    if image_path in extractor:
+                        extractor.extract(
+                            image_path, archive_images_dir / Path(image_path).name
+                        )
+
+            stats = extractor.stats()
+            print(
+                f"Extracted {stats['n_extracted']} images"
+                f" ({stats['files_per_second']:.0f} images/s)"
+            )
 
             # Step 3: Load objects from archive into database
             job.meta["progress"] = 25
@@ -642,51 +815,44 @@ def initial_clustering_job(archive_name, feature_file, parameters=None):
             job.meta["current_step"] = "Inserting objects into database..."
             job.save_meta()
 
-            # Create object data for database insertion
-            object_data = []
-            feature_dict = dict(zip(feature_object_ids, features))
-
-            for _, row in archive_df.iterrows():
-                object_id = row["object_id"]
-                original_path = row["path"]
-                # Update path to point to extracted image in archive subdirectory
-                extracted_path = f"{archive_path.stem}/{Path(original_path).name}"
-                vector = feature_dict.get(object_id)
-
-                if vector is not None:
-                    object_data.append(
-                        {
-                            "object_id": object_id,
-                            "path": extracted_path,  # Path relative to IMAGES_DIR
-                            "vector": vector,  # Keep as numpy array - should be 32 dimensions now
-                        }
-                    )
+            # Objects of the archive that have a feature vector
+            # (for duplicate object_ids in the features, the last one is used like before)
+            feature_idx = pd.Series(
+                np.arange(len(feature_object_ids)), index=feature_object_ids
+            )
+            feature_idx = feature_idx[~feature_idx.index.duplicated(keep="last")]
+            row_idx = archive_df["object_id"].map(feature_idx)
+            selector = row_idx.notnull().to_numpy()
+
+            object_ids = archive_df.loc[selector, "object_id"].to_numpy(dtype=object)
+            # Path relative to IMAGES_DIR (images were extracted to the archive subdirectory)
+            paths = [
+                f"{archive_path.stem}/{Path(original_path).name}"
+                for original_path in archive_df.loc[selector, "path"]
+            ]
+            vectors = np.asarray(features)[row_idx[selector].astype(np.int64)]
+
+            # Insert objects into database (existing objects are left untouched)
+            with database.engine.begin() as conn:
+                inserted_object_ids = insert_objects(conn, object_ids, paths, vectors)
+                vectors_version = get_vectors_version(conn)
 
-            # Insert objects into database
-            with database.engine.connect() as conn:
-                with conn.begin():
-                    # Check if objects already exist to avoid duplicates
-                    existing_objects = conn.execute(
-                        models.objects.select().where(
-                            models.objects.c.object_id.in_(
-                                [obj["object_id"] for obj in object_data]
-                            )
-                        )
-                    ).fetchall()
-                    existing_object_ids = {obj.object_id for obj in existing_objects}
-
-                    # Only insert new objects
-                    new_objects = [
-                        obj
-                        for obj in object_data
-                        if obj["object_id"] not in existing_object_ids
-                    ]
+            print(
+                f"Inserted {len(inserted_object_ids)} new objects into database"
+                f" ({len(object_ids) - len(inserted_object_ids)} already existed)"
+            )
 
-                    if new_objects:
-                        print(f"Inserting {len(new_objects)} new objects into database")
-                        conn.execute(models.objects.insert(), new_objects)
-                    else:
-                        print("All objects already exist in database")
+            # Mirror the inserted vectors in the feature store
+            feature_store_dir = app_instance.config.get("FEATURE_STORE_DIR")
+            if inserted_object_ids and feature_store_dir is not None:
+                inserted = pd.Index(inserted_object_ids)
+                mask = inserted.get_indexer(object_ids) >= 0
+                write_feature_store(
+                    feature_store_dir,
+                    object_ids[mask],
+                    vectors[mask],
+                    version=vectors_version,
+                )
 
             # Step 4: Initialize clustering
             job.meta["progress"] = 40
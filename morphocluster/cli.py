@@ -1,4 +1,5 @@
-import itertools
+import csv
+import io
 import os
 import time
 import zipfile
@@ -15,12 +16,23 @@ import sqlalchemy.engine
 import tqdm
 from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.sql.expression import bindparam, select
+from sqlalchemy.sql.expression import select
 from timer_cm import Timer
 from werkzeug.security import generate_password_hash
 
 from morphocluster import models, processing
+from morphocluster.archive import ArchiveExtractor, member_target
 from morphocluster.extensions import database
+from morphocluster.feature_store import write_feature_store
+from morphocluster.loading import (
+    count_staged_objects,
+    get_vectors_version,
+    insert_staged_objects,
+    load_vectors,
+    select_staged_objects,
+    stage_objects,
+    update_staged_objects,
+)
 from morphocluster.tree import Tree
 
 
@@ -35,6 +47,23 @@ def _add_user(username, password):
         conn.commit()
 
 
+def _read_archive_index(zf: zipfile.ZipFile):
+    """Iterate over the (object_id, path) rows of index.csv without loading it at once."""
+    with zf.open("index.csv") as f:
+        reader = csv.DictReader(io.TextIOWrapper(f, encoding="utf-8", newline=""))
+        for row in reader:
+            yield row["object_id"], row["path"]
+
+
+def _remove_previous_image(images_dir: str, path_old: str):
+    try:
+        os.remove(member_target(images_dir, path_old))
+    except FileNotFoundError:
+        print("Missing previous image:", path_old)
+    except ValueError as exc:
+        print("Not removing previous image:", exc)
+
+
 def init_app(app):
     # pylint: disable=unused-variable
 
@@ -68,6 +97,7 @@ def init_app(app):
             )
             values: Dict[str, Optional[Boolean]] = {c: None for c in cached_columns}
             values["cache_valid"] = False
+            values["prototypes_valid"] = False
             stmt = models.nodes.update().values(values)
             txn.execute(stmt)
 
@@ -93,122 +123,108 @@ def init_app(app):
             database.metadata.drop_all(txn, tables=affected_tables)
             database.metadata.create_all(txn, tables=affected_tables)
 
-    def _load_new_objects(
-        index: pd.DataFrame, batch_size: int, conn, zf: zipfile.ZipFile, images_dir: str
-    ):
-        if not index.size:
-            return
-
-        print(f"Loading {len(index):,d} new objects...")
-        index_iter = index.itertuples()
-        progress = tqdm.tqdm(total=len(index), unit_scale=True)
-        while True:
-            chunk = tuple(
-                row._asdict() for row in itertools.islice(index_iter, batch_size)
-            )
-            if not chunk:
-                break
-
-            chunk_len = len(chunk)
-
-            conn.execute(
-                models.objects.insert(),  # pylint: disable=no-value-for-parameter
-                [dict(row) for row in chunk],
-            )
-
-            for row in chunk:
-                zf.extract(row["path"], images_dir)
-
-            progress.update(chunk_len)
-        progress.close()
-
-    def _update_existing_objects(
-        index: pd.DataFrame, batch_size: int, conn, zf: zipfile.ZipFile, images_dir: str
-    ):
-        if not index.size:
-            return
-
-        stmt = (
-            models.objects.update()
-            .where(models.objects.c.object_id == bindparam("_object_id"))
-            .values({"path": bindparam("path")})
-        )
-
-        print(f"Updating {len(index):,d} existing objects...")
-        index_iter = index.itertuples()
-        progress = tqdm.tqdm(total=len(index), unit_scale=True)
-        while True:
-            chunk = tuple(
-                row._asdict() for row in itertools.islice(index_iter, batch_size)
-            )
-            if not chunk:
-                break
-
-            chunk_len = len(chunk)
-
-            # Update path
-            conn.execute(
-                stmt,
-                [
-                    {"_object_id": str(row["object_id"]), "path": row["path"]}
-                    for row in chunk
-                ],
-            )
-
-            for row in chunk:
-                zf.extract(row["path"], images_dir)
-
-                if row["path"] != row["path_old"]:
-                    try:
-                        os.remove(row["path_old"])
-                    except FileNotFoundError:
-                        print("Missing previous image:", row["path_old"])
-                        pass
-
-            progress.update(chunk_len)
-        progress.close()
-
     @app.cli.command()
     @click.argument("archive_fn")
     @click.option("--add/--no-add", help="Add new objects", default=True)
     @click.option("--update/--no-update", help="Update existing objects", default=True)
-    def load_objects(archive_fn: str, add: bool, update: bool):
+    @click.option(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of threads for image extraction (default: ARCHIVE_EXTRACT_WORKERS).",
+    )
+    def load_objects(archive_fn: str, add: bool, update: bool, workers: Optional[int]):
         """Load an archive of objects into the database."""
 
         batch_size = 1000
 
         images_dir = app.config["IMAGES_DIR"]
 
+        if workers is None:
+            workers = app.config["ARCHIVE_EXTRACT_WORKERS"]
+
         print(f"Loading {archive_fn} into {images_dir}...")
-        with database.engine.begin() as conn, zipfile.ZipFile(archive_fn) as zf:
-            with zf.open("index.csv") as f:
-                index: pd.DataFrame = pd.read_csv(f, usecols=["object_id", "path"], dtype=str)  # type: ignore
-
-            if not index["object_id"].is_unique:
-                value_counts = index["object_id"].value_counts()
-                info = str(value_counts[value_counts > 1])
-                raise ValueError(f"object_id contains duplicate values:\n{info}")
-
-            # Divide index into new and existing objects
-            print("Filtering existing entries...")
-            stmt = "SELECT object_id, path FROM objects"
-            existing = pd.read_sql(stmt, database.engine)
-
-            mask_existing = index["object_id"].isin(existing["object_id"])
-            index_new = index[~mask_existing]
-            index_update = index.merge(
-                existing, how="inner", on="object_id", suffixes=(None, "_old")
-            )
 
-            print(f"{len(existing):,d} objects already present in the database.")
+        def report(extractor: ArchiveExtractor):
+            progress.update(extractor.n_extracted - progress.n)
+
+        # Images that were replaced, removed after the transaction was committed
+        previous_paths = []
+
+        with (
+            database.engine.begin() as conn,
+            zipfile.ZipFile(archive_fn) as zf,
+            ArchiveExtractor(
+                archive_fn, n_workers=workers, max_pending=batch_size, callback=report
+            ) as extractor,
+        ):
+            # Divide index into new and existing objects (inside the database)
+            print("Staging index...")
+            staging = stage_objects(conn, _read_archive_index(zf))
+            n_new, n_existing = count_staged_objects(conn, staging)
+
+            print(f"{n_existing:,d} objects already present in the database.")
+
+            if not add:
+                n_new = 0
+            if not update:
+                n_existing = 0
+
+            # The server-side cursor is opened before the objects table is modified.
+            # (PostgreSQL cursors do not see later changes.)
+            stmt = select_staged_objects(
+                staging, new=add, existing=update
+            ).execution_options(stream_results=True, max_row_buffer=batch_size)
+            result = conn.execute(stmt)
+            partitions = result.partitions(batch_size)
+
+            progress = tqdm.tqdm(total=n_new + n_existing, unit_scale=True)
+
+            def extract(rows):
+                for row in rows:
+                    extractor.extract(row.path, member_target(images_dir, row.path))
+                    if row.path_old is not None and row.path_old != row.path:
+                        previous_paths.append(row.path_old)
+
+            # Extract the first batch of images while the objects are written
+            extract(next(partitions, []))
+
+            if add and n_new:
+                n_inserted = insert_staged_objects(conn, staging)
+                progress.write(f"Added {n_inserted:,d} new objects.")
+
+            if update and n_existing:
+                n_updated = update_staged_objects(conn, staging)
+                progress.write(f"Changed the path of {n_updated:,d} existing objects.")
+
+            for rows in partitions:
+                extract(rows)
+            result.close()
+
+            # Wait for the remaining images before the transaction is committed
+            extractor.wait()
+            progress.close()
 
-            if add:
-                _load_new_objects(index_new, batch_size, conn, zf, images_dir)
+            stats = extractor.stats()
+            print(
+                f"Extracted {stats['n_extracted']:,d} images"
+                f" ({stats['files_per_second']:,.0f} images/s)."
+            )
 
-            if update:
-                _update_existing_objects(index_update, batch_size, conn, zf, images_dir)
+        # Remove the replaced images that no object refers to anymore
+        with database.engine.connect() as conn:
+            for i in range(0, len(previous_paths), batch_size):
+                chunk = previous_paths[i : i + batch_size]
+                stmt = select(models.objects.c.path).where(
+                    models.objects.c.path.in_(chunk)
+                )
+                referenced = set(conn.execute(stmt).scalars())
 
-            print("Done.")
+                for path_old in chunk:
+                    if path_old not in referenced:
+                        _remove_previous_image(images_dir, path_old)
+
+        print("Done.")
 
     @app.cli.command()
     @click.argument("features_fns", nargs=-1)
@@ -266,46 +282,33 @@ def init_app(app):
             )
             del pca_transformer
 
-        if vectors.shape[1] > 100:
+        if models.VECTOR_BACKEND == "cube" and vectors.shape[1] > 100:
             raise ValueError(
-                "The features can not have more than 100 dimensions. Try --truncate or --pca."
+                "The features can not have more than 100 dimensions. Try --truncate or --pca,"
+                " or use MORPHOCLUSTER_VECTOR_BACKEND=float4."
             )
 
         print("Moving feature vectors to the database...")
         with database.engine.begin() as conn:
             conn: sqlalchemy.engine.Connection
 
-            if clear:
-                print("Clearing previous features...")
-                stmt = models.objects.update().values({"vector": None})
-                conn.execute(stmt)
-
-            stmt = (
-                models.objects.update()
-                .where(models.objects.c.object_id == bindparam("_object_id"))
-                .values({"vector": bindparam("vector")})
+            start = time.perf_counter()
+            base_version = get_vectors_version(conn)
+            n_matched, n_unmatched = load_vectors(conn, object_ids, vectors, clear)
+            vectors_version = get_vectors_version(conn)
+            elapsed = time.perf_counter() - start
+            print(
+                f"Loaded vectors of {n_matched:,d} objects after {elapsed:.2f}s ({n_matched / elapsed:,.0f} obj/s)."
             )
+            if n_unmatched:
+                print(f"{n_unmatched:,d} object_ids do not exist in the database.")
 
-            # TODO: Use UPDATE ... RETURNING to get the number of affected rows
-
-            progress = tqdm.tqdm(total=len(object_ids), unit="obj", unit_scale=True)
-            obj_iter = iter(zip(object_ids, vectors))  # type: ignore
-            while True:
-                chunk = tuple(itertools.islice(obj_iter, 1000))
-                if not chunk:
-                    break
-                conn.execute(
-                    stmt,
-                    [
-                        {"_object_id": str(object_id), "vector": vector}
-                        for (object_id, vector) in chunk
-                    ],
-                )
-
-                progress.update(len(chunk))
-            progress.close()
+            # Invalidate the vector indices
+            stmt = models.projects.update().values(
+                vectors_version=models.projects.c.vectors_version + 1
+            )
+            conn.execute(stmt)
 
-            # TODO: In the end, print a summary of how many objects have a feature vector now.
             stmt = (
                 select(func.count())
                 .select_from(models.objects)
@@ -317,10 +320,23 @@ def init_app(app):
             n_total = conn.execute(stmt).scalar()
 
             print(
-                f"{n_initialized:,d} out of {n_total:,d} objects ({n_initialized/n_initialized:.2%}) now have a feature vector."
+                f"{n_initialized:,d} out of {n_total:,d} objects ({n_initialized/max(n_total, 1):.2%}) now have a feature vector."
             )
 
-            print("Done.")
+        feature_store_dir = app.config.get("FEATURE_STORE_DIR")
+        if feature_store_dir is not None:
+            print(f"Writing feature store {feature_store_dir}...")
+            feature_store = write_feature_store(
+                feature_store_dir,
+                object_ids,
+                vectors,
+                clear=clear,
+                version=vectors_version,
+                base_version=base_version,
+            )
+            print(f"The feature store contains {len(feature_store):,d} objects.")
+
+        print("Done.")
 
     @app.cli.command()
     @click.argument("tree_fn")
@@ -447,7 +463,13 @@ def init_app(app):
 
     @app.cli.command()
     @click.argument("root_id", default="visible", callback=validate_consolidate_root_id)
-    def consolidate(root_id):
+    @click.option(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes for object sampling and prototype fitting.",
+    )
+    def consolidate(root_id, workers):
         with database.engine.connect() as conn, Timer("Consolidate") as timer:
             tree = Tree(conn)
 
@@ -464,7 +486,10 @@ def init_app(app):
             for rid in root_ids:
                 with timer.child(str(rid)):
                     print("Consolidating {}...".format(rid))
-                    tree.consolidate_node(rid)
+                    tree.consolidate_node(
+                        rid, n_workers=workers, refresh_prototypes=True
+                    )
+                    conn.commit()
             print("Done.")
 
     @app.cli.command()
@@ -38,9 +38,25 @@ FILES_DIR = _env.str("FILES_DIR", default=posixpath.join(DATA_DIR, "files"))
 # Location where images are served from
 IMAGES_DIR = _env.str("IMAGES_DIR", default=posixpath.join(DATA_DIR, "images"))
 
+# Number of threads that extract images from uploaded archives
+ARCHIVE_EXTRACT_WORKERS = _env.int("ARCHIVE_EXTRACT_WORKERS", default=4)
+
+# Memory-mapped copy of the object vectors (see morphocluster.feature_store)
+FEATURE_STORE_DIR = _env.str(
+    "FEATURE_STORE_DIR", default=posixpath.join(DATA_DIR, "features")
+)
+
 # ORDER BY clause for node_get_next_unfilled
 NODE_GET_NEXT_UNFILLED_ORDER_BY = "largest"
 
+# Maximum time (in seconds) that a request waits for the consolidation worker
+# before serving outdated cached values (flagged as "stale")
+CONSOLIDATION_WAIT = _env.float("CONSOLIDATION_WAIT", default=1.0)
+
+# Method of Tree.recommend_objects: "exact" (distances in the database)
+# or "ann" (approximate nearest neighbour index, see morphocluster.vector_index)
+RECOMMEND_OBJECTS_METHOD = _env.str("RECOMMEND_OBJECTS_METHOD", default="exact")
+
 ## Flask configuration
 # https://flask.palletsprojects.com/en/2.2.x/config/#PREFERRED_URL_SCHEME
 PREFERRED_URL_SCHEME = _env.str("PREFERRED_URL_SCHEME", default=None)
@@ -0,0 +1,291 @@
+"""
+Memory-mapped store of the object feature vectors.
+
+The store is a directory with three files:
+    features.npy: float32 matrix of shape [n_objects, n_features].
+    object_ids.npy: The object_ids (utf-8, sorted). Row i of features belongs to object_ids[i].
+    version.npy: The version of the vectors in the database (vectors_version_seq)
+        that the store was written for.
+
+features.npy and object_ids.npy are opened with mmap_mode="r", so that all processes share one
+copy of the vectors in the page cache instead of parsing them from the database.
+
+The vectors in the database (objects.vector) remain the reference.
+With the "cube" backend, the database stores float64, so vectors read from the store are
+rounded: Each component differs from the database by at most 2**-24 of its magnitude
+(float32 round-to-nearest). This tolerance is accepted for all users of the store.
+The store is written by ``flask load-features`` and by the initial clustering job
+(after the vectors were committed to the database).
+Objects that are missing in the store are read from the database by the users of the store.
+A store whose version differs from the database (e.g. because writing it failed) is ignored.
+"""
+
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+from morphocluster.loading import get_vectors_version
+
+FEATURES_FN = "features.npy"
+OBJECT_IDS_FN = "object_ids.npy"
+VERSION_FN = "version.npy"
+
+# Number of rows of the previous store that are copied at once when merging
+MERGE_CHUNK_SIZE = 100000
+
+
+def _encode_object_ids(object_ids):
+    return np.char.encode(np.asarray(object_ids, dtype=str), "utf-8")
+
+
+class FeatureStore:
+    """
+    Read-only view of a feature store directory.
+
+    Attributes:
+        object_ids: Sorted object_ids (bytes, memory-mapped).
+        vectors: Vectors (float32, memory-mapped). Slices are zero-copy views.
+        version: Version of the vectors in the database that the store was written for
+            (None if unknown).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.object_ids = np.load(os.path.join(path, OBJECT_IDS_FN), mmap_mode="r")
+        self.vectors = np.load(os.path.join(path, FEATURES_FN), mmap_mode="r")
+
+        try:
+            self.version = int(np.load(os.path.join(path, VERSION_FN)))
+        except FileNotFoundError:
+            self.version = None
+
+        if self.vectors.ndim != 2 or len(self.vectors) != len(self.object_ids):
+            raise ValueError(
+                "Inconsistent feature store {}: {} vectors for {} object_ids".format(
+                    path, self.vectors.shape, len(self.object_ids)
+                )
+            )
+
+    def __len__(self):
+        return len(self.object_ids)
+
+    @property
+    def n_features(self):
+        return self.vectors.shape[1]
+
+    def rows(self, object_ids):
+        """
+        Look up the rows of objects.
+
+        Returns:
+            Array of row indices (-1 for objects that are not in the store).
+        """
+        return self._rows(_encode_object_ids(object_ids))
+
+    def _rows(self, object_ids):
+        if not len(self):
+            return np.full(len(object_ids), -1)
+
+        rows = np.searchsorted(self.object_ids, object_ids)
+        rows[rows == len(self)] = 0
+        rows[self.object_ids[rows] != object_ids] = -1
+
+        return rows
+
+    def get(self, object_ids):
+        """
+        Get the vectors of objects.
+
+        Returns:
+            (vectors, found): Vectors of shape [n_objects, n_features]
+                and a boolean mask of the objects that are in the store.
+                Rows of objects that are not in the store are undefined.
+        """
+        rows = self.rows(object_ids)
+        found = rows >= 0
+
+        return self.vectors[np.where(found, rows, 0)], found
+
+
+def write_feature_store(
+    path, object_ids, vectors, clear=False, version=None, base_version=None
+):
+    """
+    Write vectors to the feature store at path.
+
+    Unless clear is given, the vectors are merged into the existing store
+    (new vectors replace existing ones).
+    The existing store is only merged if it is up to date (its version is base_version),
+    otherwise its contents are discarded.
+    The directory is replaced as a whole, so that readers never see a partial store.
+    Processes that still map the previous files are not affected.
+    Concurrent writers are serialized with a lock file next to the store.
+
+    Parameters:
+        version: Version of the vectors in the database after they were loaded.
+        base_version: Version of the vectors in the database before they were loaded
+            (default: version, i.e. no existing vectors were changed).
+
+    Returns:
+        FeatureStore
+    """
+    if base_version is None:
+        base_version = version
+
+    object_ids = _encode_object_ids(object_ids)
+    vectors = np.asarray(vectors, dtype=np.float32)
+
+    if vectors.ndim != 2 or len(vectors) != len(object_ids):
+        raise ValueError(
+            "{} vectors for {} object_ids".format(vectors.shape, len(object_ids))
+        )
+
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+
+    with open(os.path.abspath(path) + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return _write_locked(
+            path, parent, object_ids, vectors, clear, version, base_version
+        )
+
+
+def _write_locked(path, parent, object_ids, vectors, clear, version, base_version):
+    previous = None
+    if not clear and os.path.isdir(path):
+        previous = FeatureStore(path)
+
+        # Stale vectors must not be carried over into an up-to-date store
+        if previous.version != base_version:
+            previous = None
+
+    # Sort and remove duplicates (keeping the first occurence)
+    object_ids, idx = np.unique(object_ids, return_index=True)
+    vectors = vectors[idx]
+
+    if previous is not None:
+        if len(previous) and previous.n_features != vectors.shape[1]:
+            raise ValueError(
+                "The feature store contains {:d}d vectors, got {:d}d. Clear it first.".format(
+                    previous.n_features, vectors.shape[1]
+                )
+            )
+
+        # New vectors replace existing ones
+        replaced = np.zeros(len(previous), dtype=bool)
+        rows = previous._rows(object_ids)
+        replaced[rows[rows >= 0]] = True
+        previous_rows = np.flatnonzero(~replaced)
+        previous_object_ids = previous.object_ids[previous_rows]
+    else:
+        previous_rows = np.zeros(0, dtype=int)
+        previous_object_ids = object_ids[:0]
+
+    # Destination rows of the new and the previous vectors in the merged store
+    merged_object_ids = np.concatenate((object_ids, previous_object_ids))
+    order = np.argsort(merged_object_ids, kind="stable")
+    merged_object_ids = merged_object_ids[order]
+    dest = np.empty_like(order)
+    dest[order] = np.arange(len(order))
+    dest, previous_dest = dest[: len(object_ids)], dest[len(object_ids) :]
+
+    tmp_path = tempfile.mkdtemp(prefix=".features-", dir=parent)
+    try:
+        np.save(os.path.join(tmp_path, OBJECT_IDS_FN), merged_object_ids)
+
+        # The previous vectors are copied in chunks instead of being loaded at once
+        merged_vectors = np.lib.format.open_memmap(
+            os.path.join(tmp_path, FEATURES_FN),
+            mode="w+",
+            dtype=np.float32,
+            shape=(len(merged_object_ids), vectors.shape[1]),
+        )
+        merged_vectors[dest] = vectors
+        for i in range(0, len(previous_rows), MERGE_CHUNK_SIZE):
+            chunk = slice(i, i + MERGE_CHUNK_SIZE)
+            merged_vectors[previous_dest[chunk]] = previous.vectors[
+                previous_rows[chunk]
+            ]
+        merged_vectors.flush()
+        del merged_vectors
+
+        if version is not None:
+            np.save(os.path.join(tmp_path, VERSION_FN), np.int64(version))
+
+        # Readers that run into the gap find no store and use the database
+        old_path = None
+        if os.path.exists(path):
+            old_path = tempfile.mkdtemp(prefix=".features-old-", dir=parent)
+            os.replace(path, os.path.join(old_path, "store"))
+
+        os.replace(tmp_path, path)
+    except:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    if old_path is not None:
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    return FeatureStore(path)
+
+
+#: Opened stores by path
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def get_feature_store(path=None, connection=None):
+    """
+    Get the (cached) feature store at path, reopening it if it was rewritten.
+
+    Parameters:
+        path: Directory of the store. Default: FEATURE_STORE_DIR of the current app.
+        connection: SQLAlchemy connection. If given, a store that was not written
+            for the current version of the vectors in the database is ignored
+            (see morphocluster.loading.get_vectors_version).
+
+    Returns:
+        FeatureStore or None if no (up-to-date) store exists.
+    """
+    if path is None:
+        from flask import current_app, has_app_context
+
+        if not has_app_context():
+            return None
+
+        path = current_app.config.get("FEATURE_STORE_DIR")
+
+        if path is None:
+            return None
+
+    try:
+        stat = os.stat(os.path.join(path, FEATURES_FN))
+    except FileNotFoundError:
+        return None
+
+    key = (stat.st_ino, stat.st_mtime_ns)
+
+    with _cache_lock:
+        cached = _cache.get(path)
+
+    if cached is not None and cached[0] == key:
+        store = cached[1]
+    else:
+        try:
+            store = FeatureStore(path)
+        except (FileNotFoundError, ValueError):
+            # The store is being replaced
+            return None
+
+        with _cache_lock:
+            _cache[path] = (key, store)
+
+    if connection is not None and store.version != get_vectors_version(connection):
+        # The store is outdated (e.g. writing it after loading the vectors failed)
+        return None
+
+    return store
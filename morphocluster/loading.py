@@ -0,0 +1,339 @@
+"""
+Bulk loading of objects and their vectors.
+
+The rows are streamed into a staging table using binary COPY
+(the vectors as float arrays, see morphocluster.sql.staging.copy_vectors)
+and applied to the objects table with a single statement.
+"""
+
+import numpy as np
+from sqlalchemy import Column, String
+from sqlalchemy.dialects.postgresql import ARRAY, DOUBLE_PRECISION, REAL
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.sql.expression import any_, exists, func, select, text
+
+from morphocluster.models import (
+    VECTOR_BACKEND,
+    nodes,
+    nodes_objects,
+    objects,
+    vectors_version_seq,
+)
+from morphocluster.sql.staging import stage_rows, stage_vectors
+
+
+def _staging_vector_column():
+    # cube stores float8, so the vectors are staged without loss of precision
+    if VECTOR_BACKEND == "cube":
+        return Column("vector", ARRAY(DOUBLE_PRECISION))
+
+    return Column("vector", ARRAY(REAL))
+
+
+def _staged_vector(column):
+    """
+    Convert a staged vector column to the type of objects.vector.
+    """
+    if VECTOR_BACKEND == "cube":
+        return func.cube(column, type_=objects.c.vector.type)
+
+    return column
+
+
+def _unique_last(object_ids):
+    """
+    Get the indices of the last occurrence of every object_id.
+    """
+    object_ids = np.asarray(object_ids, dtype=object)
+    _, idx = np.unique(object_ids[::-1], return_index=True)
+    return np.sort(len(object_ids) - 1 - idx)
+
+
+def _invalidate_nodes_of_objects(connection, object_ids):
+    """
+    Invalidate the cached values of the nodes that contain any of the objects
+    and of their ancestors.
+
+    The vector sums, centroids and prototypes (including their radii)
+    of these nodes are derived from the vectors of the objects.
+    _vector_sum is updated incrementally on relocation,
+    so it has to be recalculated from scratch when vectors change.
+
+    Parameters:
+        object_ids: SELECT of object_ids.
+    """
+    node = nodes.alias("node")
+    stmt = (
+        nodes.update()
+        .values(cache_valid=False, prototypes_valid=False)
+        .where(
+            node.c.node_id.in_(
+                select(nodes_objects.c.node_id).where(
+                    nodes_objects.c.object_id.in_(object_ids)
+                )
+            )
+            & (nodes.c.node_id == any_(node.c.path_ids))
+        )
+    )
+    connection.execute(stmt)
+
+
+def load_vectors(connection, object_ids, vectors, clear=False):
+    """
+    Set the vectors of existing objects.
+
+    Objects whose vector does not change are not touched, so that reloading
+    the same features does not bloat the table.
+    The cached values of the nodes that contain changed objects are invalidated
+    and the global vectors version is advanced (see get_vectors_version).
+    If an object_id occurs multiple times, the last vector is used.
+
+    Parameters:
+        connection: SQLAlchemy connection (inside of a transaction).
+        object_ids: Sequence of object_ids.
+        vectors: Array of shape [n_objects, n_features].
+        clear: Remove the vectors of all other objects.
+
+    Returns:
+        (n_matched, n_unmatched): The number of (unique) object_ids that exist in the database
+            and the number of object_ids that do not.
+    """
+    idx = _unique_last(object_ids)
+    object_ids = np.asarray(object_ids, dtype=object)[idx]
+    vectors = np.asarray(vectors)[idx]
+
+    staging = stage_vectors(
+        connection,
+        "load_vectors",
+        [Column("object_id", String, primary_key=True), _staging_vector_column()],
+        [object_ids],
+        vectors,
+    )
+
+    new_vector = _staged_vector(staging.c.vector)
+
+    # Objects whose vector changes
+    changed = select(objects.c.object_id).where(
+        (objects.c.object_id == staging.c.object_id)
+        & objects.c.vector.is_distinct_from(new_vector)
+    )
+    if clear:
+        changed = changed.union_all(
+            select(objects.c.object_id).where(
+                (objects.c.vector != None)
+                & ~exists().where(staging.c.object_id == objects.c.object_id)
+            )
+        )
+
+    _invalidate_nodes_of_objects(connection, changed)
+
+    # Invalidates the feature store until it is rewritten
+    connection.execute(select(vectors_version_seq.next_value()))
+
+    if clear:
+        stmt = (
+            objects.update()
+            .values(vector=None)
+            .where(
+                (objects.c.vector != None)
+                & ~exists().where(staging.c.object_id == objects.c.object_id)
+            )
+        )
+        connection.execute(stmt)
+
+    stmt = (
+        objects.update()
+        .values(vector=new_vector)
+        .where(
+            (objects.c.object_id == staging.c.object_id)
+            & objects.c.vector.is_distinct_from(new_vector)
+        )
+    )
+    connection.execute(stmt)
+
+    stmt = (
+        select(func.count())
+        .select_from(staging)
+        .where(exists().where(objects.c.object_id == staging.c.object_id))
+    )
+    n_matched = connection.execute(stmt).scalar()
+
+    return n_matched, len(object_ids) - n_matched
+
+
+def get_vectors_version(connection):
+    """
+    Get the global version of the object vectors.
+
+    The version is advanced by load_vectors (outside of the transaction).
+    Inserting new objects leaves it unchanged, as no existing vectors change.
+
+    Returns:
+        The version (0 if no vectors were loaded yet).
+    """
+    stmt = text(
+        "SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM {}".format(
+            vectors_version_seq.name
+        )
+    )
+    return connection.execute(stmt).scalar()
+
+
+def insert_objects(connection, object_ids, paths, vectors):
+    """
+    Insert new objects with their vectors.
+
+    Objects that already exist are left untouched.
+    If an object_id occurs multiple times, the last occurrence is used.
+
+    Parameters:
+        connection: SQLAlchemy connection (inside of a transaction).
+        object_ids: Sequence of object_ids.
+        paths: Sequence of image paths.
+        vectors: Array of shape [n_objects, n_features].
+
+    Returns:
+        The object_ids of the inserted objects.
+    """
+    idx = _unique_last(object_ids)
+
+    staging = stage_vectors(
+        connection,
+        "insert_objects",
+        [
+            Column("object_id", String, primary_key=True),
+            Column("path", String),
+            _staging_vector_column(),
+        ],
+        [
+            np.asarray(object_ids, dtype=object)[idx],
+            np.asarray(paths, dtype=object)[idx],
+        ],
+        np.asarray(vectors)[idx],
+    )
+
+    stmt = (
+        pg_insert(objects)
+        .from_select(
+            ["object_id", "path", "vector"],
+            select(
+                staging.c.object_id,
+                staging.c.path,
+                _staged_vector(staging.c.vector),
+            ),
+        )
+        .on_conflict_do_nothing(index_elements=["object_id"])
+        .returning(objects.c.object_id)
+    )
+
+    return connection.execute(stmt).scalars().all()
+
+
+def stage_objects(connection, rows):
+    """
+    COPY the index of an archive into a staging table.
+
+    Parameters:
+        connection: SQLAlchemy connection (inside of a transaction).
+        rows: Iterable of (object_id, path) tuples.
+
+    Returns:
+        sqlalchemy Table
+
+    Raises:
+        ValueError if an object_id occurs multiple times.
+    """
+    staging = stage_rows(
+        connection,
+        "load_objects",
+        [Column("object_id", String), Column("path", String)],
+        rows,
+    )
+
+    count = func.count()
+    stmt = (
+        select(staging.c.object_id, count)
+        .group_by(staging.c.object_id)
+        .having(count > 1)
+        .order_by(count.desc(), staging.c.object_id)
+        .limit(10)
+    )
+    duplicates = connection.execute(stmt).all()
+
+    if duplicates:
+        info = "\n".join(f"{object_id}: {n:d}" for object_id, n in duplicates)
+        raise ValueError(f"object_id contains duplicate values:\n{info}")
+
+    return staging
+
+
+def count_staged_objects(connection, staging):
+    """
+    Returns:
+        (n_new, n_existing): The number of staged objects that are not yet
+            in the database and the number of those that are.
+    """
+    stmt = select(func.count(), func.count(objects.c.object_id)).select_from(
+        staging.outerjoin(objects, objects.c.object_id == staging.c.object_id)
+    )
+    n_total, n_existing = connection.execute(stmt).one()
+
+    return n_total - n_existing, n_existing
+
+
+def select_staged_objects(staging, new=True, existing=True):
+    """
+    Select the staged objects with their current path.
+
+    Returns:
+        SELECT object_id, path, path_old (NULL for new objects).
+    """
+    stmt = select(
+        staging.c.object_id, staging.c.path, objects.c.path.label("path_old")
+    ).select_from(
+        staging.outerjoin(objects, objects.c.object_id == staging.c.object_id)
+    )
+
+    if not new:
+        stmt = stmt.where(objects.c.object_id != None)
+
+    if not existing:
+        stmt = stmt.where(objects.c.object_id == None)
+
+    return stmt
+
+
+def insert_staged_objects(connection, staging):
+    """
+    Insert the staged objects that are not yet in the database.
+
+    Returns:
+        Number of inserted objects.
+    """
+    stmt = objects.insert().from_select(
+        ["object_id", "path"],
+        select(staging.c.object_id, staging.c.path).where(
+            ~exists().where(objects.c.object_id == staging.c.object_id)
+        ),
+    )
+
+    return connection.execute(stmt).rowcount
+
+
+def update_staged_objects(connection, staging):
+    """
+    Update the path of existing objects that changed.
+
+    Returns:
+        Number of updated objects.
+    """
+    stmt = (
+        objects.update()
+        .values(path=staging.c.path)
+        .where(
+            (objects.c.object_id == staging.c.object_id)
+            & objects.c.path.is_distinct_from(staging.c.path)
+        )
+    )
+
+    return connection.execute(stmt).rowcount
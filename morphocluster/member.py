@@ -18,11 +18,19 @@ class MemberCollection(Sequence):
         members: list of dict
         none_action: "raise" | "remove"
             How to deal with None vector values.
+        vectors: Optional array of shape = [n_members, n_features]
+            Vectors of the members (if already available).
+        feature_store: Optional FeatureStore (see morphocluster.feature_store).
+            Objects without a vector key are looked up by their object_id.
     """
 
-    def __init__(self, members, none_action="raise"):
+    def __init__(self, members, none_action="raise", vectors=None, feature_store=None):
         self.members = members
         self.none_action = none_action
+        self.feature_store = feature_store
+
+        if vectors is not None:
+            self._vectors = vectors
 
     @property
     def vectors(self):
@@ -30,10 +38,25 @@ class MemberCollection(Sequence):
             return self._vectors
         except AttributeError:
             vectors = [
-                m["_centroid"] if "_centroid" in m else m["vector"]
+                m["_centroid"] if "_centroid" in m else m.get("vector")
                 for m in self.members
             ]
 
+            if self.feature_store is not None:
+                # Look up objects without a vector in the feature store
+                idx = [
+                    i
+                    for i, m in enumerate(self.members)
+                    if "_centroid" not in m and "vector" not in m
+                ]
+                if idx:
+                    store_vectors, found = self.feature_store.get(
+                        [self.members[i]["object_id"] for i in idx]
+                    )
+                    for i, v, f in zip(idx, store_vectors, found):
+                        if f:
+                            vectors[i] = v
+
             if self.none_action == "raise":
                 n_none = sum(1 for v in vectors if v is None)
                 if n_none:
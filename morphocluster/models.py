@@ -5,9 +5,10 @@ Created on 13.03.2018
 """
 
 import datetime
+import os
 
 # pylint: disable=W,C,R
-from sqlalchemy import Column, ForeignKey, Index, Table
+from sqlalchemy import Column, ForeignKey, Index, Sequence, Table
 from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.sql import func
 from sqlalchemy.sql.schema import CheckConstraint, UniqueConstraint
@@ -17,24 +18,42 @@ from sqlalchemy.types import (
     DateTime,
     Float,
     Integer,
-    PickleType,
     String,
     Text,
 )
 
 from morphocluster.extensions import database as db
-from morphocluster.sql.types import Point
+from morphocluster.sql.types import Float4Array, NumpyArray, Point, PrototypesType
 
 metadata = db.metadata
 
+#: Storage of the object vectors, selected per deployment (MORPHOCLUSTER_VECTOR_BACKEND):
+#: "cube" (Point, at most 100 dimensions, indexed nearest neighbour search)
+#: or "float4" (Float4Array, any number of dimensions).
+#: The column is converted by migration 9d4f3b6e2a17 according to this setting.
+VECTOR_BACKEND = os.environ.get("MORPHOCLUSTER_VECTOR_BACKEND", "cube")
+
+VECTOR_TYPES = {"cube": Point, "float4": Float4Array}
+
+if VECTOR_BACKEND not in VECTOR_TYPES:
+    raise ValueError(
+        "Unknown MORPHOCLUSTER_VECTOR_BACKEND: {!r}".format(VECTOR_BACKEND)
+    )
+
 #: :type objects: sqlalchemy.sql.schema.Table
 objects = Table(
     "objects",
     metadata,
     Column("object_id", String, primary_key=True),
     Column("path", String, nullable=False),
-    Column("vector", Point(numpy=True), nullable=True),
+    Column("vector", VECTOR_TYPES[VECTOR_BACKEND](numpy=True), nullable=True),
     Column("rand", Float, server_default=func.random()),
+    # Nearest neighbour search (ORDER BY vector <-> prototype)
+    *(
+        [Index("idx_objects_vector", "vector", postgresql_using="gist")]
+        if VECTOR_BACKEND == "cube"
+        else []
+    ),
 )
 
 #: :type projects: sqlalchemy.sql.schema.Table
@@ -46,8 +65,17 @@ projects = Table(
     Column("creation_date", DateTime, default=datetime.datetime.now),
     Column("visible", Boolean, nullable=False, server_default="t"),
     Column("metadata", Text, nullable=True),  # JSON metadata for clustering parameters
+    # Incremented whenever the shape or the flags of the tree change (see morphocluster.topology)
+    Column("version", BigInteger, nullable=False, server_default="0"),
+    # Incremented whenever object vectors are loaded (see morphocluster.vector_index)
+    Column("vectors_version", BigInteger, nullable=False, server_default="0"),
 )
 
+#: Global version of the object vectors, advanced whenever vectors are loaded
+#: (see morphocluster.loading.load_vectors).
+#: The feature store records the version it was written for (see morphocluster.feature_store).
+vectors_version_seq = Sequence("vectors_version_seq", metadata=metadata)
+
 #: :type nodes: sqlalchemy.sql.schema.Table
 nodes = Table(
     "nodes",
@@ -83,13 +111,17 @@ nodes = Table(
         index=True,
         nullable=True,
     ),
+    # Materialized path: node_ids of all ancestors from the root down to (and including) this node
+    Column("path_ids", ARRAY(BigInteger), nullable=True),
     # ===========================================================================
     # The following fields are cached values
     # ===========================================================================
     # Centroid (single)
-    Column("_centroid", PickleType, nullable=True),
+    Column("_centroid", NumpyArray("<f4"), nullable=True),
     # Prototypes (multiple centroid)
-    Column("_prototypes", PickleType, nullable=True),
+    Column("_prototypes", PrototypesType, nullable=True),
+    # Prototypes of the objects directly below this node (with radii, used to bound their distance)
+    Column("_own_prototypes", PrototypesType, nullable=True),
     # object_ids of type objects representative for all descendants (used as preview)
     Column("_type_objects", ARRAY(String), nullable=True),
     # object_ids of type objects directly under this node (used as preview for the node's objects)
@@ -100,10 +132,19 @@ nodes = Table(
     Column("_n_objects", BigInteger, nullable=True),
     # Number of all objects anywhere below this node
     Column("_n_objects_deep", BigInteger, nullable=True),
+    # Sum of the vectors of all objects anywhere below this node (_centroid = _vector_sum / _n_objects_deep)
+    # (float64, because it is updated incrementally)
+    Column("_vector_sum", NumpyArray("<f8"), nullable=True),
     # Validity of cached values
     Column("cache_valid", Boolean, nullable=False, server_default="f"),
+    # Validity of _prototypes, _own_prototypes, _type_objects and _own_type_objects.
+    # (The additive values are updated incrementally when objects or nodes are relocated,
+    # the prototypes only become stale.)
+    Column("prototypes_valid", Boolean, nullable=False, server_default="f"),
     # An orig_id must be unique inside a project
     Index("idx_orig_proj", "orig_id", "project_id", unique=True),
+    # Subtree lookups (path_ids @> ARRAY[node_id])
+    Index("idx_nodes_path_ids", "path_ids", postgresql_using="gin"),
     # A node may not be its own child
     CheckConstraint("node_id != parent_id"),
 )
@@ -7,6 +7,15 @@ from sklearn.preprocessing import LabelEncoder
 from sklearn.utils.extmath import softmax
 from sklearn.utils.validation import check_is_fitted
 
+#: Relative tolerance of lower_bound
+_BOUND_RTOL = 1e-5
+
+
+def _check_is_fitted(prototypes):
+    # sklearn's check_is_fitted only accepts estimators
+    if not hasattr(prototypes, "prototypes_") or not hasattr(prototypes, "support_"):
+        raise NotFittedError("Prototypes are not fitted.")
+
 
 def _check_is_clusterer(clusterer):
     attributes = ("fit_predict", "n_clusters")
@@ -29,6 +38,9 @@ class Prototypes:
     Attributes:
         prototypes_: array of shape = [n_prototypes, n_features]
         support_: array of shape = [n_prototypes]
+        radii_: array of shape = [n_prototypes] (optional)
+            Maximum distance of the vectors represented by each prototype.
+            Every vector lies within the radius of some prototype.
     """
 
     def __init__(self, clusterer):
@@ -51,6 +63,8 @@ class Prototypes:
         if self.clusterer.n_clusters == 1:
             self.prototypes_ = np.mean(X, axis=0)[np.newaxis, :]
             self.support_ = np.array([X.shape[0]])
+            self.radii_ = np.zeros(1)
+            self.expand_radii(X)
             self._validate()
 
             return
@@ -59,6 +73,7 @@ class Prototypes:
         if X.shape[0] <= self.clusterer.n_clusters:
             self.prototypes_ = X.copy()
             self.support_ = np.ones(X.shape[0])
+            self.radii_ = np.zeros(X.shape[0])
             self._validate()
 
             return
@@ -67,14 +82,114 @@ class Prototypes:
 
         self.prototypes_ = self.clusterer.cluster_centers_
         self.support_ = np.bincount(labels, minlength=self.prototypes_.shape[0])
+        self.radii_ = np.zeros(self.prototypes_.shape[0])
+        self.expand_radii(X)
+        self._validate()
+
+    def expand_radii(self, X):
+        """
+        Expand the radii so that every row of X lies within the radius of its closest prototype.
+
+        Used to include vectors that were not part of the sample the prototypes were fitted to.
+
+        Parameters:
+            X: array of shape = [n_samples, n_features]
+        """
+        _check_is_fitted(self)
+
+        if X.shape[0] == 0:
+            return
+
+        dist_matrix = cdist(X, self.prototypes_)
+        labels = np.argmin(dist_matrix, axis=1)
+
+        radii = np.array(self.radii_, dtype=float)
+        np.maximum.at(radii, labels, dist_matrix[np.arange(X.shape[0]), labels])
+        self.radii_ = radii
+
+    def lower_bound(self, X):
+        """
+        Compute a lower bound of the distance of every row in X
+        to any of the vectors represented by the prototypes.
+
+        By the triangle inequality, no represented vector is closer to x
+        than the distance of x to a prototype minus its radius.
+
+        Returns: array of shape = [n_samples]
+            Zero where no bound is known (e.g. if the prototypes have no radii).
+        """
+        _check_is_fitted(self)
+
+        if getattr(self, "radii_", None) is None or self.prototypes_.shape[0] == 0:
+            return np.zeros(X.shape[0])
+
+        # Tolerate the rounding of the float32 representation
+        slack = _BOUND_RTOL * (np.linalg.norm(self.prototypes_, axis=1) + self.radii_)
+
+        dist_matrix = cdist(X, self.prototypes_) - self.radii_ - slack
+
+        return np.maximum(np.min(dist_matrix, axis=1), 0)
+
+    def to_bytes(self):
+        """
+        Serialize to a compact binary representation.
+
+        Layout: k and d (uint32), prototypes_ (k*d float32), support_ (k float32)
+        and optionally radii_ (k float32).
+        """
+        if not hasattr(self, "prototypes_"):
+            raise NotFittedError("Prototypes are not fitted.")
         self._validate()
 
+        k, d = self.prototypes_.shape
+        parts = [
+            np.array([k, d], dtype="<u4").tobytes(),
+            np.ascontiguousarray(self.prototypes_, dtype="<f4").tobytes(),
+            np.ascontiguousarray(self.support_, dtype="<f4").tobytes(),
+        ]
+
+        if getattr(self, "radii_", None) is not None:
+            parts.append(np.ascontiguousarray(self.radii_, dtype="<f4").tobytes())
+
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, buffer):
+        """
+        Deserialize from the representation created by to_bytes.
+
+        The arrays are read-only views into buffer.
+        """
+        k, d = np.frombuffer(buffer, dtype="<u4", count=2)
+        k, d = int(k), int(d)
+
+        result = cls(None)
+        result.prototypes_ = np.frombuffer(
+            buffer, dtype="<f4", count=k * d, offset=8
+        ).reshape((k, d))
+        result.support_ = np.frombuffer(
+            buffer, dtype="<f4", count=k, offset=8 + 4 * k * d
+        )
+
+        # Prototypes serialized without radii_ are still supported
+        if len(buffer) >= 8 + 4 * k * d + 8 * k:
+            result.radii_ = np.frombuffer(
+                buffer, dtype="<f4", count=k, offset=8 + 4 * k * d + 4 * k
+            )
+
+        return result
+
     def _validate(self):
         """Validate that prototypes and support match."""
         assert (
             self.prototypes_.shape[0] == self.support_.shape[0]
         ), f"Prototype shape ({self.prototypes_.shape}) does not support shape ({self.support_.shape})"
 
+        radii = getattr(self, "radii_", None)
+        assert (
+            radii is None or self.prototypes_.shape[0] == radii.shape[0]
+        ), f"Prototype shape ({self.prototypes_.shape}) does not match radii shape ({radii.shape})"
+
     def transform(self, X, metric="euclidean", **kwargs):
         """
         Compute distance for every row in X.
@@ -91,7 +206,7 @@ class Prototypes:
 
         TODO: Accept a list of Prototypes as X
         """
-        check_is_fitted(self, ["prototypes_", "support_"])
+        _check_is_fitted(self)
 
         if self.prototypes_.shape[0] == 0:
             return np.zeros(X.shape[0]) + np.inf
@@ -198,15 +313,22 @@ def merge_prototypes(children, k, metric="euclidean"):
         return Prototypes(None)
 
     for c in children:
-        check_is_fitted(c, ["prototypes_", "support_"])
+        _check_is_fitted(c)
 
     prototypes_ = np.concatenate([ncd.prototypes_ for ncd in children])
     support_ = np.concatenate([ncd.support_ for ncd in children])
 
+    # Radii are only known if they are known for all children
+    if all(getattr(ncd, "radii_", None) is not None for ncd in children):
+        radii_ = np.concatenate([ncd.radii_ for ncd in children])
+    else:
+        radii_ = None
+
     if prototypes_.shape[0] <= k:
         result = Prototypes(k)
         result.prototypes_ = prototypes_
         result.support_ = support_
+        result.radii_ = radii_
 
         return result
 
@@ -217,6 +339,7 @@ def merge_prototypes(children, k, metric="euclidean"):
         (unique_labels.shape[0], prototypes_.shape[1]), prototypes_.dtype
     )
     new_support = np.empty((unique_labels.shape[0]), support_.dtype)
+    new_radii = np.empty((unique_labels.shape[0]))
 
     for label in unique_labels:
         mask = labels == label
@@ -229,8 +352,15 @@ def merge_prototypes(children, k, metric="euclidean"):
 
         new_prototypes[label] = x
 
+        if radii_ is not None:
+            # The merged sphere encloses the spheres of the merged prototypes
+            new_radii[label] = np.max(
+                np.linalg.norm(prototypes_[mask] - x, axis=1) + radii_[mask]
+            )
+
     result = Prototypes(None)
     result.prototypes_ = new_prototypes
     result.support_ = new_support
+    result.radii_ = new_radii if radii_ is not None else None
 
     return result
@@ -60,6 +60,37 @@ class Recluster:
                 "object_id": pd.Series(f_features["object_id"].asstr()[:]),
             }
 
+        self._add_dataset(dataset, append)
+
+        self._log("load_features", dict(append=append, features_fn=features_fn))
+
+        return self
+
+    def load_feature_store(self, feature_store, append=True):
+        """
+        Use the vectors of a feature store (see morphocluster.feature_store).
+
+        The memory-mapped vectors are not copied (unless appended to existing features).
+
+        Parameters:
+            feature_store: FeatureStore.
+            append: Append to the existing features (instead of replacing).
+        """
+
+        print("Loading feature store {}...".format(feature_store.path))
+
+        dataset = {
+            "features": feature_store.vectors,
+            "object_id": pd.Series(np.char.decode(feature_store.object_ids, "utf-8")),
+        }
+
+        self._add_dataset(dataset, append)
+
+        self._log("load_feature_store", dict(append=append, path=feature_store.path))
+
+        return self
+
+    def _add_dataset(self, dataset, append):
         if append and self.dataset is not None:
             self.dataset["features"] = np.concatenate(
                 (self.dataset["features"], dataset["features"])
@@ -72,15 +103,11 @@ class Recluster:
         else:
             self.dataset = dataset
 
-        self._log("load_features", dict(append=append, features_fn=features_fn))
-
         print("Loaded {:,d} features.".format(len(dataset["features"])))
 
         if append:
             print("Dataset size: {:,d}".format(len(self.dataset["features"])))
 
-        return self
-
     def init_tree(self):
         """
         Initialize tree from dataset.
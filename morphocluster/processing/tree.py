@@ -6,15 +6,50 @@ Conversion between different tree formats.
 import json
 import os
 import sys
-from io import StringIO
+from io import BytesIO, TextIOWrapper
 from typing import Dict
-from zipfile import ZIP_DEFLATED, ZipFile
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
 
 import fire
 import numpy as np
 import pandas as pd
 
 
+def open_text_member(archive: ZipFile, name):
+    """
+    Open a member of archive for writing text.
+
+    The data is compressed and written while it is produced,
+    so that it never has to be held in memory completely.
+    """
+    return TextIOWrapper(
+        archive.open(name, "w", force_zip64=True), encoding="utf-8", newline=""
+    )
+
+
+#: Tables of a saved tree
+TABLES = ("nodes", "objects", "rejected_objects")
+
+#: Data types of the columns of the CSV tables (which are otherwise inferred)
+_CSV_DTYPES = {
+    "nodes": {"name": str},
+    "objects": {"object_id": str},
+    "rejected_objects": {"object_id": str},
+}
+
+#: Positions of the children of a leaf
+_NO_CHILDREN = np.empty(0, dtype=np.int64)
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError as exc:
+        raise ImportError(
+            "You must have pyarrow installed to use the parquet format"
+        ) from exc
+
+
 class Tree(object):
     """
     Conversion between different tree formats.
@@ -83,22 +118,46 @@ class Tree(object):
         return Tree(nodes, objects)
 
     @staticmethod
-    def from_saved(tree_fn) -> "Tree":
+    def from_saved(tree_fn, tables=TABLES, columns=None) -> "Tree":
         """
         Read a saved tree.
+
+        The format (CSV or parquet) is detected automatically.
+
+        Parameters:
+            tables: Tables to read (e.g. `("nodes",)`). The others are None.
+            columns: Optional mapping of a table name to the columns to read.
+                The columns required by Tree must be included.
         """
+        if columns is None:
+            columns = {}
+
         with ZipFile(tree_fn, "r") as archive:
-            with archive.open("nodes.csv", "r") as nodes_f:
-                nodes = pd.read_csv(nodes_f, dtype={"name": str})
-            with archive.open("objects.csv", "r") as objects_f:
-                objects = pd.read_csv(objects_f, dtype={"object_id": str})
+            members = set(archive.namelist())
 
-            try:
-                with archive.open("rejected_objects.csv", "r") as objects_f:
-                    rejected_objects = pd.read_csv(objects_f, dtype={"object_id": str})
-            except KeyError:
-                # No such member
-                rejected_objects = None
+            if "nodes.parquet" in members:
+                _require_pyarrow()
+
+                def read_table(name):
+                    data = BytesIO(archive.read(name + ".parquet"))
+                    return pd.read_parquet(data, columns=columns.get(name))
+
+                ext = ".parquet"
+            else:
+
+                def read_table(name):
+                    with archive.open(name + ".csv", "r") as f:
+                        return pd.read_csv(
+                            f, dtype=_CSV_DTYPES[name], usecols=columns.get(name)
+                        )
+
+                ext = ".csv"
+
+            data = {
+                name: read_table(name) if name + ext in members else None
+                for name in TABLES
+                if name in tables
+            }
 
             try:
                 with archive.open("meta.json", "r") as meta_f:
@@ -110,7 +169,12 @@ class Tree(object):
         meta["base"] = "from_saved"
         meta["base_fn"] = tree_fn
 
-        return Tree(nodes, objects, rejected_objects, meta)
+        return Tree(
+            data.get("nodes"),
+            data.get("objects"),
+            data.get("rejected_objects"),
+            meta,
+        )
 
     @staticmethod
     def from_HDBSCAN(path, root_first=True) -> "Tree":
@@ -277,32 +341,116 @@ class Tree(object):
         if meta is None:
             meta = {}
 
-        self.nodes: pd.DataFrame = nodes
+        self.nodes = nodes
         self.objects: pd.DataFrame = objects
         self.rejected_objects: pd.DataFrame = rejected_objects
         self.meta: Dict = meta
 
-    def save(self, tree_fn, meta=None):
+    @property
+    def nodes(self) -> pd.DataFrame:
+        return self._nodes
+
+    @nodes.setter
+    def nodes(self, nodes):
+        self._nodes = nodes
+        self._index = None
+
+    def _get_index(self):
+        """
+        Get the (cached) index of the tree structure.
+
+        The index is rebuilt when `nodes` is replaced or when its node_id or parent_id
+        columns were changed in place (e.g. `tree.nodes.loc[..., "parent_id"] = ...`).
+        The check is linear in the number of nodes,
+        so the index should be retrieved once per operation.
+
+        Returns:
+            (node_ids, rows, children): Array of the node_ids of all rows,
+            mapping of node_id to the position of its (first) row and
+            mapping of node_id to the positions of the rows of its children.
+        """
+        node_ids = self.nodes["node_id"]
+        parent_ids = self.nodes["parent_id"]
+
+        if self._index is not None:
+            index, cached_node_ids, cached_parent_ids = self._index
+            if cached_node_ids.equals(node_ids) and cached_parent_ids.equals(
+                parent_ids
+            ):
+                return index
+
+        # Snapshots to detect changes
+        node_ids, parent_ids = node_ids.copy(), parent_ids.copy()
+
+        rows = {}
+        for i, node_id in enumerate(node_ids.tolist()):
+            rows.setdefault(node_id, i)
+
+        has_parent = parent_ids.notnull().to_numpy()
+        children = {
+            parent_id: children_pos.to_numpy()
+            for parent_id, children_pos in pd.Index(np.flatnonzero(has_parent))
+            .groupby(parent_ids.to_numpy()[has_parent])
+            .items()
+        }
+
+        index = (node_ids.to_numpy(), rows, children)
+        self._index = (index, node_ids, parent_ids)
+
+        return index
+
+    def _subtree_ids(self, node_id, index=None):
+        """
+        Get the node_ids of the subtree rooted at node_id (including node_id).
+
+        Parameters:
+            index: The result of _get_index, if already retrieved.
+        """
+        node_ids, _, children = self._get_index() if index is None else index
+
+        result = []
+        queue = [node_id]
+        while queue:
+            node_id = queue.pop()
+            result.append(node_id)
+            queue.extend(node_ids[children.get(node_id, _NO_CHILDREN)].tolist())
+
+        return result
+
+    def save(self, tree_fn, meta=None, format="csv"):
         """
         Save nodes and objects to an archive.
+
+        Parameters:
+            format: "csv" or "parquet". Parquet preserves the data types
+                and is considerably faster to write and read.
         """
 
+        if format not in ("csv", "parquet"):
+            raise ValueError("Unknown format: {!r}".format(format))
+
+        if format == "parquet":
+            _require_pyarrow()
+
         # Merge meta into self.meta
         meta = {**(self.meta or {}), **(meta or {})}
 
-        with ZipFile(tree_fn, "w", ZIP_DEFLATED) as archive:
-            buffer_ = StringIO()
-            self.nodes.to_csv(buffer_, index=False)
-            archive.writestr("nodes.csv", buffer_.getvalue())
+        # Parquet is already compressed
+        compression = ZIP_STORED if format == "parquet" else ZIP_DEFLATED
 
-            buffer_ = StringIO()
-            self.objects.to_csv(buffer_, index=False)
-            archive.writestr("objects.csv", buffer_.getvalue())
+        with ZipFile(tree_fn, "w", compression) as archive:
+            for name in TABLES:
+                table = getattr(self, name)
 
-            if self.rejected_objects is not None:
-                buffer_ = StringIO()
-                self.rejected_objects.to_csv(buffer_, index=False)
-                archive.writestr("rejected_objects.csv", buffer_.getvalue())
+                if table is None:
+                    continue
+
+                if format == "parquet":
+                    with archive.open(name + ".parquet", "w", force_zip64=True) as f:
+                        table.to_parquet(f, index=False)
+                else:
+                    with open_text_member(archive, name + ".csv") as f:
+                        table.to_csv(f, index=False)
 
             if meta is not None:
                 archive.writestr("meta.json", json.dumps(meta))
@@ -332,27 +480,27 @@ class Tree(object):
         if root_id is None:
             root_id = self.get_root_id()
 
+        node_ids, rows, children = self._get_index()
+
         queue = [root_id]
 
         while queue:
             node_id = queue.pop()
 
-            child_selector = self.nodes["parent_id"] == node_id
-            children = self.nodes.loc[child_selector]
+            children_pos = children.get(node_id, _NO_CHILDREN)
 
             if order_by_name:
-                children = children.sort_values("name")
-
-            queue.extend(children["node_id"])
+                names = self.nodes["name"].iloc[children_pos]
+                children_pos = children_pos[
+                    names.reset_index(drop=True).sort_values().index
+                ]
 
-            node_selector = self.nodes["node_id"] == node_id
+            queue.extend(node_ids[children_pos])
 
-            if not node_selector.any():
+            if node_id not in rows:
                 raise ValueError("No matching row for node_id={}".format(node_id))
 
-            node_idx = node_selector.idxmax()
-
-            yield node_idx
+            yield self.nodes.index[rows[node_id]]
 
     def walk(self, path=None):
         """
@@ -363,32 +511,38 @@ class Tree(object):
         if path is None:
             path = [self.get_root_id()]
 
+        node_ids, _, children = self._get_index()
+
         yield (path[:-1], [path[-1]])
 
         queue = [path]
         while queue:
             path = queue.pop()
 
-            child_selector = self.nodes["parent_id"] == path[-1]
+            children_pos = children.get(path[-1], _NO_CHILDREN)
 
-            if child_selector.any():
-                child_node_ids = list(self.nodes.loc[child_selector, "node_id"])
+            if len(children_pos):
+                child_node_ids = node_ids[children_pos].tolist()
 
                 yield (path, child_node_ids)
 
                 queue.extend([path + [c] for c in child_node_ids])
 
     def get_path(self, node_id):
+        """
+        Get the node_ids of the ancestors of a node, from the root down to its parent.
+        """
+        _, rows, _ = self._get_index()
+        parent_ids = self.nodes["parent_id"].to_numpy()
+
         path = []
 
-        while True:
-            node_selector = self.nodes["node_id"] == node_id
+        while node_id in rows:
+            parent_id = parent_ids[rows[node_id]]
 
-            if not node_selector.any():
+            if pd.isnull(parent_id):
                 break
 
-            node = self.nodes[node_selector.idxmax()]
-            parent_id = node["parent_id"]
             path.append(parent_id)
 
             node_id = parent_id
@@ -510,13 +664,10 @@ class Tree(object):
         Traverse the tree and see if all nodes and objects are visited.
         """
 
-        # Visit objects
-        self.nodes["__visited"] = False
-        for node_idx in self.topological_order_idx():
-            self.nodes.loc[node_idx, "__visited"] = True
-        if any(~self.nodes["__visited"]):
+        # Visit nodes
+        n_visited = sum(1 for _ in self.topological_order_idx())
+        if n_visited < len(self.nodes):
             raise ValueError("Tree is not a single connected component.")
-        del self.nodes["__visited"]
 
         # Check objects
         ons = set(self.objects["node_id"])
@@ -535,12 +686,12 @@ class Tree(object):
         Returns a DataFrame with object_id and label.
 
         Ignores objects without named ancestors.
-        """
-
-        node_idx = pd.Index(self.nodes["node_id"])
 
-        def _get_nodes(node_ids):
-            return [self.nodes.loc[node_idx.get_loc(node_id)] for node_id in node_ids]
+        The labels of the nodes are calculated in a single top-down pass:
+        A named node is labeled with the names along its path,
+        all nodes below an unnamed node inherit the label of its parent.
+        The objects are then labeled with the label of their node.
+        """
 
         def _clean_path_name(path):
             result = ""
@@ -559,56 +710,63 @@ class Tree(object):
 
             return result
 
-        objects = self.objects.copy()
-        objects["label"] = None
+        def _path_name(prefix, name):
+            # prefix is None for children of the root
+            if prefix is None:
+                return name
 
-        root_id = self.get_root_id()
+            if clean_name:
+                return _clean_path_name((prefix, name))
 
-        for path, node_ids in self.walk():
-            path_nodes = _get_nodes(path[1:])
+            return "/".join((prefix, name))
 
-            if clean_name:
-                path_name = _clean_path_name(str(node["name"]) for node in path_nodes)
-            else:
-                path_name = "/".join(str(node["name"]) for node in path_nodes)
+        index = self._get_index()
+        node_ids, _, children = index
+        names = self.nodes["name"].to_numpy()
 
-            nodes = _get_nodes(node_ids)
+        node_labels = {}
 
-            # Do not descend into unnamed nodes
-            node_ids[:] = [n["node_id"] for n in nodes if not pd.isnull(n["name"])]
+        # Named nodes (and the root) with the path name of their children
+        queue = [(self.get_root_id(), None)]
+        while queue:
+            node_id, prefix = queue.pop()
 
-            for node in nodes:
-                if node["node_id"] == root_id:
-                    continue
+            children_pos = children.get(node_id, _NO_CHILDREN)
 
-                if pd.isnull(node["name"]):
+            for child_id, name in zip(
+                node_ids[children_pos].tolist(), names[children_pos]
+            ):
+                if pd.isnull(name):
                     # This node has no name, append all objects below to the parent node
-                    subtree = sum(
-                        (node_ids for _, node_ids in self.walk([node["node_id"]])), []
-                    )
+                    label = prefix or ""
+                    for n_id in self._subtree_ids(child_id, index):
+                        node_labels[n_id] = label
+                    continue
 
-                    object_selector = objects["node_id"].isin(subtree)
-                    objects.loc[object_selector, "label"] = path_name
-                else:
-                    node_name = str(node["name"])
+                # This node has a name, append objects to this node
+                name = str(name)
+                path_name = _path_name(prefix, name)
 
-                    if clean_name:
-                        canonical_name = _clean_path_name((path_name, node_name))
-                    else:
-                        canonical_name = "/".join((path_name, node_name))
+                if clean_name:
+                    node_labels[child_id] = path_name
+                else:
+                    node_labels[child_id] = "/".join((prefix or "", name))
 
-                    print(" {}".format(canonical_name))
+                queue.append((child_id, path_name))
 
-                    # This node has a name, append objects to this node
-                    object_selector = objects["node_id"] == node["node_id"]
-                    objects.loc[object_selector, "label"] = canonical_name
+        labels = self.objects["node_id"].map(node_labels)
+        result_mask = ~labels.isna()
 
-        result_mask = ~objects["label"].isna()
-        return objects.loc[result_mask, ["object_id", "label"]].reset_index(drop=True)
+        return (
+            self.objects.loc[result_mask, ["object_id"]]
+            .assign(label=labels[result_mask])
+            .reset_index(drop=True)
+        )
 
     def offset_node_ids(self, offset):
         self.nodes["node_id"] += offset
         self.nodes.loc[pd.notna(self.nodes["parent_id"]), "parent_id"] += offset
+        self._index = None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,199 @@
+"""
+Bulk transfer of vector columns (Point or Float4Array).
+
+The vectors of a result are decoded column-wise into one contiguous array
+instead of value by value.
+
+If the type supports binary I/O (float4[] always, cube >= 1.5 with PostgreSQL >= 14),
+the result is transferred with ``COPY ... TO STDOUT (FORMAT binary)``
+and the coordinates are read without parsing any text.
+Otherwise, the text representations are fetched and parsed at once.
+"""
+
+import io
+import struct
+
+from sqlalchemy import Integer, String, Text, cast
+
+from morphocluster.sql.staging import BINARY_COPY_SIGNATURE
+from morphocluster.sql.types import (
+    Float4Array,
+    Point,
+    decode_float4_arrays_binary,
+    decode_points_binary,
+    parse_points,
+)
+
+_int16 = struct.Struct(">h")
+_int32 = struct.Struct(">i")
+
+
+def binary_points_supported(connection):
+    """
+    Check if the cube type of the database has a binary representation.
+
+    The result is cached per DBAPI connection.
+    """
+    supported = connection.info.get("binary_points")
+
+    if supported is None:
+        stmt = "SELECT typsend::text FROM pg_type WHERE typname = 'cube'"
+        typsend = connection.exec_driver_sql(stmt).scalar()
+        supported = connection.info["binary_points"] = typsend == "cube_send"
+
+    return supported
+
+
+def as_text(column):
+    """
+    Select a vector column as text, to be decoded with parse_points.
+    """
+    return cast(column, Text).label(column.name)
+
+
+def render_copy_query(dialect, stmt):
+    """
+    Render ``COPY (stmt) TO STDOUT WITH (FORMAT binary)`` with all values inlined.
+
+    COPY does not accept parameters, so the values are rendered into the statement.
+    For the format and pyformat paramstyles (psycopg2), SQLAlchemy escapes every "%"
+    as "%%" and relies on the DBAPI to unescape it while interpolating the parameters.
+    copy_expert does not interpolate, so the statement is interpolated here
+    (without parameters).
+    """
+    query = str(stmt.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+
+    if dialect.paramstyle == "pyformat":
+        query = query % {}
+    elif dialect.paramstyle == "format":
+        query = query % ()
+
+    return "COPY ({}) TO STDOUT WITH (FORMAT binary)".format(query)
+
+
+def copy_to_binary(connection, stmt):
+    """
+    Run a SELECT statement with ``COPY (...) TO STDOUT (FORMAT binary)``.
+
+    Returns:
+        bytes
+    """
+    query = render_copy_query(connection.dialect, stmt)
+
+    buffer = io.BytesIO()
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(query, buffer)
+    finally:
+        cursor.close()
+
+    return buffer.getvalue()
+
+
+def parse_copy_binary(data, n_fields):
+    """
+    Split the output of a binary COPY into columns.
+
+    Returns:
+        List of n_fields columns (lists of bytes or None).
+    """
+    if not data.startswith(BINARY_COPY_SIGNATURE):
+        raise ValueError("Invalid COPY signature")
+
+    (extension_length,) = _int32.unpack_from(data, len(BINARY_COPY_SIGNATURE) + 4)
+    offset = len(BINARY_COPY_SIGNATURE) + 8 + extension_length
+
+    columns = [[] for _ in range(n_fields)]
+
+    while True:
+        (n,) = _int16.unpack_from(data, offset)
+        offset += 2
+
+        # Trailer
+        if n == -1:
+            break
+
+        if n != n_fields:
+            raise ValueError(f"Expected {n_fields} fields, got {n}")
+
+        for column in columns:
+            (length,) = _int32.unpack_from(data, offset)
+            offset += 4
+
+            if length < 0:
+                column.append(None)
+            else:
+                column.append(data[offset : offset + length])
+                offset += length
+
+    return columns
+
+
+def _decode_binary_column(type_, values):
+    if isinstance(type_, String):
+        return [None if v is None else v.decode("utf-8") for v in values]
+
+    return [
+        None if v is None else int.from_bytes(v, "big", signed=True) for v in values
+    ]
+
+
+def fetch_points(connection, stmt, binary=None):
+    """
+    Execute a SELECT statement whose last column is a vector and decode all vectors at once.
+
+    The other columns may be strings or integers.
+
+    Parameters:
+        connection: SQLAlchemy connection.
+        stmt: SELECT statement.
+        binary: Use binary COPY (default: if supported by the database).
+
+    Returns:
+        (columns, vectors): List of the other columns (lists of values)
+            and an array of shape [n_rows, n_features].
+
+    Raises:
+        ValueError if a vector is NULL.
+    """
+    *other, vector = stmt.selected_columns
+
+    if isinstance(vector.type, Point):
+        decode_binary = decode_points_binary
+    elif isinstance(vector.type, Float4Array):
+        decode_binary = decode_float4_arrays_binary
+    else:
+        raise TypeError(f"The last column must be a vector, got {vector.type!r}")
+
+    if binary is None:
+        binary = all(isinstance(c.type, (String, Integer)) for c in other) and (
+            isinstance(vector.type, Float4Array) or binary_points_supported(connection)
+        )
+
+    if binary:
+        *columns, vectors = parse_copy_binary(
+            copy_to_binary(connection, stmt), len(other) + 1
+        )
+
+        n_none = sum(1 for v in vectors if v is None)
+        if n_none:
+            raise ValueError(
+                f"vectors contain {n_none} None entries (out of {len(vectors)})"
+            )
+
+        columns = [_decode_binary_column(c.type, v) for c, v in zip(other, columns)]
+
+        return columns, decode_binary(vectors)
+
+    stmt = stmt.with_only_columns(*other, as_text(vector))
+    rows = connection.execute(stmt).fetchall()
+
+    columns = [[r[i] for r in rows] for i in range(len(other))]
+    vectors = parse_points([r[-1] for r in rows])
+
+    if isinstance(vector.type, Float4Array):
+        # float4 is printed with the shortest representation that identifies the value,
+        # so rounding to float32 yields the stored values (like the binary representation)
+        vectors = vectors.astype("float32").astype(float)
+
+    return columns, vectors
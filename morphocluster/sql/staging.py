@@ -0,0 +1,270 @@
+"""
+Bulk transfer of client-side rows into temporary staging tables using COPY.
+
+Staging tables are dropped at the end of the transaction,
+so they have to be used inside of a transaction.
+"""
+
+import csv
+import io
+import itertools
+import struct
+
+from sqlalchemy import MetaData, Table
+from sqlalchemy.dialects.postgresql import REAL
+
+from morphocluster.sql.types import encode_arrays_binary
+
+#: Rows that are serialized at once
+COPY_CHUNK_SIZE = 10000
+
+#: Header of the binary COPY format
+BINARY_COPY_SIGNATURE = b"PGCOPY\n\377\r\n\0"
+
+_int16 = struct.Struct(">h")
+_int32 = struct.Struct(">i")
+
+_counter = itertools.count()
+
+
+class _CSVFile(io.TextIOBase):
+    """
+    Read-only file that serializes rows to CSV on demand.
+
+    This allows to COPY arbitrarily many rows without materializing them.
+    """
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = ""
+
+    def readable(self):
+        return True
+
+    def _fill(self, size):
+        while size < 0 or len(self._buffer) < size:
+            chunk = list(itertools.islice(self._rows, COPY_CHUNK_SIZE))
+            if not chunk:
+                break
+
+            out = io.StringIO()
+            csv.writer(out, lineterminator="\n").writerows(chunk)
+            self._buffer += out.getvalue()
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+
+        self._fill(size)
+
+        if size < 0:
+            result, self._buffer = self._buffer, ""
+        else:
+            result, self._buffer = self._buffer[:size], self._buffer[size:]
+
+        return result
+
+    def readline(self, size=-1):
+        self._fill(COPY_CHUNK_SIZE)
+
+        end = self._buffer.find("\n") + 1 or len(self._buffer)
+        result, self._buffer = self._buffer[:end], self._buffer[end:]
+
+        return result
+
+
+class _BinaryFile(io.RawIOBase):
+    """
+    Read-only file that concatenates chunks of bytes on demand.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+
+        if size < 0:
+            result, self._buffer = self._buffer, b""
+        else:
+            result, self._buffer = self._buffer[:size], self._buffer[size:]
+
+        return result
+
+
+def _encode_vector_rows(texts, vectors, dtype):
+    """
+    Serialize rows of text columns and a vector column in the binary COPY format.
+    """
+    n_fields = _int16.pack(len(texts) + 1)
+
+    yield BINARY_COPY_SIGNATURE + _int32.pack(0) + _int32.pack(0)
+
+    for start in range(0, len(vectors), COPY_CHUNK_SIZE):
+        stop = min(start + COPY_CHUNK_SIZE, len(vectors))
+
+        encoded = encode_arrays_binary(vectors[start:stop], dtype)
+        size = encoded.dtype.itemsize
+        vector_length = _int32.pack(size)
+        buffer = encoded.tobytes()
+
+        parts = []
+        for i in range(stop - start):
+            parts.append(n_fields)
+            for column in texts:
+                value = column[start + i]
+                if value is None:
+                    parts.append(_int32.pack(-1))
+                else:
+                    value = str(value).encode("utf-8")
+                    parts.append(_int32.pack(len(value)))
+                    parts.append(value)
+            parts.append(vector_length)
+            parts.append(buffer[i * size : (i + 1) * size])
+
+        yield b"".join(parts)
+
+    yield _int16.pack(-1)
+
+
+def copy_rows(connection, table, rows, columns=None):
+    """
+    COPY rows into a table.
+
+    Parameters:
+        connection: SQLAlchemy connection.
+        table: sqlalchemy Table.
+        rows: Iterable of tuples. None (and the empty string) is transferred as NULL.
+        columns: Names of the columns in the rows (default: all columns of table).
+
+    Returns:
+        Number of copied rows.
+    """
+    if columns is None:
+        columns = [c.name for c in table.columns]
+
+    stmt = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(
+        connection.dialect.identifier_preparer.format_table(table),
+        ", ".join(connection.dialect.identifier_preparer.quote(c) for c in columns),
+    )
+
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(stmt, _CSVFile(rows))
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+def copy_vectors(connection, table, texts, vectors, columns=None):
+    """
+    COPY rows with a vector into a table using the binary format.
+
+    The vectors are transferred as float4[] or float8[] without being formatted as text.
+
+    Parameters:
+        connection: SQLAlchemy connection.
+        table: sqlalchemy Table. The last column must be ARRAY(REAL) or ARRAY(DOUBLE_PRECISION).
+        texts: Sequences of values (converted with str, None is transferred as NULL)
+            for the preceding columns.
+        vectors: Array of shape [n_rows, n_features].
+        columns: Names of the columns (default: all columns of table).
+
+    Returns:
+        Number of copied rows.
+    """
+    if columns is None:
+        columns = [c.name for c in table.columns]
+
+    item_type = table.columns[columns[-1]].type.item_type
+    dtype = "f4" if isinstance(item_type, REAL) else "f8"
+
+    stmt = "COPY {} ({}) FROM STDIN WITH (FORMAT binary)".format(
+        connection.dialect.identifier_preparer.format_table(table),
+        ", ".join(connection.dialect.identifier_preparer.quote(c) for c in columns),
+    )
+
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(
+            stmt, _BinaryFile(_encode_vector_rows(texts, vectors, dtype))
+        )
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+def create_staging_table(connection, name, *columns):
+    """
+    Create a temporary table that is dropped at the end of the transaction.
+
+    Parameters:
+        connection: SQLAlchemy connection (inside of a transaction).
+        name: Prefix of the table name.
+        *columns: sqlalchemy Column objects.
+
+    Returns:
+        sqlalchemy Table
+    """
+    table = Table(
+        "{}_{:d}".format(name, next(_counter)),
+        MetaData(),
+        *columns,
+        prefixes=["TEMPORARY"],
+        postgresql_on_commit="DROP",
+    )
+    table.create(connection)
+
+    return table
+
+
+def stage_rows(connection, name, columns, rows, analyze=True):
+    """
+    Create a staging table and COPY rows into it.
+
+    Parameters:
+        connection: SQLAlchemy connection (inside of a transaction).
+        name: Prefix of the table name.
+        columns: List of sqlalchemy Column objects.
+        rows: Iterable of tuples.
+        analyze: Collect statistics so that the planner knows the size of the table.
+
+    Returns:
+        sqlalchemy Table
+    """
+    table = create_staging_table(connection, name, *columns)
+
+    copy_rows(connection, table, rows)
+
+    if analyze:
+        connection.exec_driver_sql("ANALYZE {}".format(table.name))
+
+    return table
+
+
+def stage_vectors(connection, name, columns, texts, vectors, analyze=True):
+    """
+    Create a staging table and COPY rows with a vector into it (see copy_vectors).
+
+    Returns:
+        sqlalchemy Table
+    """
+    table = create_staging_table(connection, name, *columns)
+
+    copy_vectors(connection, table, texts, vectors)
+
+    if analyze:
+        connection.exec_driver_sql("ANALYZE {}".format(table.name))
+
+    return table
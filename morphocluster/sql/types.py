@@ -1,4 +1,176 @@
-from sqlalchemy.types import TypeEngine, UserDefinedType, Float
+from sqlalchemy.dialects.postgresql import ARRAY, REAL
+from sqlalchemy.sql.expression import func, literal, select
+from sqlalchemy.types import (
+    Float,
+    LargeBinary,
+    TypeDecorator,
+    TypeEngine,
+    UserDefinedType,
+)
+
+#: Flag in the header of the binary representation of a zero-volume cube
+CUBE_POINT_BIT = 0x80000000
+
+#: Element types (OIDs) of float4[] and float8[] in the binary representation of arrays
+FLOAT4_OID = 700
+FLOAT8_OID = 701
+
+_PARENTHESES = str.maketrans("", "", "(){}")
+
+
+def format_point(value):
+    """
+    Format a sequence of numbers as the text representation of a point.
+    """
+    if getattr(value, "dtype", None) == "float64":
+        # Python floats are formatted much faster than numpy float64 scalars
+        value = value.tolist()
+
+    return "(" + ",".join(map(str, value)) + ")"
+
+
+def parse_points(values, n_features=None):
+    """
+    Decode the text representations of many points (or float4[] arrays) at once.
+
+    All values are parsed by one call to numpy instead of one call per value.
+
+    Parameters:
+        values: Sequence of str (or bytes) like "(1, 2, 3)" or "{1,2,3}".
+        n_features: Dimensionality of the points (only used if values is empty).
+
+    Returns:
+        Contiguous array of shape [len(values), n_features].
+    """
+    import numpy as np
+
+    n_none = sum(1 for v in values if v is None)
+    if n_none:
+        raise ValueError(
+            f"vectors contain {n_none} None entries (out of {len(values)})"
+        )
+
+    if not len(values):
+        return np.empty((0, n_features or 0))
+
+    values = [bytes(v).decode("ascii") if not isinstance(v, str) else v for v in values]
+
+    if values[0].count("(") > 1:
+        raise ValueError(f"Not a point: {values[0]}")
+
+    n_features = values[0].count(",") + 1
+
+    result = np.fromstring(",".join(values).translate(_PARENTHESES), sep=",")
+
+    if result.size != len(values) * n_features:
+        raise ValueError("Points have different dimensionality")
+
+    return result.reshape((len(values), n_features))
+
+
+def decode_points_binary(values):
+    """
+    Decode the binary representations (cube_send) of many points at once.
+
+    The binary representation of a zero-volume cube is a big-endian uint32 header
+    (dimensionality | CUBE_POINT_BIT) followed by the big-endian float8 coordinates.
+
+    Parameters:
+        values: Sequence of bytes.
+
+    Returns:
+        Contiguous array of shape [len(values), n_features].
+    """
+    import numpy as np
+
+    if not len(values):
+        return np.empty((0, 0))
+
+    n_features = (len(values[0]) - 4) // 8
+    dtype = np.dtype([("header", ">u4"), ("x", ">f8", (n_features,))])
+
+    if any(len(v) != dtype.itemsize for v in values):
+        raise ValueError("Points have different dimensionality")
+
+    decoded = np.frombuffer(b"".join(values), dtype=dtype)
+
+    if np.any(decoded["header"] != (CUBE_POINT_BIT | n_features)):
+        raise ValueError("Not a point")
+
+    return decoded["x"].astype(float)
+
+
+def decode_float4_arrays_binary(values):
+    """
+    Decode the binary representations (array_send) of many float4[] arrays at once.
+
+    The binary representation of a one-dimensional array without NULLs is a header
+    (ndim, flags, element OID, length, lower bound; big-endian int32)
+    followed by the length (int32) and the value (float4) of every element.
+
+    Parameters:
+        values: Sequence of bytes.
+
+    Returns:
+        Contiguous array of shape [len(values), n_features].
+    """
+    import numpy as np
+
+    if not len(values):
+        return np.empty((0, 0))
+
+    n_features = (len(values[0]) - 20) // 8
+    dtype = np.dtype(
+        [
+            ("header", ">i4", (5,)),
+            ("x", [("length", ">i4"), ("value", ">f4")], (n_features,)),
+        ]
+    )
+
+    if any(len(v) != dtype.itemsize for v in values):
+        raise ValueError("Arrays have different dimensionality")
+
+    decoded = np.frombuffer(b"".join(values), dtype=dtype)
+
+    if np.any(decoded["header"] != (1, 0, FLOAT4_OID, n_features, 1)) or np.any(
+        decoded["x"]["length"] != 4
+    ):
+        raise ValueError("Not a one-dimensional float4[] array without NULLs")
+
+    return decoded["x"]["value"].astype(float)
+
+
+def encode_arrays_binary(vectors, dtype="f4"):
+    """
+    Encode the rows of a matrix in the binary representation of float4[] or float8[] arrays.
+
+    This is the input of array_recv, e.g. for COPY ... (FORMAT binary).
+
+    Parameters:
+        vectors: Array of shape [n_rows, n_features].
+        dtype: "f4" (float4[]) or "f8" (float8[]).
+
+    Returns:
+        Structured array with one (fixed-size) item per row.
+    """
+    import numpy as np
+
+    vectors = np.asarray(vectors)
+    n_rows, n_features = vectors.shape
+    oid = {"f4": FLOAT4_OID, "f8": FLOAT8_OID}[dtype]
+
+    encoded = np.empty(
+        n_rows,
+        dtype=[
+            ("header", ">i4", (5,)),
+            ("x", [("length", ">i4"), ("value", ">" + dtype)], (n_features,)),
+        ],
+    )
+    encoded["header"] = (1, 0, oid, n_features, 1)
+    encoded["x"]["length"] = np.dtype(dtype).itemsize
+    encoded["x"]["value"] = vectors
+
+    return encoded
 
 
 class Point(UserDefinedType):
@@ -24,24 +196,20 @@ class Point(UserDefinedType):
             if value is None:
                 return None
 
-            return "(" + ",".join(str(v) for v in value) + ")"
+            return format_point(value)
 
         return process
 
     def result_processor(self, dialect, coltype):
 
         if self.numpy:
-            import numpy as np
 
             def process_numpy(value):
                 # NULL
                 if value is None:
                     return value
 
-                if isinstance(value, memoryview):
-                    value = value.tobytes()
-
-                return np.fromstring(value[1:-1], sep=",")
+                return parse_points([value])[0]
 
             return process_numpy
 
@@ -68,3 +236,117 @@ class Point(UserDefinedType):
 
     # Statements using this type are safe to cache.
     cache_ok = True
+
+
+class Float4Array(TypeDecorator):
+    """
+    Represent a point as a float4[] array.
+
+    Unlike Point, the dimensionality is not limited.
+    Distances are calculated inside the database as well, but without index support.
+    """
+
+    impl = ARRAY(REAL, dimensions=1)
+
+    cache_ok = True
+
+    def __init__(self, numpy=False) -> None:
+        self.numpy = numpy
+
+        super().__init__()
+
+    def process_bind_param(self, value, dialect):
+        import numpy as np
+
+        if value is None:
+            return None
+
+        return np.asarray(value, dtype=np.float32).tolist()
+
+    def process_result_value(self, value, dialect):
+        import numpy as np
+
+        if value is None:
+            return None
+
+        if self.numpy:
+            # Values are parsed from their shortest representation: Round to the stored float4
+            return np.array(value, dtype=np.float32).astype(float)
+
+        return tuple(value)
+
+    class comparator_factory(TypeDecorator.Comparator):
+        def dist_euclidean(self, other):
+            # Pair the elements of both arrays and sum the squared differences
+            pairs = (
+                func.unnest(self.expr, literal(other, self.type))
+                .table_valued("a", "b")
+                .render_derived()
+            )
+            return func.sqrt(
+                select(func.sum(func.power(pairs.c.a - pairs.c.b, 2)))
+                .select_from(pairs)
+                .scalar_subquery(),
+                type_=Float,
+            )
+
+
+class NumpyArray(TypeDecorator):
+    """
+    Store a one-dimensional numpy array as raw bytes.
+
+    Values are decoded without copying (np.frombuffer), so the resulting arrays are read-only.
+    """
+
+    impl = LargeBinary
+
+    cache_ok = True
+
+    def __init__(self, dtype="<f4") -> None:
+        import numpy as np
+
+        self.dtype = np.dtype(dtype)
+
+        super().__init__()
+
+    def process_bind_param(self, value, dialect):
+        import numpy as np
+
+        if value is None:
+            return None
+
+        return np.ascontiguousarray(value, dtype=self.dtype).tobytes()
+
+    def process_result_value(self, value, dialect):
+        import numpy as np
+
+        if value is None:
+            return None
+
+        return np.frombuffer(value, dtype=self.dtype)
+
+
+class PrototypesType(TypeDecorator):
+    """
+    Store a fitted Prototypes object in the compact binary representation of Prototypes.to_bytes.
+
+    Unfitted Prototypes are stored as NULL.
+    """
+
+    impl = LargeBinary
+
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not hasattr(value, "prototypes_"):
+            return None
+
+        return value.to_bytes()
+
+    def process_result_value(self, value, dialect):
+        from morphocluster.processing.prototypes import Prototypes
+
+        if value is None:
+            return None
+
+        return Prototypes.from_bytes(value)
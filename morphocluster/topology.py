@@ -0,0 +1,260 @@
+"""
+In-memory topology (shape) of a project tree.
+
+The topology of a project is cached per process and rebuilt when the
+version of the project (``projects.version``) changes.
+Every method of Tree that changes the shape or the flags of a tree bumps this version.
+"""
+
+import threading
+
+import numpy as np
+import pandas as pd
+from sqlalchemy.sql.expression import select
+
+from morphocluster.models import nodes, projects
+
+
+class Topology:
+    """
+    Immutable snapshot of the shape of a project tree.
+
+    Nodes are addressed by their index into the sorted array `node_ids`.
+
+    Attributes:
+        node_ids: Sorted node IDs.
+        parent: Index of the parent of each node (-1 for the root).
+        offsets, children: Children in compressed sparse row format:
+            The children of node i are children[offsets[i]:offsets[i + 1]].
+        n_children: Number of children of each node.
+        depth: Depth of each node (0 for the root).
+        approved, starred, filled, preferred: Flags of each node.
+    """
+
+    def __init__(
+        self,
+        project_id,
+        version,
+        node_ids,
+        parent_ids,
+        approved,
+        starred,
+        filled,
+        preferred,
+    ):
+        self.project_id = project_id
+        self.version = version
+
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        order = np.argsort(node_ids)
+        self.node_ids = node_ids[order]
+        n_nodes = len(self.node_ids)
+
+        # Parent IDs (-1 for roots) to parent indices
+        parent_ids = np.asarray(parent_ids, dtype=np.int64)[order]
+        has_parent = parent_ids >= 0
+        self.parent = np.full(n_nodes, -1, dtype=np.int64)
+        self.parent[has_parent] = np.searchsorted(self.node_ids, parent_ids[has_parent])
+
+        # Children (CSR)
+        self.n_children = np.bincount(self.parent[has_parent], minlength=n_nodes)
+        self.offsets = np.zeros(n_nodes + 1, dtype=np.int64)
+        np.cumsum(self.n_children, out=self.offsets[1:])
+        by_parent = np.argsort(self.parent, kind="stable")
+        n_roots = n_nodes - np.count_nonzero(has_parent)
+        self.children = by_parent[n_roots:]
+
+        # Depth (level by level, starting at the roots)
+        self.depth = np.zeros(n_nodes, dtype=np.int64)
+        frontier = by_parent[:n_roots]
+        level = 0
+        while frontier.size:
+            self.depth[frontier] = level
+            frontier = self.children_of(frontier)
+            level += 1
+
+        self.approved = np.asarray(approved, dtype=bool)[order]
+        self.starred = np.asarray(starred, dtype=bool)[order]
+        self.filled = np.asarray(filled, dtype=bool)[order]
+        self.preferred = np.asarray(preferred, dtype=bool)[order]
+
+    @classmethod
+    def load(cls, connection, project_id, version):
+        """
+        Load the topology of a project from the database.
+        """
+        stmt = select(
+            nodes.c.node_id,
+            nodes.c.parent_id,
+            nodes.c.approved,
+            nodes.c.starred,
+            nodes.c.filled,
+            nodes.c.preferred,
+        ).where(nodes.c.project_id == project_id)
+
+        frame = pd.read_sql_query(stmt, connection)
+
+        return cls(
+            project_id,
+            version,
+            frame["node_id"].to_numpy(),
+            frame["parent_id"].fillna(-1).to_numpy(),
+            frame["approved"].to_numpy(),
+            frame["starred"].to_numpy(),
+            frame["filled"].to_numpy(),
+            frame["preferred"].to_numpy(),
+        )
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def __contains__(self, node_id):
+        i = np.searchsorted(self.node_ids, node_id)
+        return i < len(self.node_ids) and self.node_ids[i] == node_id
+
+    def index(self, node_id):
+        """
+        Get the index of a node.
+
+        Raises:
+            KeyError if the node is not part of the topology.
+        """
+        i = np.searchsorted(self.node_ids, node_id)
+        if i >= len(self.node_ids) or self.node_ids[i] != node_id:
+            raise KeyError(node_id)
+        return int(i)
+
+    def children_of(self, idx):
+        """
+        Get the indices of all children of the nodes with the indices idx.
+        """
+        starts = self.offsets[idx]
+        lengths = self.offsets[np.asarray(idx) + 1] - starts
+
+        # Concatenate the ranges [start, start + length) without a Python loop
+        total = lengths.sum()
+        if total == 0:
+            return np.empty(0, dtype=np.int64)
+        ends = np.cumsum(lengths)
+        positions = np.arange(total) + np.repeat(starts - (ends - lengths), lengths)
+        return self.children[positions]
+
+    def get_path_ids(self, node_id):
+        """
+        Get the path of the node.
+
+        Returns:
+            List of `node_id`s from the root to the node.
+        """
+        i = self.index(node_id)
+        path = []
+        while i >= 0:
+            path.append(int(self.node_ids[i]))
+            i = self.parent[i]
+        return path[::-1]
+
+    def get_children_ids(self, node_id):
+        i = self.index(node_id)
+        return self.node_ids[
+            self.children[self.offsets[i] : self.offsets[i + 1]]
+        ].tolist()
+
+    def subtree(self, node_id, descend=None):
+        """
+        Get the subtree rooted at node_id.
+
+        Parameters:
+            descend: Optional boolean mask.
+                A descendant is only included if the mask is true for itself and
+                all nodes between it and node_id.
+
+        Returns:
+            Indices of the nodes in the subtree (in breadth-first order).
+        """
+        frontier = np.array([self.index(node_id)], dtype=np.int64)
+        result = []
+        while frontier.size:
+            result.append(frontier)
+            frontier = self.children_of(frontier)
+            if descend is not None:
+                frontier = frontier[descend[frontier]]
+        return np.concatenate(result)
+
+    def superparents(self, node_id):
+        """
+        Get the superparent of the nodes below node_id.
+
+        Like the recursive walk that this replaces, the nodes are connected to node_id
+        by descending only through nodes that are not starred.
+        Nodes below a starred node (and all nodes, if node_id itself is starred)
+        are not connected and keep their previous superparent.
+
+        Returns:
+            (idx, superparent_idx): Indices of the connected descendants of node_id
+            and of their superparents.
+        """
+        root = self.index(node_id)
+
+        result_idx = []
+
+        frontier = np.array([root], dtype=np.int64)
+        frontier = frontier[~self.starred[frontier]]
+        while frontier.size:
+            children = self.children_of(frontier)
+            result_idx.append(children)
+            frontier = children[~self.starred[children]]
+
+        idx = np.concatenate(result_idx) if result_idx else np.empty(0, dtype=np.int64)
+
+        return idx, np.full(len(idx), root, dtype=np.int64)
+
+    def get_tip(self, node_id):
+        """
+        Get the id of the tip (descendant with maximum depth) below a node.
+
+        See Tree.get_tip.
+        """
+        subtree = self.subtree(node_id, ~self.approved & ~self.starred)
+        subtree = subtree[self.n_children[subtree] > 0]
+
+        if not subtree.size:
+            return None
+
+        return int(self.node_ids[subtree[np.argmax(self.depth[subtree])]])
+
+
+#: Topologies by project_id (shared by all connections of this process)
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def get_topology(connection, project_id, version=None):
+    """
+    Get the topology of a project, reloading it if the project version changed.
+
+    The loaded topology is shared with other connections, so the version
+    must not have been changed in the current, uncommitted transaction
+    (see Tree.get_topology).
+
+    Parameters:
+        version: Current version of the project, if already known.
+    """
+    if version is None:
+        stmt = select(projects.c.version).where(projects.c.project_id == project_id)
+        version = connection.execute(stmt).scalar()
+
+        if version is None:
+            raise KeyError(project_id)
+
+    with _cache_lock:
+        topology = _cache.get(project_id)
+
+    if topology is not None and topology.version == version:
+        return topology
+
+    topology = Topology.load(connection, project_id, version)
+
+    with _cache_lock:
+        _cache[project_id] = topology
+
+    return topology
@@ -4,29 +4,44 @@ Created on 13.03.2018
 @author: mschroeder
 """
 
+import csv
+import heapq
 import itertools
+import json
+import logging
+import multiprocessing
 import os
+import time
 import warnings
+from concurrent.futures import ProcessPoolExecutor
 from numbers import Integral
+from operator import itemgetter
 from typing import Iterable, Mapping
+from zipfile import ZIP_DEFLATED, ZipFile
 
 import numpy as np
 import pandas as pd
 from genericpath import commonprefix
 from sklearn.cluster import KMeans
+from sqlalchemy import Column, String, create_engine
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import NullPool
 from sqlalchemy.sql import text
 from sqlalchemy.sql.elements import literal_column
-from sqlalchemy.sql.expression import bindparam, literal, select
+from sqlalchemy.sql.expression import any_, bindparam, literal, select
 from sqlalchemy.sql.functions import coalesce, func
+from sqlalchemy.types import BigInteger
 from timer_cm import Timer
 from tqdm import tqdm
 
 from morphocluster import processing
 from morphocluster.classifier import Classifier
 from morphocluster.extensions import database
+from morphocluster.feature_store import get_feature_store
 from morphocluster.helpers import seq2array
 from morphocluster.processing.prototypes import Prototypes, merge_prototypes
+from morphocluster.processing.tree import open_text_member
 from morphocluster.member import MemberCollection
 from morphocluster.models import (
     nodes,
@@ -35,10 +50,38 @@ from morphocluster.models import (
     objects,
     projects,
 )
+from morphocluster.sql.points import as_text, fetch_points
+from morphocluster.sql.staging import copy_rows, stage_rows
+from morphocluster.sql.types import parse_points
+from morphocluster.topology import Topology, get_topology
+from morphocluster.vector_index import get_vector_index
+
+logger = logging.getLogger(__name__)
 
 # TODO: Make N_PROTOTYPES configurable
 N_PROTOTYPES = 16
 
+#: Number of objects sampled per node during consolidation
+CONSOLIDATE_SAMPLE_SIZE = 1000
+
+#: Maximum number of sampled objects that are processed at once during consolidation
+CONSOLIDATE_BATCH_SIZE = 100000
+
+#: Number of object vectors that are fetched at once to expand the radii of prototypes
+CONSOLIDATE_RADII_CHUNK_SIZE = 10000
+
+#: Number of rows that are fetched and written at once during export
+EXPORT_CHUNK_SIZE = 10000
+
+#: Minimum number of candidates for which Tree.recommend_objects uses the vector index
+RECOMMEND_ANN_MIN_CANDIDATES = 10000
+
+#: Factor by which more neighbours than expected are retrieved from the vector index
+RECOMMEND_ANN_OVERSAMPLING = 2
+
+#: Columns that are part of the cached topology (see morphocluster.topology)
+TOPOLOGY_COLUMNS = {"parent_id", "approved", "starred", "filled", "preferred"}
+
 
 class TreeError(Exception):
     """
@@ -94,6 +137,27 @@ def _paths_to_node_order(paths):
     return result
 
 
+def _path_depth(node_id):
+    """
+    Constructs a scalar subquery for the depth of node_id (the length of its path).
+    """
+    root = nodes.alias("root")
+    return (
+        select(func.cardinality(root.c.path_ids))
+        .where(root.c.node_id == node_id)
+        .scalar_subquery()
+    )
+
+
+def _has_ancestor(table, node_id):
+    """
+    Constructs a clause that is true for node_id and all its descendants.
+
+    This is answered using the GIN index on `path_ids`.
+    """
+    return table.c.path_ids.contains([node_id])
+
+
 def _rquery_preds(node_id):
     """
     Constructs a selectable of predecessor of node_id with all columns of `nodes` and an additional
@@ -101,24 +165,21 @@ def _rquery_preds(node_id):
 
     `level` is 0 for the supplied `node_id` and decreases for each predecessor.
     """
-    # Start with the last child
-    query = (
-        select([nodes, literal(0).label("level")])
-        .where(nodes.c.node_id == node_id)
-        .cte(recursive=True)
-        .alias("q")
-    )
-
+    node = nodes.alias("node")
     preds = nodes.alias("p")
 
-    query = query.union_all(
-        select([preds, literal_column("level") - 1]).where(
-            query.c.parent_id == preds.c.node_id
+    return (
+        select(
+            preds,
+            (
+                func.array_position(node.c.path_ids, preds.c.node_id)
+                - func.cardinality(node.c.path_ids)
+            ).label("level"),
         )
+        .where((node.c.node_id == node_id) & (preds.c.node_id == any_(node.c.path_ids)))
+        .cte("q")
     )
 
-    return query
-
 
 def _rquery_subtree(node_id, recurse_cb=None):
     """
@@ -131,25 +192,38 @@ def _rquery_subtree(node_id, recurse_cb=None):
     Parameters:
         recurse_cb: A callback with two parameters (q, s). q is the recursive query, s is the successor.
             The callback must return a clause that can be used in where().
+            The subtree is then walked recursively and the walk stops where the clause is false.
     """
-    q = (
-        select(nodes, literal(0).label("level"))
-        .where(nodes.c.node_id == node_id)
-        .cte(recursive=True)
-        .alias("q")
-    )
 
-    s = nodes.alias("s")
+    if callable(recurse_cb):
+        q = (
+            select(nodes, literal(0).label("level"))
+            .where(nodes.c.node_id == node_id)
+            .cte(recursive=True)
+            .alias("q")
+        )
 
-    rq = select(s, literal_column("level") + 1).where(s.c.parent_id == q.c.node_id)
+        s = nodes.alias("s")
 
-    if callable(recurse_cb):
-        condition = recurse_cb(q, s)
-        rq = rq.where(condition)
+        rq = select(s, literal_column("level") + 1).where(
+            (s.c.parent_id == q.c.node_id) & recurse_cb(q, s)
+        )
+
+        return q.union_all(rq)
+
+    # Without a callback, the subtree is a single index scan on the materialized path
+    root_depth = _path_depth(node_id)
+    s = nodes.alias("s")
+
+    return (
+        select(s, (func.cardinality(s.c.path_ids) - root_depth).label("level"))
+        .where(_has_ancestor(s, node_id))
+        .cte("q")
+    )
 
-    q = q.union_all(rq)
 
-    return q
+def _limit(max_n, limit):
+    return max_n if limit is None else min(max_n, limit)
 
 
 def _compute_flags(mapping: Mapping, names: Iterable[str]):
@@ -158,17 +232,378 @@ def _compute_flags(mapping: Mapping, names: Iterable[str]):
     }
 
 
+def _aggregate_progress(subtree: pd.DataFrame):
+    """
+    Aggregate progress statistics bottom-up (in place).
+
+    n_approved_objects and n_named_objects of a node become the maximum of its own
+    value and the sum of its children, n_approved_nodes, n_filled_nodes and n_nodes
+    are summed up.
+
+    Parameters:
+        subtree: DataFrame indexed by node_id with columns parent_id, level
+            and the statistics.
+    """
+
+    parent_ids = subtree["parent_id"].fillna(-1).astype(np.int64)
+    parent_idx = subtree.index.get_indexer(parent_ids)
+    level = subtree["level"].to_numpy()
+
+    max_fields = ["n_approved_objects", "n_named_objects"]
+    sum_fields = ["n_approved_nodes", "n_filled_nodes", "n_nodes"]
+
+    values = {f: subtree[f].to_numpy(copy=True) for f in max_fields + sum_fields}
+    children_sums = {f: np.zeros_like(v) for f, v in values.items()}
+
+    # Process one level after the other, starting with the deepest
+    for lvl in np.unique(level)[::-1]:
+        rows = np.flatnonzero(level == lvl)
+
+        # The children of these rows are complete
+        for f in max_fields:
+            values[f][rows] = np.maximum(values[f][rows], children_sums[f][rows])
+        for f in sum_fields:
+            values[f][rows] += children_sums[f][rows]
+
+        # Propagate to parents
+        rows = rows[parent_idx[rows] >= 0]
+        for f, v in values.items():
+            np.add.at(children_sums[f], parent_idx[rows], v[rows])
+
+    for f, v in values.items():
+        subtree[f] = v
+
+
+def _neg(vector):
+    return -vector if vector is not None else None
+
+
+def _add_delta(
+    deltas, node_id, n_objects=0, n_children=0, n_objects_deep=0, vector_sum=None
+):
+    """
+    Accumulate changes of the additive cached values of a node.
+
+    deltas[node_id] is [_n_objects, _n_children, _n_objects_deep, _vector_sum].
+    """
+    delta = deltas.setdefault(node_id, [0, 0, 0, None])
+    delta[0] += n_objects
+    delta[1] += n_children
+    delta[2] += n_objects_deep
+    if vector_sum is not None:
+        delta[3] = vector_sum if delta[3] is None else delta[3] + vector_sum
+
+
+def _fit_object_prototypes(node_id, vectors):
+    """
+    Fit prototypes to the (sampled) object vectors of a node.
+
+    The clusterer is seeded with the node_id so that the result does not depend
+    on the process (or the order) in which the nodes are consolidated.
+    """
+    if len(vectors) == 0:
+        return None
+
+    clusterer = KMeans(N_PROTOTYPES, n_init=2, random_state=node_id % 2**32)
+    prots = Prototypes(clusterer)
+    prots.fit(vectors)
+    return prots
+
+
+def _sample_and_fit(connection, node_ids, feature_store=None):
+    """
+    Sample the objects of each node and fit their prototypes.
+
+    This is the part of the consolidation of a node that does not depend on its children.
+
+    Returns:
+        List of (node_id, objects_, prototypes, vector_sum) tuples.
+        vector_sum is the exact sum of the vectors of all objects of the node
+        (None if the node has no objects).
+    """
+    tree = Tree(connection, feature_store)
+
+    # Sample objects to speed up the calculation
+    samples = tree.sample_objects(node_ids, CONSOLIDATE_SAMPLE_SIZE)
+
+    result = []
+    for node_id in node_ids:
+        object_ids, vectors = samples[node_id]
+        objects_ = MemberCollection(
+            [{"object_id": object_id} for object_id in object_ids],
+            "raise",
+            vectors=vectors,
+        )
+        prots = _fit_object_prototypes(node_id, vectors)
+
+        if len(vectors) == 0:
+            vector_sum = None
+        elif len(vectors) < CONSOLIDATE_SAMPLE_SIZE:
+            # The sample contains all objects
+            vector_sum = np.sum(vectors, axis=0, dtype=float)
+        else:
+            # The radii have to cover all objects of the node, not only the sample.
+            # The vector sum is accumulated in the same pass, because relocations
+            # update it incrementally with the exact vectors.
+            vector_sum = np.zeros(vectors.shape[1])
+            for _, chunk in tree.iter_object_vectors(
+                node_id, CONSOLIDATE_RADII_CHUNK_SIZE
+            ):
+                prots.expand_radii(chunk)
+                vector_sum += np.sum(chunk, axis=0, dtype=float)
+
+        result.append((node_id, objects_, prots, vector_sum))
+
+    return result
+
+
+def _batches(items, sizes, max_size):
+    """
+    Split items into consecutive batches so that the sum of sizes per batch
+    does not exceed max_size (unless a single item is bigger).
+    """
+    batch = []
+    batch_size = 0
+    for item, size in zip(items, sizes):
+        if batch and batch_size + size > max_size:
+            yield batch
+            batch = []
+            batch_size = 0
+
+        batch.append(item)
+        batch_size += size
+
+    if batch:
+        yield batch
+
+
+#: Engine and feature store path of a consolidation worker process
+_worker_engine = None
+_worker_feature_store_path = None
+
+
+def _init_consolidation_worker(database_url, feature_store_path=None):
+    global _worker_engine, _worker_feature_store_path
+    _worker_engine = create_engine(database_url, poolclass=NullPool)
+    _worker_feature_store_path = feature_store_path
+
+
+def _consolidation_worker(node_ids):
+    with _worker_engine.connect() as connection:
+        feature_store = None
+        if _worker_feature_store_path is not None:
+            feature_store = get_feature_store(
+                _worker_feature_store_path, connection=connection
+            )
+
+        return _sample_and_fit(connection, node_ids, feature_store)
+
+
 class Tree(object):
     """
     A tree as represented by the database.
     """
 
-    def __init__(self, connection):
+    def __init__(self, connection, feature_store=None):
         self.connection = connection
 
+        # Memory-mapped object vectors (see morphocluster.feature_store),
+        # looked up on first use
+        self._feature_store = feature_store
+        self._feature_store_loaded = feature_store is not None
+
+        # Private topologies of the projects that were changed by this instance (by project_id)
+        self._topologies = {}
+        # Projects whose version was bumped by this instance
+        self._bumped_projects = set()
+
+        # Nodes whose cached values were invalidated by this instance
+        # (to be handed over to the consolidation worker after the transaction was committed)
+        self.dirty_node_ids = set()
+
+    @property
+    def feature_store(self):
+        """
+        The feature store of the current app, if it is up to date with the database.
+        """
+        if not self._feature_store_loaded:
+            self._feature_store = get_feature_store(connection=self.connection)
+            self._feature_store_loaded = True
+
+        return self._feature_store
+
+    def get_topology(self, project_id, version=None):
+        """
+        Get the topology of a project.
+
+        The version of the project is checked on every call,
+        so that changes by other connections are picked up.
+        Topologies of projects that were changed by this instance are not shared
+        with other connections (the change is not committed yet).
+
+        Parameters:
+            version: Current version of the project, if already known.
+        """
+        if project_id not in self._bumped_projects:
+            return get_topology(self.connection, project_id, version=version)
+
+        if version is None:
+            stmt = select(projects.c.version).where(projects.c.project_id == project_id)
+            version = self.connection.execute(stmt).scalar()
+
+            if version is None:
+                raise KeyError(project_id)
+
+        topology = self._topologies.get(project_id)
+
+        if topology is None or topology.version != version:
+            topology = Topology.load(self.connection, project_id, version)
+            self._topologies[project_id] = topology
+
+        return topology
+
+    def _get_topology_for_node(self, node_id):
+        stmt = (
+            select(nodes.c.project_id, projects.c.version)
+            .select_from(nodes.join(projects))
+            .where(nodes.c.node_id == node_id)
+        )
+        row = self.connection.execute(stmt).first()
+
+        if row is None:
+            raise TreeError("Unknown node: {}".format(node_id))
+
+        return self.get_topology(row.project_id, row.version)
+
+    def _bump_version(self, node_ids):
+        """
+        Bump the version of the projects of the supplied nodes.
+
+        This invalidates the cached topologies.
+        Has to be called by every method that changes the shape or the flags of a tree.
+        """
+        project_ids = (
+            select(nodes.c.project_id)
+            .where(nodes.c.node_id.in_(list(node_ids)))
+            .scalar_subquery()
+        )
+        stmt = (
+            projects.update()
+            .values(version=projects.c.version + 1)
+            .where(projects.c.project_id.in_(project_ids))
+            .returning(projects.c.project_id)
+        )
+        for (project_id,) in self.connection.execute(stmt):
+            self._topologies.pop(project_id, None)
+            self._bumped_projects.add(project_id)
+
+    def _reserve_node_ids(self, n):
+        """
+        Reserve n node IDs from the sequence of nodes.node_id.
+        """
+        stmt = select(
+            func.nextval(func.pg_get_serial_sequence("nodes", "node_id"))
+        ).select_from(func.generate_series(1, n))
+        return [r for (r,) in self.connection.execute(stmt)]
+
+    def _copy_nodes(self, project_id, tree, root_id=None):
+        """
+        Insert the nodes of a processing.Tree using COPY.
+
+        Node IDs, parents and paths are calculated client-side.
+        Only nodes reachable from the root of tree are inserted.
+
+        Parameters:
+            root_id: If not None, the root of tree is not inserted
+                but mapped to this existing node.
+
+        Returns:
+            Mapping of the node IDs in tree to the node IDs in the database.
+        """
+
+        # Walk the tree from the root
+        tree_nodes = tree.nodes.set_index("node_id", drop=False)
+        tree_parent_ids = tree_nodes["parent_id"].dropna().astype(np.int64)
+        children = tree_parent_ids.index.groupby(tree_parent_ids.to_numpy())
+
+        tree_root_id = tree.get_root_id()
+        order = [tree_root_id]
+        for tree_node_id in order:
+            order.extend(children.get(tree_node_id, []))
+
+        if root_id is not None:
+            order = order[1:]
+            new_node_ids = {tree_root_id: root_id}
+            paths = {tree_root_id: self.get_path_ids(root_id)}
+        else:
+            new_node_ids = {}
+            paths = {}
+
+        # Map the original node IDs to newly reserved ones
+        new_node_ids.update(zip(order, self._reserve_node_ids(len(order))))
+
+        def node_rows():
+            for tree_node_id, node in zip(
+                order, tree_nodes.loc[order].to_dict("records")
+            ):
+                node_id = new_node_ids[tree_node_id]
+
+                if pd.notnull(node["parent_id"]):
+                    parent_id = new_node_ids[int(node["parent_id"])]
+                    path = paths[int(node["parent_id"])] + [node_id]
+                else:
+                    parent_id = None
+                    path = [node_id]
+                paths[tree_node_id] = path
+
+                name = (
+                    node["name"]
+                    if "name" in node and pd.notnull(node["name"])
+                    else None
+                )
+                flags = _compute_flags(node, ("approved", "starred", "filled"))
+
+                yield (
+                    node_id,
+                    int(tree_node_id),
+                    project_id,
+                    parent_id,
+                    name,
+                    flags.get("approved", False),
+                    flags.get("starred", False),
+                    flags.get("filled", False),
+                    "{{{}}}".format(",".join(str(n) for n in path)),
+                )
+
+        copy_rows(
+            self.connection,
+            nodes,
+            tqdm(node_rows(), total=len(order), unit_scale=True, desc="Nodes"),
+            [
+                "node_id",
+                "orig_id",
+                "project_id",
+                "parent_id",
+                "name",
+                "approved",
+                "starred",
+                "filled",
+                "path_ids",
+            ],
+        )
+
+        inserted = [new_node_ids[tree_node_id] for tree_node_id in order]
+        if inserted:
+            self._bump_version(inserted)
+            self.dirty_node_ids.update(inserted)
+
+        return new_node_ids
+
     def load_project(self, name, tree):
         """
         Load a project from a saved tree.
+
+        Nodes and objects are streamed into the database using COPY.
         """
 
         if not isinstance(tree, processing.Tree):
@@ -179,45 +614,46 @@ class Tree(object):
         # Lock project
         self.lock_project(project_id)
 
-        progress_bar = tqdm(total=len(tree.nodes) + len(tree.objects), unit_scale=True)
+        start = time.perf_counter()
 
-        def progress_cb(nadd):
-            progress_bar.update(nadd)
+        new_node_ids = self._copy_nodes(project_id, tree)
 
-        for node in tree.topological_order():
-            name = node["name"] if "name" in node and pd.notnull(node["name"]) else None
-
-            object_ids = tree.objects_for_node(node["node_id"])["object_id"].tolist()
+        # Objects of unreachable nodes are dropped
+        object_node_ids = tree.objects["node_id"].map(new_node_ids)
+        selector = object_node_ids.notnull()
+        object_rows = zip(
+            object_node_ids[selector].astype(np.int64),
+            itertools.repeat(project_id),
+            tree.objects.loc[selector, "object_id"],
+        )
 
-            tree_parent_id = (
-                int(node["parent_id"]) if pd.notnull(node["parent_id"]) else None
-            )
+        n_objects = copy_rows(
+            self.connection,
+            nodes_objects,
+            tqdm(
+                object_rows, total=int(selector.sum()), unit_scale=True, desc="Objects"
+            ),
+            ["node_id", "project_id", "object_id"],
+        )
 
-            flags = _compute_flags(node, ("approved", "starred", "filled"))  # type: ignore
-
-            # Create node with objects
-            self.create_node(
-                project_id,
-                orig_node_id=int(node["node_id"]),
-                orig_parent=tree_parent_id,
-                object_ids=object_ids,
-                name=name,
-                progress_cb=progress_cb,
-                **flags,
+        n_nodes = len(new_node_ids)
+        elapsed = time.perf_counter() - start
+        print(
+            "Loaded {:,d} nodes and {:,d} objects after {:.2f}s ({:,.0f} rows/s).".format(
+                n_nodes, n_objects, elapsed, (n_nodes + n_objects) / elapsed
             )
-
-            # Update progress bar
-            progress_cb(1)
-        progress_bar.close()
-        print()
-
-        print("Done after {}s.".format(progress_bar.format_dict["elapsed"]))
+        )
 
         return project_id
 
     def update_project(self, project_id, tree):
         """
         Update a project from a saved tree.
+
+        The root of the saved tree corresponds to the root of the project.
+        All other nodes are inserted below it using COPY and
+        their objects are moved there from the root of the project in one UPDATE.
+        Objects that are not located in the root of the project stay where they are.
         """
 
         if not isinstance(tree, processing.Tree):
@@ -228,52 +664,46 @@ class Tree(object):
         # Lock project
         self.lock_project(project_id)
 
-        tree_root_id = tree.get_root_id()
-
-        progress_bar = tqdm(total=len(tree.nodes), unit_scale=True)
-
-        for node in tree.topological_order():
-            name = node["name"] if "name" in node and pd.notnull(node["name"]) else None
-
-            object_ids = tree.objects_for_node(node["node_id"])["object_id"].tolist()
+        start = time.perf_counter()
+
+        # Do not change root when updating
+        new_node_ids = self._copy_nodes(project_id, tree, root_id)
+
+        # Stage the new assignments of objects (except for the ones in the root)
+        object_node_ids = tree.objects["node_id"].map(new_node_ids)
+        selector = object_node_ids.notnull() & (object_node_ids != root_id)
+        staging = stage_rows(
+            self.connection,
+            "update_project",
+            [Column("object_id", String), Column("node_id", BigInteger)],
+            zip(
+                tree.objects.loc[selector, "object_id"],
+                object_node_ids[selector].astype(np.int64),
+            ),
+        )
 
-            tree_parent_id = (
-                int(node["parent_id"]) if pd.notnull(node["parent_id"]) else None
+        # Relocate objects (but take only from root)
+        stmt = (
+            nodes_objects.update()
+            .values(node_id=staging.c.node_id)
+            .where(
+                (nodes_objects.c.project_id == project_id)
+                & (nodes_objects.c.node_id == root_id)
+                & (nodes_objects.c.object_id == staging.c.object_id)
             )
+        )
+        n_objects = self.connection.execute(stmt).rowcount
 
-            flags = _compute_flags(node, ("approved", "starred", "filled"))  # type: ignore
-
-            # Were updating an existing project
-            if tree_parent_id is None:
-                # Do not change root when updating
-                print("Skipping root.")
-            else:
-                # Calculate parent
-                if tree_parent_id == tree_root_id:
-                    # If tree parent is tree root, use supplied root_id
-                    parent_cfg = dict(parent_id=root_id)
-                else:
-                    # If node further down, use orig_parent
-                    parent_cfg = dict(orig_parent=tree_parent_id)
-
-                # Create new node without creating new objects
-                new_node_id = self.create_node(
-                    project_id,
-                    orig_node_id=int(node["node_id"]),
-                    name=name,
-                    **parent_cfg,
-                    **flags,
-                )
-
-                # Relocate objects (but take only from root)
-                self.relocate_objects(object_ids, new_node_id, src_node_id=root_id)
-
-            # Update progress bar
-            progress_bar.update()
-        progress_bar.close()
-        print()
+        # The inserted nodes are invalid already
+        self.invalidate_nodes([root_id])
 
-        print("Done after {}s.".format(progress_bar.format_dict["elapsed"]))
+        n_nodes = len(new_node_ids) - 1
+        elapsed = time.perf_counter() - start
+        print(
+            "Inserted {:,d} nodes and relocated {:,d} objects after {:.2f}s ({:,.0f} rows/s).".format(
+                n_nodes, n_objects, elapsed, (n_nodes + n_objects) / elapsed
+            )
+        )
 
         return project_id
 
@@ -391,66 +821,67 @@ class Tree(object):
         return project_id
 
     def connect_supertree(self, root_id):
-        with self.connection.begin():
-            successors = _rquery_subtree(root_id)
-
-            supersuccessor_ids = select([successors.c.node_id]).where(
-                successors.c.starred == True
-            )
-            supersuccessor_ids = self.connection.execute(supersuccessor_ids).fetchall()
-            supersuccessor_ids = [node_id for (node_id,) in supersuccessor_ids]
-            supersuccessor_ids.insert(0, root_id)
+        """
+        Set superparent_id of the nodes below root_id to root_id
+        (see Topology.superparents).
 
-            progress_bar = tqdm(
-                total=len(supersuccessor_ids), desc="Connecting supertree"
-            )
+        The superparents are calculated in memory from the topology
+        and written back in a single UPDATE.
+        """
+        with self.connection.begin():
+            # Acquire project lock
+            self.lock_project_for_node(root_id)
 
-            for node_id in supersuccessor_ids:
+            topology = self._get_topology_for_node(root_id)
 
-                def recurse_cb(q, _):
-                    return q.c.starred == False
+            idx, superparent_idx = topology.superparents(root_id)
 
-                successors = _rquery_subtree(node_id, recurse_cb)
+            staging = stage_rows(
+                self.connection,
+                "connect_supertree",
+                [Column("node_id", BigInteger), Column("superparent_id", BigInteger)],
+                zip(
+                    topology.node_ids[idx].tolist(),
+                    topology.node_ids[superparent_idx].tolist(),
+                ),
+            )
 
-                # ===============================================================
-                # UPDATE nodes
-                # SET superparent_id=node_id
-                # WHERE node_id IN (SELECT node_id from successors);
-                # ===============================================================
-                successor_ids = select([successors.c.node_id]).where(
-                    successors.c.node_id != node_id
-                )
-                stmt = (
-                    nodes.update()
-                    .values(superparent_id=node_id)
-                    .where(nodes.c.node_id.in_(successor_ids))
+            stmt = (
+                nodes.update()
+                .values(superparent_id=staging.c.superparent_id)
+                .where(
+                    (nodes.c.node_id == staging.c.node_id)
+                    & nodes.c.superparent_id.is_distinct_from(
+                        staging.c.superparent_id
+                    )
                 )
-                self.connection.execute(stmt)
+            )
+            n_updated = self.connection.execute(stmt).rowcount
 
-                progress_bar.update(1)
-            progress_bar.close()
+            print(
+                "Connected {:,d} nodes ({:,d} updated).".format(len(idx), n_updated)
+            )
 
     def get_objects_recursive(self, node_id):
-        # Recursively select all descendants
-        rquery = select([nodes]).where(nodes.c.node_id == node_id).cte(recursive=True)
-
-        parents = rquery.alias("n")
-        descendants = nodes.alias("nd")
-
-        rquery = rquery.union_all(
-            select([descendants]).where(descendants.c.parent_id == parents.c.node_id)
+        # Select all descendants
+        descendants = (
+            select(nodes.c.node_id).where(_has_ancestor(nodes, node_id)).subquery()
         )
 
-        # For each node in rquery, get associated objects
+        # For each descendant, get associated objects
         obj_query = (
-            select([objects])
+            select(objects)
             .distinct()
-            .select_from(rquery.join(nodes_objects).join(objects))
+            .select_from(
+                descendants.join(
+                    nodes_objects, nodes_objects.c.node_id == descendants.c.node_id
+                ).join(objects)
+            )
         )
 
         result = self.connection.execute(obj_query)
 
-        return [dict(r) for r in result]
+        return [r._asdict() for r in result]
 
     def calculate_progress(self, node_id):
         """
@@ -501,44 +932,17 @@ class Tree(object):
             }
 
             # Compute deep values for root
-            # subtree is ordered deep-first
             with t.child("deep stats"):
-                for nid in subtree.index:
-                    child_selector = subtree["parent_id"] == nid
-
-                    subtree.at[nid, "n_approved_objects"] = max(
-                        subtree.at[nid, "n_approved_objects"],
-                        subtree.loc[child_selector, "n_approved_objects"].sum(),
-                    )
-
-                    subtree.at[nid, "n_named_objects"] = max(
-                        subtree.at[nid, "n_named_objects"],
-                        subtree.loc[child_selector, "n_named_objects"].sum(),
-                    )
-
-                    subtree.at[nid, "n_approved_nodes"] = (
-                        subtree.at[nid, "n_approved_nodes"]
-                        + subtree.loc[child_selector, "n_approved_nodes"].sum()
-                    )
-
-                    subtree.at[nid, "n_filled_nodes"] = (
-                        subtree.at[nid, "n_filled_nodes"]
-                        + subtree.loc[child_selector, "n_filled_nodes"].sum()
-                    )
-
-                    subtree.at[nid, "n_nodes"] = (
-                        subtree.at[nid, "n_nodes"]
-                        + subtree.loc[child_selector, "n_nodes"].sum()
-                    )
+                _aggregate_progress(subtree)
 
             deep_result = subtree.loc[node_id, fields].to_dict()
             deep_result = {k.lstrip("_"): v for k, v in deep_result.items()}
 
             return dict(**leaves_result, **deep_result)
 
-    def dump_tree(self, root_id):
+    def _dump_nodes(self, root_id):
         """
-        Generate a processing.Tree from the tree below root_id.
+        Get the consolidated nodes of the tree below root_id as a DataFrame.
         """
         # Acquire project lock
         self.lock_project_for_node(root_id)
@@ -558,32 +962,66 @@ class Tree(object):
             "_n_objects",
             "_n_objects_deep",
         ]
-        tree_nodes = subtree[keep_columns].reset_index()
+        return subtree[keep_columns].reset_index()
 
-        print("Getting objects...")
-        # Get subtree below root
+    @staticmethod
+    def _query_members(table, root_id):
+        """
+        Query (node_id, object_id) of all members (objects or rejected objects) below root_id.
+        """
         subtree = _rquery_subtree(root_id)
 
-        # Get object IDs for all nodes
-        node_objects = (
-            select(nodes_objects.c.node_id, nodes_objects.c.object_id)
-            .select_from(nodes_objects)
-            .where(nodes_objects.c.node_id == subtree.c.node_id)
+        return (
+            select(table.c.node_id, table.c.object_id)
+            .select_from(table)
+            .where(table.c.node_id == subtree.c.node_id)
         )
 
-        node_objects = pd.read_sql_query(node_objects, self.connection)
+    def _warn_unreachable_objects(self, root_id):
+        """
+        Warn about objects of the project that are not exported with the tree below root_id.
 
-        node_rejected_objects = (
-            select(
-                nodes_rejected_objects.c.node_id,
-                nodes_rejected_objects.c.object_id,
+        Only applies if root_id is the root of the project: Objects of nodes that are not
+        reachable from the root (e.g. because their parent was deleted) are not part of the tree.
+        """
+        root = self.get_node(root_id, require_valid=False)
+
+        if root["parent_id"] is not None:
+            return
+
+        subtree = _rquery_subtree(root_id)
+        stmt = (
+            select(func.count())
+            .select_from(nodes_objects)
+            .where(
+                (nodes_objects.c.project_id == root["project_id"])
+                & nodes_objects.c.node_id.not_in(select(subtree.c.node_id))
             )
-            .select_from(nodes_rejected_objects)
-            .where(nodes_rejected_objects.c.node_id == subtree.c.node_id)
         )
+        n_unreachable = self.connection.execute(stmt).scalar()
+
+        if n_unreachable:
+            warnings.warn(
+                "{:d} objects of project {} are not reachable from the root.".format(
+                    n_unreachable, root["project_id"]
+                )
+            )
+
+    def dump_tree(self, root_id):
+        """
+        Generate a processing.Tree from the tree below root_id.
+
+        Objects of nodes that are not reachable from the root are dropped with a warning.
+        """
+        tree_nodes = self._dump_nodes(root_id)
+        self._warn_unreachable_objects(root_id)
 
+        print("Getting objects...")
+        node_objects = pd.read_sql_query(
+            self._query_members(nodes_objects, root_id), self.connection
+        )
         node_rejected_objects = pd.read_sql_query(
-            node_rejected_objects, self.connection
+            self._query_members(nodes_rejected_objects, root_id), self.connection
         )
 
         try:
@@ -597,11 +1035,37 @@ class Tree(object):
     def export_tree(self, root_id, tree_fn):
         """
         Export the whole tree with its objects.
+
+        Produces the same archive as `dump_tree(root_id).save(tree_fn)`,
+        but the objects are streamed from a server-side cursor into the archive
+        in chunks, so that the memory usage does not depend on the number of objects.
+        Objects of nodes that are not reachable from the root are dropped with a warning.
         """
 
-        tree = self.dump_tree(root_id)
+        tree_nodes = self._dump_nodes(root_id)
+        self._warn_unreachable_objects(root_id)
+
         print("Writing tree...")
-        tree.save(tree_fn)
+        with ZipFile(tree_fn, "w", ZIP_DEFLATED) as archive:
+            with open_text_member(archive, "nodes.csv") as f:
+                tree_nodes.to_csv(f, index=False)
+
+            for name, table in (
+                ("objects.csv", nodes_objects),
+                ("rejected_objects.csv", nodes_rejected_objects),
+            ):
+                stmt = self._query_members(table, root_id).execution_options(
+                    stream_results=True, max_row_buffer=EXPORT_CHUNK_SIZE
+                )
+                result = self.connection.execute(stmt)
+
+                with open_text_member(archive, name) as f:
+                    writer = csv.writer(f, lineterminator="\n")
+                    writer.writerow(result.keys())
+                    for chunk in result.partitions(EXPORT_CHUNK_SIZE):
+                        writer.writerows(chunk)
+
+            archive.writestr("meta.json", json.dumps({}))
 
     def get_root_id(self, project_id):
         """Get the root node ID of a project."""
@@ -623,6 +1087,15 @@ class Tree(object):
 
         self.connection.execute(stmt)
 
+        stmt = (
+            projects.update()
+            .values(version=projects.c.version + 1)
+            .where(projects.c.project_id == project_id)
+        )
+        self.connection.execute(stmt)
+        self._topologies.pop(project_id, None)
+        self._bumped_projects.add(project_id)
+
     def get_projects(self, visible_only=True):
         """
         Get projects with name
@@ -670,27 +1143,7 @@ class Tree(object):
         Returns:
             List of `node_id`s.
         """
-        stmt = text(
-            """
-            WITH RECURSIVE q AS
-            (
-                SELECT  n.*, 1 AS level
-                FROM    nodes AS n
-                WHERE   n.node_id = :node_id
-                UNION ALL
-                SELECT  p.*, level + 1
-                FROM    q
-                JOIN    nodes AS p
-                ON      p.node_id = q.parent_id
-            )
-            SELECT  node_id
-            FROM    q
-            ORDER BY
-            level DESC
-        """
-        )
-        rows = self.connection.execute(stmt, {"node_id": node_id}).fetchall()
-        return [r for (r,) in rows]
+        return self._get_topology_for_node(node_id).get_path_ids(node_id)
 
     def create_project(self, name, metadata=None):
         """
@@ -764,6 +1217,23 @@ class Tree(object):
 
         node_id = result.inserted_primary_key[0]
 
+        # Materialize the path of the new node
+        parents = nodes.alias("parents")
+        parent_path = (
+            select(parents.c.path_ids)
+            .where(parents.c.node_id == nodes.c.parent_id)
+            .scalar_subquery()
+        )
+        stmt = (
+            nodes.update()
+            .values(path_ids=func.array_append(parent_path, nodes.c.node_id))
+            .where(nodes.c.node_id == node_id)
+        )
+        self.connection.execute(stmt)
+
+        self._bump_version([node_id])
+        self.dirty_node_ids.add(node_id)
+
         # Insert objects
         if object_ids is not None:
             object_ids = iter(object_ids)
@@ -849,63 +1319,41 @@ class Tree(object):
         return int(node["_n_objects"] + sum(child_ns))
 
     def _query_n_objects_deep(self, node):
-        # Recursively select all descendants
-        rquery = (
-            select([nodes])
-            .where(nodes.c.node_id == node["node_id"])
-            .cte(recursive=True)
-        )
-
-        parents = rquery.alias("n")
-        descendants = nodes.alias("nd")
-
-        rquery = rquery.union_all(
-            select([descendants]).where(descendants.c.parent_id == parents.c.node_id)
-        )
-
-        # For each node in rquery, calculate #objects
-        deep_count = (
-            select(
-                [rquery.c.node_id, func.count(nodes_objects.c.object_id).label("count")]
+        # Count the objects of all descendants
+        stmt = (
+            select(func.count(nodes_objects.c.object_id))
+            .select_from(
+                nodes.join(nodes_objects, nodes_objects.c.node_id == nodes.c.node_id)
             )
-            .select_from(rquery.join(nodes_objects))
-            .group_by(rquery.c.node_id)
-            .alias("deep_count")
+            .where(_has_ancestor(nodes, node["node_id"]))
         )
 
-        # Build total sum
-        stmt = select([func.sum(deep_count.c.count)]).select_from(deep_count)
-
         result = self.connection.scalar(stmt) or 0
 
         return int(result)
 
     def node_n_descendants(self, node_id):
-        # Recursively select all descendants
-        rquery = select([nodes]).where(nodes.c.node_id == node_id).cte(recursive=True)
-
-        parents = rquery.alias("n")
-        descendants = nodes.alias("nd")
-
-        rquery = rquery.union_all(
-            select([descendants]).where(descendants.c.parent_id == parents.c.node_id)
-        )
-
-        # Count results
-        stmt = select([func.count()]).select_from(rquery)
+        # Count all descendants (including the node itself)
+        stmt = select(func.count()).where(_has_ancestor(nodes, node_id))
 
         result = self.connection.scalar(stmt) or 0
 
         return result
 
-    def get_node(self, node_id, require_valid=True):
+    def get_children_ids(self, node_id):
+        """
+        Get the `node_id`s of the children of a node.
+        """
+        return self._get_topology_for_node(node_id).get_children_ids(node_id)
+
+    def get_node(self, node_id, require_valid=True, refresh_prototypes=False):
         assert isinstance(node_id, Integral), "node_id is not integral: {!r}".format(
             node_id
         )
 
         if require_valid:
             # TODO: Directly use values instead of reading again from DB
-            self.consolidate_node(node_id)
+            self.consolidate_node(node_id, refresh_prototypes=refresh_prototypes)
 
         stmt = select(nodes).where(nodes.c.node_id == node_id)
 
@@ -975,6 +1423,29 @@ class Tree(object):
             )
             self.connection.execute(stmt)
 
+            # Move the paths of all descendants below dest
+            dest = nodes.alias("dest")
+            dest_path = (
+                select(dest.c.path_ids)
+                .where(dest.c.node_id == dest_node_id)
+                .scalar_subquery()
+            )
+            position = func.array_position(
+                nodes.c.path_ids, literal(node_id, BigInteger)
+            )
+            stmt = (
+                nodes.update()
+                .values(
+                    path_ids=dest_path.op("||")(
+                        nodes.c.path_ids[
+                            position + 1 : func.cardinality(nodes.c.path_ids)
+                        ]
+                    )
+                )
+                .where(_has_ancestor(nodes, node_id) & (nodes.c.node_id != node_id))
+            )
+            self.connection.execute(stmt)
+
             # Change parent for children
             stmt = (
                 nodes.update()
@@ -983,6 +1454,9 @@ class Tree(object):
             )
             self.connection.execute(stmt)
 
+            self._bump_version([dest_node_id])
+            self.dirty_node_ids.add(dest_node_id)
+
             # Delete node
             stmt = nodes.delete().where(nodes.c.node_id == node_id)
             self.connection.execute(stmt)
@@ -1018,6 +1492,149 @@ class Tree(object):
 
         return [r._asdict() for r in result]
 
+    def get_object_vectors(self, object_ids):
+        """
+        Get the vectors of objects.
+
+        The vectors are taken from the feature store (if available),
+        missing ones are read from the database.
+
+        Returns:
+            Array of shape [n_objects, n_features].
+        """
+        object_ids = np.asarray(object_ids, dtype=object)
+
+        vectors = None
+        missing = np.ones(len(object_ids), dtype=bool)
+        if self.feature_store is not None:
+            vectors, found = self.feature_store.get(object_ids)
+            vectors = vectors.astype(float)
+            missing = ~found
+
+        if missing.any():
+            stmt = select(objects.c.object_id, objects.c.vector).where(
+                objects.c.object_id
+                == any_(
+                    bindparam(
+                        "object_ids",
+                        object_ids[missing].tolist(),
+                        type_=ARRAY(String),
+                    )
+                )
+            )
+            (db_object_ids,), db_vectors = fetch_points(self.connection, stmt)
+
+            n_unknown = int(missing.sum()) - len(db_object_ids)
+            if n_unknown:
+                raise ValueError(
+                    f"{n_unknown} objects do not exist (out of {len(object_ids)})"
+                )
+
+            db_idx = dict(zip(db_object_ids, range(len(db_object_ids))))
+            db_vectors = db_vectors[[db_idx[o] for o in object_ids[missing]]]
+
+            if vectors is None:
+                vectors = db_vectors
+            else:
+                vectors[missing] = db_vectors
+
+        if vectors is None:
+            vectors = np.empty((0, 0))
+
+        return vectors
+
+    def iter_object_vectors(self, node_id, chunk_size):
+        """
+        Iterate over the vectors of the objects directly below a node.
+
+        Yields:
+            (object_ids, vectors) with vectors of shape [<=chunk_size, n_features].
+        """
+        if self.feature_store is not None:
+            stmt = select(nodes_objects.c.object_id).where(
+                nodes_objects.c.node_id == node_id
+            )
+        else:
+            # Vectors are fetched as text and parsed chunk-wise
+            stmt = (
+                select(
+                    objects.c.object_id,
+                    as_text(objects.c.vector),
+                )
+                .select_from(nodes_objects.join(objects))
+                .where(nodes_objects.c.node_id == node_id)
+            )
+
+        stmt = stmt.execution_options(stream_results=True, max_row_buffer=chunk_size)
+
+        for chunk in self.connection.execute(stmt).partitions(chunk_size):
+            object_ids = np.array([r.object_id for r in chunk], dtype=object)
+
+            if self.feature_store is not None:
+                yield object_ids, self.get_object_vectors(object_ids)
+            else:
+                yield object_ids, parse_points([r.vector for r in chunk])
+
+    def sample_objects(self, node_ids, n):
+        """
+        Sample up to n objects for each of the supplied nodes in one query.
+
+        Returns:
+            dict of node_id -> (object_ids, vectors). The vectors of all nodes are
+            slices of one preallocated array.
+        """
+
+        # With a feature store, only the object_ids are sampled in the database
+        columns = [nodes_objects.c.node_id, objects.c.object_id]
+        if self.feature_store is None:
+            columns.append(objects.c.vector)
+
+        ranked = (
+            select(
+                *columns,
+                func.row_number()
+                .over(partition_by=nodes_objects.c.node_id, order_by=objects.c.rand)
+                .label("rank"),
+            )
+            .select_from(nodes_objects.join(objects))
+            .where(nodes_objects.c.node_id.in_(list(node_ids)))
+            .subquery()
+        )
+
+        stmt = (
+            select(*(c for c in ranked.c if c.name != "rank"))
+            .where(ranked.c.rank <= n)
+            .order_by(ranked.c.node_id, ranked.c.rank)
+        )
+
+        if self.feature_store is not None:
+            rows = self.connection.execute(stmt).fetchall()
+            node_ids_ = [r.node_id for r in rows]
+            object_ids = [r.object_id for r in rows]
+        else:
+            (node_ids_, object_ids), vectors = fetch_points(self.connection, stmt)
+
+        node_ids_ = np.array(node_ids_, dtype=np.int64)
+        object_ids = np.array(object_ids, dtype=object)
+
+        if self.feature_store is not None:
+            vectors = self.get_object_vectors(object_ids)
+
+        result = {node_id: (object_ids[:0], vectors[:0]) for node_id in node_ids}
+
+        # Rows are grouped by node
+        boundaries = np.flatnonzero(np.diff(node_ids_)) + 1
+        starts = np.concatenate(([0], boundaries))
+        stops = np.append(boundaries, len(object_ids))
+        for start, stop in zip(starts, stops):
+            if start < stop:
+                result[int(node_ids_[start])] = (
+                    object_ids[start:stop],
+                    vectors[start:stop],
+                )
+
+        return result
+
     def get_n_objects(self, node_id):
         stmt = (
             select([func.count()])
@@ -1036,28 +1653,28 @@ class Tree(object):
         with self.connection.begin():
             self.lock_project_for_node(node_id)
 
-            stmt = text(
-                """
-            WITH RECURSIVE q AS
-            (
-                SELECT  n.*, 1 AS level
-                FROM    nodes AS n
-                WHERE   n.node_id = :node_id
-                UNION ALL
-                SELECT  p.*, level + 1
-                FROM    q
-                JOIN    nodes AS p
-                ON      p.node_id = q.parent_id
-            )
-            UPDATE nodes
-            SET cache_valid = FALSE
-            WHERE node_id IN (SELECT node_id from q);
-            """
+            node = nodes.alias("node")
+
+            stmt = (
+                nodes.update()
+                .values(cache_valid=False)
+                .where(
+                    (node.c.node_id == node_id)
+                    & (nodes.c.node_id == any_(node.c.path_ids))
+                )
+                .returning(nodes.c.node_id)
             )
 
-            self.connection.execute(stmt, node_id=node_id)
+            self.dirty_node_ids.update(self.connection.execute(stmt).scalars())
+
+    def recommend_children(self, node_id, max_n=1000, limit=None):
+        """
+        Recommend children for a node.
 
-    def recommend_children(self, node_id, max_n=1000):
+        Parameters:
+            limit: Only return the first `limit` of the max_n recommendations
+                (the candidates are the same as without a limit).
+        """
         node = self.get_node(node_id)
 
         # Get the path to the node
@@ -1086,89 +1703,265 @@ class Tree(object):
 
         assert len(distances) == len(vectors), distances.shape
 
-        order = np.argsort(distances)[:max_n]
+        order = np.argsort(distances)[: _limit(max_n, limit)]
 
         return nodes_[order].tolist()
 
-    def recommend_objects(self, node_id, max_n=1000):
+    def _recommend_candidates(self, node_id, max_n):
+        """
+        Determine the candidates for the recommendation of objects for a node.
+
+        The candidates are the objects (with a vector) of the nearest ancestors
+        of the node (until max_n are reached) that were not rejected by the node.
+
+        Returns:
+            (node, ancestor_ids, candidates, n_candidates):
+                The node (with prototypes), the ancestors that contribute candidates,
+                a clause selecting the candidates from `objects JOIN nodes_objects`
+                and the number of candidates.
+        """
+        node = self.get_node(node_id, refresh_prototypes=True)
+        project_id = node["project_id"]
+
+        if node["_prototypes"] is None:
+            raise TreeError(f"Node {node_id} has no prototypes!")
+
+        # Get the path to the node (without the node itself)
+        path = self.get_path_ids(node_id)[:-1]
+
+        rejected_object_ids = select(nodes_rejected_objects.c.object_id).where(
+            nodes_rejected_objects.c.node_id == node_id
+        )
+
+        # Number of candidates per ancestor
+        stmt = (
+            select(nodes_objects.c.node_id, func.count())
+            .select_from(objects.join(nodes_objects))
+            .where(
+                nodes_objects.c.node_id.in_(path)
+                & (nodes_objects.c.project_id == project_id)
+                & (objects.c.vector != None)
+                & (~objects.c.object_id.in_(rejected_object_ids))
+            )
+            .group_by(nodes_objects.c.node_id)
+        )
+        n_objects = dict(self.connection.execute(stmt).fetchall())
+
+        # Traverse the path in reverse until there are enough candidates
+        ancestor_ids = []
+        n_candidates = 0
+        for parent_id in path[::-1]:
+            if n_candidates >= max_n:
+                break
+
+            ancestor_ids.append(parent_id)
+            n_candidates += n_objects.get(parent_id, 0)
+
+        candidates = (
+            nodes_objects.c.node_id.in_(ancestor_ids)
+            & (nodes_objects.c.project_id == project_id)
+            & (objects.c.vector != None)
+            & (~objects.c.object_id.in_(rejected_object_ids))
+        )
+
+        return node, ancestor_ids, candidates, n_candidates
+
+    def _recommend_bounds(self, ancestor_ids, prots):
+        """
+        Calculate lower bounds of the distance of each prototype
+        to the objects of each ancestor (using their _own_prototypes).
+
+        Returns:
+            Array of shape [n_ancestors, n_prototypes].
+            Zero where no bound is known (stale or missing _own_prototypes).
+            The radii of the prototypes are only valid for the vectors they were fitted on,
+            so nodes whose objects' vectors changed are skipped (see loading.load_vectors).
+        """
+        stmt = select(nodes.c.node_id, nodes.c._own_prototypes).where(
+            nodes.c.node_id.in_(ancestor_ids)
+            & nodes.c.cache_valid
+            & nodes.c.prototypes_valid
+        )
+        own_prototypes = dict(self.connection.execute(stmt).fetchall())
+
+        bounds = np.zeros((len(ancestor_ids), len(prots.prototypes_)))
+        for i, ancestor_id in enumerate(ancestor_ids):
+            own = own_prototypes.get(ancestor_id)
+            if own is not None:
+                bounds[i] = own.lower_bound(prots.prototypes_)
+
+        return bounds
+
+    def recommend_objects(self, node_id, max_n=1000, method="exact", limit=None):
         """
         Recommend objects for a node.
 
-        Note: Most time is spent querying all objects below a node.
-        This can be sped up, if the nodes a relatively small.
+        Parameters:
+            method: "exact" (distances are calculated in the database)
+                or "ann" (approximate nearest neighbours, see morphocluster.vector_index).
+            limit: Only return the first `limit` of the max_n recommendations.
+                The candidates are the same as without a limit,
+                so that the result is a prefix of the full result.
+
+        The candidates are the objects of the nearest ancestors (until max_n are reached),
+        the result are the max_n candidates closest to any of the prototypes of the node.
+
+        For every prototype, the max_n closest candidates are queried
+        (ORDER BY distance LIMIT max_n, supported by the GiST index on objects.vector)
+        and the closest result of every object is kept.
+        The max_n closest objects to any prototype are among those, so that
+        only prototypes * max_n rows leave the database.
+        The GiST index degrades with the dimensionality of the vectors, however:
+        For 32 features and 1M objects, the per-prototype queries together take
+        as long as fetching all candidates. Use method="ann" for large projects.
+
+        The objects of an ancestor are enclosed by the spheres of its _own_prototypes.
+        A prototype skips ancestors that cannot contain an object closer than
+        the current max_n-th result (branch and bound).
+        Prototypes are processed by ascending bound, so that this threshold
+        is established early.
 
         History:
+            26/10/17: Skip ancestors using bounds from _own_prototypes.
+            26/10/17: Query the closest candidates per prototype and merge.
             18/10/29: Query all objects, then sort and truncate.
             pre 18/10/29: Queried number of objects per node is limited by max_n.
                 This leads to suboptimal results, as the closest objects may not
                 lie under these max_n quasi-randomly chosen objects.
         """
-        with Timer("Tree.recommend_objects") as timer:
-            node = self.get_node(node_id)
-            project_id = node["project_id"]
+        if method == "ann":
+            # The approximate result of a smaller search is not necessarily a prefix
+            return self._recommend_objects_ann(node_id, max_n)[: _limit(max_n, limit)]
 
-            # Get the path to the node (without the node itself)
-            path = self.get_path_ids(node_id)[:-1]
+        if method != "exact":
+            raise ValueError("Unknown method: {!r}".format(method))
 
-            objects_ = []
+        # Number of results
+        k = _limit(max_n, limit)
 
-            rejected_object_ids = select(nodes_rejected_objects.c.object_id).where(
-                nodes_rejected_objects.c.node_id == node_id
-            )
+        with Timer("Tree.recommend_objects") as timer:
+            with timer.child("Candidates"):
+                node, ancestor_ids, candidates, n_candidates = (
+                    self._recommend_candidates(node_id, max_n)
+                )
+                prots: Prototypes = node["_prototypes"]
 
-            prots: Prototypes = node["_prototypes"]
-            if prots is None:
-                raise TreeError(f"Node {node_id} has no prototypes!")
+            if not n_candidates:
+                return []
 
-            distances_expression = [
-                objects.c.vector.dist_euclidean(p) for p in prots.prototypes_
-            ]
+            with timer.child("Bounds"):
+                bounds = self._recommend_bounds(ancestor_ids, prots)
 
-            print("Tree.recommend_objects: Querying candidates...")
-            with timer.child("Query matching objects") as c:
-                # Traverse the parse in reverse
-                for parent_id in path[::-1]:
-                    n_left = max_n - len(objects_)
+            # Closest result of every object
+            best = {}
+            threshold = np.inf
+            n_skipped = 0
 
-                    # Break if we already have enough objects
-                    if n_left <= 0:
-                        break
+            with timer.child("Query closest candidates"):
+                for j in np.argsort(bounds.min(axis=0), kind="stable"):
+                    selected = bounds[:, j] < threshold
+                    n_skipped += np.count_nonzero(~selected)
 
-                    # Get objects below parent_id that are not rejected by node_id
+                    if not selected.any():
+                        continue
+
+                    distance = objects.c.vector.dist_euclidean(prots.prototypes_[j])
                     stmt = (
                         select(
                             objects.c.object_id,
                             objects.c.path,
-                            func.least(*distances_expression).label("distance"),
+                            distance.label("distance"),
                         )
                         .select_from(objects.join(nodes_objects))
                         .where(
-                            (nodes_objects.c.node_id == parent_id)
-                            & (nodes_objects.c.project_id == project_id)
-                            & (~objects.c.object_id.in_(rejected_object_ids))
+                            candidates
+                            & nodes_objects.c.node_id.in_(
+                                [a for a, sel in zip(ancestor_ids, selected) if sel]
+                            )
                         )
+                        .order_by(distance)
+                        .limit(k)
                     )
 
-                    with c.child("execute"):
-                        r = self.connection.execute(stmt)
+                    for r in self.connection.execute(stmt):
+                        o = best.get(r.object_id)
+                        if o is None or r.distance < o["distance"]:
+                            best[r.object_id] = r._asdict()
+
+                    if len(best) >= k:
+                        threshold = heapq.nsmallest(
+                            k, (o["distance"] for o in best.values())
+                        )[-1]
 
-                    with c.child("fetch"):
-                        result = r.fetchall()
+            logger.debug(
+                "Skipped %d of %d (ancestor, prototype) pairs.", n_skipped, bounds.size
+            )
 
-                    objects_.extend(r._asdict() for r in result)
+            return heapq.nsmallest(k, best.values(), key=itemgetter("distance"))
 
-            if not objects_:
-                return []
+    def _recommend_objects_ann(self, node_id, max_n):
+        """
+        Recommend objects for a node using the vector index of the project.
+
+        The candidates are the same as for the exact method.
+        The index is queried for a growing number of neighbours
+        until max_n of them are candidates.
+        """
+        with Timer("Tree._recommend_objects_ann") as timer:
+            with timer.child("Candidates"):
+                node, _, candidates, n_candidates = self._recommend_candidates(
+                    node_id, max_n
+                )
+                prots: Prototypes = node["_prototypes"]
+
+            if n_candidates < RECOMMEND_ANN_MIN_CANDIDATES:
+                # Few candidates are scored faster in the database
+                return self.recommend_objects(node_id, max_n, method="exact")
+
+            with timer.child("Load index"):
+                index = get_vector_index(self.connection, node["project_id"])
+
+            # Expected number of neighbours that contain max_n candidates
+            k = int(
+                np.ceil(RECOMMEND_ANN_OVERSAMPLING * max_n * len(index) / n_candidates)
+            )
+
+            while True:
+                with timer.child("Search"):
+                    object_ids, distances = index.search(prots.prototypes_, k)
+
+                with timer.child("Filter candidates"):
+                    stmt = (
+                        select(objects.c.object_id, objects.c.path)
+                        .select_from(objects.join(nodes_objects))
+                        .where(
+                            (
+                                nodes_objects.c.object_id
+                                == any_(
+                                    bindparam(
+                                        "object_ids",
+                                        object_ids.tolist(),
+                                        type_=ARRAY(String),
+                                    )
+                                )
+                            )
+                            & candidates
+                        )
+                    )
+                    paths = dict(self.connection.execute(stmt).fetchall())
+
+                if len(paths) >= max_n or k >= len(index):
+                    break
 
-            with timer.child("Convert to array"):
-                distances = np.array([o["distance"] for o in objects_])
-                objects_ = np.array(objects_, dtype=object)
+                k *= 4
 
-            with timer.child("Sorting"):
-                order = np.argsort(distances)[:max_n]
+            result = [
+                {"object_id": object_id, "path": paths[object_id], "distance": distance}
+                for object_id, distance in zip(object_ids, distances.tolist())
+                if object_id in paths
+            ]
 
-            with timer.child("Result assembly"):
-                return objects_[order].tolist()
+            return result[:max_n]
 
     def invalidate_nodes(self, nodes_to_invalidate, unapprove=False):
         """
@@ -1193,70 +1986,253 @@ class Tree(object):
         )
         self.connection.execute(stmt)
 
+        if unapprove:
+            self._bump_version(nodes_to_invalidate)
+
+        self.dirty_node_ids.update(nodes_to_invalidate)
+
+    def _update_aggregates(self, deltas, unapprove=False):
+        """
+        Update the additive cached values of nodes incrementally.
+
+        The prototypes and type objects of the updated nodes become stale.
+        Nodes without valid aggregates are invalidated instead.
+        The updated nodes are locked (FOR UPDATE) while their aggregates are read.
+
+        Parameters:
+            deltas: Mapping of node_id to a list
+                [delta _n_objects, delta _n_children, delta _n_objects_deep, delta _vector_sum].
+        """
+
+        if not deltas:
+            return
+
+        stmt = (
+            select(
+                nodes.c.node_id,
+                nodes.c.cache_valid,
+                nodes.c._n_objects,
+                nodes.c._n_children,
+                nodes.c._n_objects_deep,
+                nodes.c._vector_sum,
+            )
+            .where(nodes.c.node_id.in_(list(deltas.keys())))
+            .order_by(nodes.c.node_id)
+            .with_for_update(of=nodes)
+        )
+
+        updates = []
+        nodes_to_invalidate = []
+        for row in self.connection.execute(stmt):
+            d_n_objects, d_n_children, d_n_objects_deep, d_vector_sum = deltas[
+                row.node_id
+            ]
+
+            if (
+                not row.cache_valid
+                or row._n_objects is None
+                or row._n_children is None
+                or row._n_objects_deep is None
+                or (row._vector_sum is None and row._n_objects_deep > 0)
+            ):
+                nodes_to_invalidate.append(row.node_id)
+                continue
+
+            _n_objects_deep = row._n_objects_deep + d_n_objects_deep
+
+            if _n_objects_deep <= 0:
+                _vector_sum = None
+            elif row._vector_sum is None:
+                _vector_sum = d_vector_sum
+            elif d_vector_sum is None:
+                _vector_sum = row._vector_sum
+            else:
+                _vector_sum = row._vector_sum + d_vector_sum
+
+            updates.append(
+                {
+                    "_node_id": row.node_id,
+                    "_n_objects": row._n_objects + d_n_objects,
+                    "_n_children": row._n_children + d_n_children,
+                    "_n_objects_deep": _n_objects_deep,
+                    "_vector_sum": _vector_sum,
+                    "_centroid": (
+                        _vector_sum / _n_objects_deep
+                        if _vector_sum is not None
+                        else None
+                    ),
+                }
+            )
+
+        if updates:
+            stmt = (
+                nodes.update()
+                .where(nodes.c.node_id == bindparam("_node_id"))
+                .values({k: bindparam(k) for k in updates[0].keys() if k != "_node_id"})
+            )
+            self.connection.execute(stmt, updates)
+
+        values = {nodes.c.prototypes_valid: False}
+        if unapprove:
+            values[nodes.c.approved] = False
+
+        stmt = (
+            nodes.update()
+            .values(values)
+            .where(nodes.c.node_id.in_(list(deltas.keys())))
+        )
+        self.connection.execute(stmt)
+
+        if unapprove:
+            self._bump_version(deltas.keys())
+
+        # The prototypes of the updated nodes are stale
+        self.dirty_node_ids.update(deltas.keys())
+
+        if nodes_to_invalidate:
+            self.invalidate_nodes(nodes_to_invalidate)
+
     def relocate_nodes(self, node_ids, parent_id, unapprove=False):
         """
         Relocate nodes to another parent.
+
+        The additive cached values along the affected paths are updated incrementally.
         """
 
         if len(node_ids) == 0:
             return
 
-        with self.connection.begin():
-            # Acquire project lock
-            self.lock_project_for_node(parent_id)
+        # Acquire project lock
+        self.lock_project_for_node(parent_id)
 
-            new_parent_path = self.get_path_ids(parent_id)
+        new_parent_path = self.get_path_ids(parent_id)
 
-            # Check if the new parent is below the node
-            new_parent_set = set(new_parent_path)
-            for node_id in node_ids:
-                if node_id in new_parent_set:
-                    raise TreeError(
-                        "Relocating {} to {} would create a circle!".format(
-                            node_id, parent_id
-                        )
+        # Check if the new parent is below the node
+        new_parent_set = set(new_parent_path)
+        for node_id in node_ids:
+            if node_id in new_parent_set:
+                raise TreeError(
+                    "Relocating {} to {} would create a circle!".format(
+                        node_id, parent_id
                     )
+                )
 
-            # stmt = nodes.update().values({"parent_id": parent_id}).where(nodes.c.node_id.in_(node_ids))
-
-            # Return distinct old `parent_id`s
-            stmt = text(
-                """
-            WITH updater AS (
-                UPDATE nodes x
-                SET parent_id = :new_parent_id
-                FROM  (SELECT node_id, parent_id FROM nodes WHERE node_id IN :node_ids FOR UPDATE) y
-                WHERE  x.node_id = y.node_id
-                RETURNING y.parent_id AS old_parent_id
+        # Lock the relocated nodes and fetch their old parents (with paths) and aggregates
+        parents = nodes.alias("parents")
+        stmt = (
+            select(
+                nodes.c.node_id,
+                nodes.c.parent_id,
+                nodes.c.cache_valid,
+                nodes.c._n_objects_deep,
+                nodes.c._vector_sum,
+                parents.c.path_ids.label("parent_path_ids"),
             )
-            SELECT DISTINCT old_parent_id FROM updater;
-            """
+            .select_from(
+                nodes.outerjoin(parents, parents.c.node_id == nodes.c.parent_id)
             )
+            .where(nodes.c.node_id.in_(node_ids))
+            .with_for_update(of=nodes)
+        )
+        relocated = self.connection.execute(stmt).fetchall()
+        relocated_ids = set(r.node_id for r in relocated)
 
-            # Fetch old_parent_ids
-            result = self.connection.execute(
-                stmt, new_parent_id=parent_id, node_ids=tuple(node_ids)
-            ).fetchall()
+        old_parent_paths = {
+            r.parent_id: list(r.parent_path_ids)
+            for r in relocated
+            if r.parent_id is not None
+        }
 
-            # Invalidate subtree rooted at first common ancestor
-            parent_paths = [new_parent_path] + [
-                self.get_path_ids(r["old_parent_id"]) for r in result
-            ]
-            paths_to_update = _paths_from_common_ancestor(parent_paths)
+        stmt = (
+            nodes.update()
+            .values({nodes.c.parent_id: parent_id})
+            .where(nodes.c.node_id.in_(node_ids))
+        )
+        self.connection.execute(stmt)
+
+        # Re-root the materialized paths of the relocated subtrees.
+        # (If relocated nodes are nested, the deepest one determines the new path.)
+        stmt = text(
+            """
+            UPDATE  nodes AS n
+            SET     path_ids = CAST(:new_parent_path AS bigint[]) || n.path_ids[r.pos:cardinality(n.path_ids)]
+            FROM    (
+                SELECT  d.node_id, max(array_position(d.path_ids, m.node_id)) AS pos
+                FROM    unnest(CAST(:node_ids AS bigint[])) AS m(node_id)
+                JOIN    nodes AS d
+                ON      d.path_ids @> ARRAY[m.node_id]
+                GROUP BY d.node_id
+            ) AS r
+            WHERE   n.node_id = r.node_id
+            """
+        )
+        self.connection.execute(
+            stmt,
+            {
+                "new_parent_path": new_parent_path,
+                "node_ids": [int(n) for n in relocated_ids],
+            },
+        )
+
+        self._bump_version([parent_id])
+
+        # Update subtree rooted at first common ancestor
+        parent_paths = [new_parent_path] + list(old_parent_paths.values())
+        common_ancestor_idx = len(commonprefix(parent_paths)) - 1
+
+        if any(
+            not r.cache_valid
+            or r._n_objects_deep is None
+            or (r._vector_sum is None and r._n_objects_deep > 0)
+            for r in relocated
+        ) or any(relocated_ids.intersection(p) for p in old_parent_paths.values()):
+            # The aggregates of the relocated nodes are unknown
+            # or some of them are nested and can not be simply added
+            paths_to_update = [p[common_ancestor_idx:] for p in parent_paths]
             nodes_to_invalidate = set(sum(paths_to_update, []))
 
             assert parent_id in nodes_to_invalidate
 
             self.invalidate_nodes(nodes_to_invalidate, unapprove)
+            return
+
+        deltas = {}
+        for r in relocated:
+            if r.parent_id is not None:
+                _add_delta(deltas, r.parent_id, n_children=-1)
+                for n in old_parent_paths[r.parent_id][common_ancestor_idx:]:
+                    _add_delta(
+                        deltas,
+                        n,
+                        n_objects_deep=-r._n_objects_deep,
+                        vector_sum=_neg(r._vector_sum),
+                    )
+
+            _add_delta(deltas, parent_id, n_children=1)
+            for n in new_parent_path[common_ancestor_idx:]:
+                _add_delta(
+                    deltas,
+                    n,
+                    n_objects_deep=r._n_objects_deep,
+                    vector_sum=r._vector_sum,
+                )
+
+        self._update_aggregates(deltas, unapprove)
 
     def relocate_objects(self, object_ids, node_id, unapprove=False, src_node_id=None):
         """
-        Relocate an object to another node.
+        Relocate objects to another node.
+
+        The object_ids are transferred into a staging table using COPY
+        and reassigned in one UPDATE that returns their old nodes.
+        The additive cached values along the affected paths are updated incrementally.
+
+        Concurrent relocations are serialized by the advisory project lock.
+        In addition, the assignments are locked (FOR UPDATE) before the UPDATE,
+        so that the old nodes are read after any concurrent writer has committed.
 
         Args:
             src_node_id: If not None, transfer only objects from this node.
-
-        TODO: This is slow!
         """
 
         if len(object_ids) == 0:
@@ -1271,69 +2247,94 @@ class Tree(object):
 
         new_node_path = self.get_path_ids(node_id)
 
-        # Find current node_ids of the objects
-        # This is slow!
-        # old_node_ids is required for invalidation
-        # TODO: Distinct!
+        staging = stage_rows(
+            self.connection,
+            "relocate_objects",
+            [Column("object_id", String)],
+            ((object_id,) for object_id in object_ids),
+        )
+
+        # Lock the assignments (in a consistent order to avoid deadlocks).
+        # The UPDATE below reads the old node_ids from a snapshot taken afterwards.
         stmt = (
-            select(nodes_objects.c.node_id)
-            .with_for_update()
+            select(nodes_objects.c.object_id)
             .where(
-                nodes_objects.c.object_id.in_(object_ids)
+                (nodes_objects.c.object_id == staging.c.object_id)
                 & (nodes_objects.c.project_id == project_id)
             )
+            .order_by(nodes_objects.c.object_id)
+            .with_for_update(of=nodes_objects)
         )
+        self.connection.execute(stmt)
 
-        if src_node_id is not None:
-            stmt = stmt.where(nodes_objects.c.node_id == src_node_id)
-
-        old_node_ids = [r.node_id for r in self.connection.execute(stmt).fetchall()]
-
-        # Update assignments
+        # Update assignments and return the old node_ids and the vectors of the objects
+        # (required for the update of the aggregates)
+        old = nodes_objects.alias("old")
         stmt = (
             nodes_objects.update()
-            .values({"node_id": node_id})
+            .values(node_id=node_id)
             .where(
-                nodes_objects.c.object_id.in_(object_ids)
-                & (nodes_objects.c.project_id == project_id)
+                (old.c.object_id == staging.c.object_id)
+                & (old.c.project_id == project_id)
+                & (old.c.node_id != node_id)
+                & (nodes_objects.c.project_id == old.c.project_id)
+                & (nodes_objects.c.object_id == old.c.object_id)
+                & (objects.c.object_id == old.c.object_id)
             )
+            .returning(old.c.node_id, objects.c.vector)
         )
 
         if src_node_id is not None:
-            stmt = stmt.where(nodes_objects.c.node_id == src_node_id)
+            stmt = stmt.where(old.c.node_id == src_node_id)
 
-        self.connection.execute(stmt)
+        relocated = self.connection.execute(stmt).fetchall()
+
+        if not relocated:
+            return
+
+        # Number and vector sum of the relocated objects per old node
+        old_node_ids, inverse = np.unique(
+            np.array([r.node_id for r in relocated], dtype=np.int64),
+            return_inverse=True,
+        )
+        counts = np.bincount(inverse, minlength=len(old_node_ids))
+        has_vector = np.array([r.vector is not None for r in relocated])
+        vector_sums = None
+        if has_vector.any():
+            vectors = np.stack([r.vector for r in relocated if r.vector is not None])
+            vector_sums = np.zeros((len(old_node_ids), vectors.shape[1]))
+            np.add.at(vector_sums, inverse[has_vector], vectors)
+
+        # Paths of all old nodes in one query
+        stmt = select(nodes.c.node_id, nodes.c.path_ids).where(
+            nodes.c.node_id.in_(old_node_ids.tolist())
+        )
+        old_node_paths = {
+            r.node_id: list(r.path_ids) for r in self.connection.execute(stmt)
+        }
 
-        # # Return distinct old `parent_id`s
-        # stmt = text("""
-        # WITH updater AS (
-        #     UPDATE nodes_objects x
-        #     SET node_id = :node_id
-        #     FROM  (SELECT object_id, node_id FROM nodes_objects
-        #         WHERE project_id = :project_id AND object_id IN :object_ids FOR UPDATE) y
-        #     WHERE  project_id = :project_id AND x.object_id = y.object_id
-        #     RETURNING y.node_id AS old_node_id
-        # )
-        # SELECT DISTINCT old_node_id FROM updater;
-        # """)
-
-        # # Fetch old_parent_ids
-        # result = self.connection.execute(stmt,
-        #                                  node_id=node_id,
-        #                                  project_id=project_id,
-        #                                  object_ids=tuple(object_ids)
-        #                                  ).fetchall()
-
-        # Invalidate subtree rooted at first common ancestor
-        paths = [new_node_path] + [old_node_ids]
-        paths_to_update = _paths_from_common_ancestor(paths)
-        nodes_to_invalidate = set(sum(paths_to_update, []))
-
-        print("Invalidating {!r}...".format(nodes_to_invalidate))
-
-        assert node_id in nodes_to_invalidate
-
-        self.invalidate_nodes(nodes_to_invalidate, unapprove)
+        # Update subtree rooted at first common ancestor
+        paths = [new_node_path] + list(old_node_paths.values())
+        common_ancestor_idx = len(commonprefix(paths)) - 1
+
+        deltas = {}
+        for i, old_node_id in enumerate(old_node_ids.tolist()):
+            n = int(counts[i])
+            vector_sum = vector_sums[i] if vector_sums is not None else None
+
+            _add_delta(deltas, old_node_id, n_objects=-n)
+            for n_id in old_node_paths[old_node_id][common_ancestor_idx:]:
+                _add_delta(
+                    deltas, n_id, n_objects_deep=-n, vector_sum=_neg(vector_sum)
+                )
+
+            _add_delta(deltas, node_id, n_objects=n)
+            for n_id in new_node_path[common_ancestor_idx:]:
+                _add_delta(deltas, n_id, n_objects_deep=n, vector_sum=vector_sum)
+
+        assert node_id in deltas
+
+        self._update_aggregates(deltas, unapprove)
 
     def reject_objects(self, node_id, object_ids):
         """
@@ -1372,6 +2373,9 @@ class Tree(object):
         stmt = nodes.update().values(data).where(nodes.c.node_id == node_id)
         self.connection.execute(stmt)
 
+        if TOPOLOGY_COLUMNS.intersection(data.keys()):
+            self._bump_version([node_id])
+
     def get_tip(self, node_id):
         """
         Get the id of the tip (descendant with maximum depth) below a node.
@@ -1382,31 +2386,7 @@ class Tree(object):
             - is has children
         """
 
-        stmt = text(
-            """
-        WITH    RECURSIVE
-        q AS
-        (
-            SELECT  node_id, starred, 1 as level
-            FROM    nodes AS n
-            WHERE   node_id = :node_id
-            UNION ALL
-            SELECT  nd.node_id, nd.starred, level + 1
-            FROM    q
-            JOIN    nodes AS nd
-            ON      nd.parent_id = q.node_id
-            WHERE nd.approved = 'f' AND nd.starred = 'f'
-        )
-        SELECT q.node_id
-        FROM q LEFT JOIN nodes as c ON c.parent_id = q.node_id
-        GROUP BY q.node_id, q.level
-        HAVING COUNT(c.*) > 0
-        ORDER BY q.level desc
-        LIMIT 1
-        """
-        )
-
-        return self.connection.execute(stmt, node_id=node_id).scalar()
+        return self._get_topology_for_node(node_id).get_tip(node_id)
 
     def get_minlevel_starred(self, root_node_id, require_valid=True):
         """
@@ -1415,34 +2395,41 @@ class Tree(object):
         Descend into the tree while a node is not starred. Return only starred nodes.
         """
 
-        rquery = (
-            select([nodes]).where(nodes.c.node_id == root_node_id).cte(recursive=True)
-        )
+        root_depth = _path_depth(root_node_id)
 
-        parents = rquery.alias("n")
-        descendants = nodes.alias("nd")
+        s = nodes.alias("s")
+        a = nodes.alias("a")
 
-        rquery = rquery.union_all(
-            # Include descendants when the parent is not starred
-            select([descendants]).where(
-                (not parents.c.starred) & (descendants.c.parent_id == parents.c.node_id)
-            )
+        # Ancestors between root_node_id (inclusive) and s (exclusive)
+        ancestors = s.c.path_ids[root_depth : func.cardinality(s.c.path_ids) - 1]
+        starred_ancestor = (
+            select(a.c.node_id)
+            .where((a.c.node_id == any_(ancestors)) & (a.c.starred == True))
+            .exists()
         )
 
-        stmt = select([rquery]).where(rquery.c.starred)
+        stmt = select(s).where(
+            _has_ancestor(s, root_node_id) & (s.c.starred == True) & ~starred_ancestor
+        )
 
         result = self.connection.execute(stmt).fetchall()
 
         return [
-            self._upgrade_node(dict(r), require_valid=require_valid) for r in result
+            (
+                self.get_node(r.node_id)
+                if require_valid and not r.cache_valid
+                else r._asdict()
+            )
+            for r in result
         ]
 
     def get_next_node(
         self,
         node_id,
         leaf=False,
-        recurse_cb=None,
+        descend_cb=None,
         filter=None,
+        where=None,
         preferred_first=False,
         order_by=None,
     ):
@@ -1450,85 +2437,229 @@ class Tree(object):
         Get the id of the next unapproved node.
 
         This is either
-            a) the deepest node below, if this current node matches the recurse_cb, or
-            b) the first node below a predecessor of the current node that does not match the recurse_cb.
+            a) the deepest node below, if this current node matches the descend_cb, or
+            b) the first node below a predecessor of the current node that does not match the descend_cb.
 
         Parameters:
             node_id
             leaf: Only return leaves.
+            descend_cb: Only descend into nodes that match this callback.
+                The callback receives the Topology and returns a boolean mask.
+            filter: Only return nodes that match this callback.
+                The callback receives the Topology and returns a boolean mask.
+            where: Only return nodes that match this callback.
+                The callback receives `nodes` and must return a clause that can be used in where().
+                (For cached values that are not part of the topology.)
+            preferred_first: Return preferred nodes first.
+            order_by (None | "largest" | "smallest"): Order nodes of the same depth by their number of objects.
         """
 
-        # First try if there are candidates below this node
-        subtree = _rquery_subtree(node_id, recurse_cb)
+        if order_by not in (None, "largest", "smallest"):
+            raise ValueError(f"Unknown order_by value: {order_by}")
 
-        # TODO: Could be replaced by cached values
-        children = nodes.alias("children")
-        n_children = (
-            select(func.count())
-            .select_from(children)
-            .where(children.c.parent_id == subtree.c.node_id)
-            .scalar_subquery()
-            .label("n_children")
-        )
+        topology = self._get_topology_for_node(node_id)
 
-        n_objects = (
-            select(func.count())
-            .select_from(nodes_objects)
-            .where(nodes_objects.c.node_id == subtree.c.node_id)
-            .scalar_subquery()
-            .label("n_objects")
-        )
-
-        stmt = select(subtree.c.node_id)
+        # First try if there are candidates below this node
+        descend = descend_cb(topology) if descend_cb is not None else None
+        candidates = topology.subtree(node_id, descend)
 
         if filter is not None:
-            stmt = stmt.where(filter(subtree))
+            candidates = candidates[filter(topology)[candidates]]
 
         if leaf:
-            stmt = stmt.where(n_children == 0)
+            candidates = candidates[topology.n_children[candidates] == 0]
+
+        if candidates.size:
+            # Deeper nodes (and preferred nodes) first
+            key = topology.depth[candidates]
+            if preferred_first:
+                key = key + topology.preferred[candidates] * (topology.depth.max() + 1)
+
+            if where is None and order_by is None:
+                return int(topology.node_ids[candidates[np.argmax(key)]])
+
+            # Check the remaining conditions in the database
+            ranked = (
+                text(
+                    """
+                SELECT  *
+                FROM    unnest(CAST(:node_ids AS bigint[]), CAST(:ranks AS bigint[]))
+                AS      c(node_id, rank)
+                """
+                )
+                .columns(node_id=BigInteger, rank=BigInteger)
+                .subquery("c")
+            )
 
-        if preferred_first:
-            stmt = stmt.order_by(subtree.c.preferred.desc())
+            stmt = select(ranked.c.node_id).select_from(
+                ranked.join(nodes, nodes.c.node_id == ranked.c.node_id)
+            )
 
-        stmt = stmt.order_by(subtree.c.level.desc()).limit(1)
+            if where is not None:
+                stmt = stmt.where(where(nodes))
 
-        if order_by is None:
-            pass
-        elif order_by == "largest":
-            stmt = stmt.order_by(n_objects.desc())
-        elif order_by == "smallest":
-            stmt = stmt.order_by(n_objects.asc())
-        else:
-            raise ValueError(f"Unknown order_by value: {order_by}")
+            stmt = stmt.order_by(ranked.c.rank)
 
-        print(stmt)
+            if order_by is not None:
+                n_objects = (
+                    select(func.count())
+                    .select_from(nodes_objects)
+                    .where(nodes_objects.c.node_id == ranked.c.node_id)
+                    .scalar_subquery()
+                )
+                stmt = stmt.order_by(
+                    n_objects.desc() if order_by == "largest" else n_objects.asc()
+                )
 
-        result = self.connection.execute(stmt).scalar()
+            result = self.connection.execute(
+                stmt.limit(1),
+                {
+                    "node_ids": topology.node_ids[candidates].tolist(),
+                    "ranks": (-key).tolist(),
+                },
+            ).scalar()
 
-        if result is not None:
-            return result
+            if result is not None:
+                return result
 
         # Otherwise go to parent
-        node = self.connection.execute(
-            nodes.select().where(nodes.c.node_id == node_id)
-        ).first()
+        parent = topology.parent[topology.index(node_id)]
 
-        if node.parent_id:
-            print("No matching children, trying parent: {}".format(node.parent_id))
-            return self.get_next_node(node.parent_id, leaf, recurse_cb, filter)
+        if parent >= 0:
+            parent_id = int(topology.node_ids[parent])
+            print("No matching children, trying parent: {}".format(parent_id))
+            return self.get_next_node(
+                parent_id, leaf, descend_cb, filter, where, preferred_first, order_by
+            )
 
         return None
 
-    def consolidate_node(self, node_id, depth=0, descend_approved=True, return_=None):
+    def _consolidate_aggregate(
+        self, invalid_subtree, node_id, objects_, prots, own_vector_sum, t
+    ):
+        """
+        Calculate the cached values of an invalid node from its (already valid)
+        children, its sampled objects, their prototypes and the exact vector sum
+        of its own objects.
+
+        The results are stored in `invalid_subtree`.
+        """
+        try:
+            child_selector = invalid_subtree["parent_id"] == node_id
+            children = invalid_subtree.loc[child_selector]
+            # Build collection of children.
+            children_dict = MemberCollection(
+                children.reset_index().to_dict("records"), "remove"
+            )
+
+            # 2. _n_objects_deep
+            _n_objects = invalid_subtree.loc[node_id, "_n_objects"]
+            _n_objects_deep = _n_objects + children["_n_objects_deep"].sum()
+            invalid_subtree.at[node_id, "_n_objects_deep"] = _n_objects_deep
+
+            # 3. _own_type_objects, _type_objects
+            # TODO: Replace _own_type_objects with "_atypical_objects"
+            with t.child("_calc_own_type_objects"):
+                invalid_subtree.at[node_id, "_own_type_objects"] = (
+                    self._calc_own_type_objects(children_dict, objects_)
+                )
+
+            with t.child("_calc_type_objects"):
+                invalid_subtree.at[node_id, "_type_objects"] = self._calc_type_objects(
+                    children_dict, objects_
+                )
+
+            if (
+                len(children_dict) > 0
+                and len(invalid_subtree.at[node_id, "_type_objects"]) == 0
+            ):
+                print(
+                    "\nNode {} has no type objects although it has children!".format(
+                        node_id
+                    )
+                )
+
+            # 4. _vector_sum, _centroid
+            with t.child("_centroid"):
+                _vector_sums = [v for v in children["_vector_sum"] if v is not None]
+
+                if own_vector_sum is not None:
+                    _vector_sums.append(own_vector_sum)
+
+                if len(_vector_sums) > 0 and _n_objects_deep > 0:
+                    _vector_sum = np.sum(_vector_sums, axis=0)
+                    _centroid = _vector_sum / _n_objects_deep
+                else:
+                    _vector_sum = None
+                    _centroid = None
+
+                invalid_subtree.at[node_id, "_vector_sum"] = _vector_sum
+                invalid_subtree.at[node_id, "_centroid"] = _centroid
+
+                if invalid_subtree.loc[node_id, "_centroid"] is None:
+                    print("\nNode {} has no centroid!".format(node_id))
+
+            # 5. _own_prototypes, _prototypes
+            with t.child("_prototypes"):
+                invalid_subtree.at[node_id, "_own_prototypes"] = prots
+
+                _prototypes = []
+
+                if prots is not None:
+                    _prototypes.append(prots)
+                if len(children_dict) > 0:
+                    _prototypes.extend(
+                        c["_prototypes"]
+                        for c in children_dict
+                        if c["_prototypes"] is not None
+                    )
+
+                if len(_prototypes) > 0:
+                    try:
+                        _prototypes = merge_prototypes(_prototypes, N_PROTOTYPES)
+                    except:
+                        for prots in _prototypes:
+                            print(prots.prototypes_)
+                        raise
+                else:
+                    _prototypes = None
+                    print("\nNode {} has no prototypes!".format(node_id))
+
+                invalid_subtree.at[node_id, "_prototypes"] = _prototypes
+
+            # Finally, flag as updated
+            invalid_subtree.at[node_id, "__updated"] = True
+        except:
+            print(f"Error processing node {node_id}")
+            raise
+
+    def consolidate_node(
+        self,
+        node_id,
+        depth=0,
+        descend_approved=True,
+        return_=None,
+        n_workers=None,
+        refresh_prototypes=False,
+    ):
         """
         Ensures that the calculated values of this node are valid.
 
         If deep=True, ensures that also the calculated values of all successors are valid.
 
+        Invalid nodes are processed level by level, starting with the deepest.
+        The object sampling and prototype fitting of the nodes of one level
+        is independent and can be distributed to `n_workers` processes.
+        Only the aggregation of the children happens in order.
+
         Parameters:
             node_id: Root of the subtree that gets consolidated.
             depth: Ensure validity of cached values at least up to a certain depth.
             return_: None | "node" | "children". Return this node or its children.
+            n_workers: Number of worker processes. None or 1 consolidates in this process.
+                Workers use their own connections, so they only see committed data.
+            refresh_prototypes: Also recalculate nodes where only the prototypes
+                (and type objects) are stale.
 
         Returns:
             node dict or list of children, depending on return_ parameter.
@@ -1547,6 +2678,11 @@ class Tree(object):
             # Acquire project lock
             self.lock_project_for_node(node_id)
 
+            def is_invalid(q):
+                if refresh_prototypes:
+                    return (q.c.cache_valid == False) | (q.c.prototypes_valid == False)
+                return q.c.cache_valid == False
+
             if depth == -1:
                 if descend_approved:
                     recurse_cb = None
@@ -1554,7 +2690,7 @@ class Tree(object):
                     # Only recurse into invalid nodes
                     # Ensure validity up to a certain level
                     def recurse_cb(q, s):
-                        return (q.c.cache_valid == False) | (q.c.approved == False)
+                        return is_invalid(q) | (q.c.approved == False)
 
             else:
                 if not descend_approved:
@@ -1563,7 +2699,7 @@ class Tree(object):
                 # Only recurse into invalid nodes
                 # Ensure validity up to a certain level
                 def recurse_cb(q, s):
-                    return (q.c.cache_valid == False) | (q.c.level < depth)
+                    return is_invalid(q) | (q.c.level < depth)
 
             invalid_subtree = _rquery_subtree(node_id, recurse_cb)
 
@@ -1598,142 +2734,84 @@ class Tree(object):
             if len(invalid_subtree) == 0:
                 raise TreeError("Unknown node: {}".format(node_id))
 
-            if not invalid_subtree["cache_valid"].all():
+            invalid_selection = ~invalid_subtree["cache_valid"].astype(bool)
+            if refresh_prototypes:
+                invalid_selection |= ~invalid_subtree["prototypes_valid"].astype(bool)
+
+            if invalid_selection.any():
                 # 1. _n_objects, _n_children
                 invalid_subtree["_n_objects"] = invalid_subtree["_n_objects_"]
                 invalid_subtree["_n_children"] = invalid_subtree["_n_children_"]
 
                 invalid_subtree["__updated"] = False
 
-                # Initialize clusterer
-                clusterer = KMeans(N_PROTOTYPES, n_init=2)
+                if n_workers is not None and n_workers > 1:
+                    database_url = self.connection.engine.url.render_as_string(
+                        hide_password=False
+                    )
+                    executor = ProcessPoolExecutor(
+                        n_workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                        initializer=_init_consolidation_worker,
+                        initargs=(
+                            database_url,
+                            (
+                                self.feature_store.path
+                                if self.feature_store is not None
+                                else None
+                            ),
+                        ),
+                    )
+                    map_ = executor.map
+                    sample_and_fit = _consolidation_worker
+                else:
+                    executor = None
+                    map_ = map
+
+                    def sample_and_fit(node_ids):
+                        return _sample_and_fit(
+                            self.connection, node_ids, self.feature_store
+                        )
 
-                # Iterate over DataFrame fixing the values along the way
+                # Iterate over DataFrame level by level fixing the values along the way
                 progress_bar = tqdm(
                     total=len(invalid_subtree), desc="Consolidating nodes"
                 )
-                for node_id in invalid_subtree.index:
-                    try:
-                        if invalid_subtree.at[node_id, "cache_valid"]:
-                            # Don't recalculate valid nodes as invalid_subtree (rightly)
-                            # doesn't include their children.
-                            continue
-
-                        child_selector = invalid_subtree["parent_id"] == node_id
-                        children = invalid_subtree.loc[child_selector]
-                        # Build collection of children.
-                        children_dict = MemberCollection(
-                            children.reset_index().to_dict("records"), "remove"
+                try:
+                    # Don't recalculate valid nodes as invalid_subtree (rightly)
+                    # doesn't include their children.
+                    invalid_nodes = invalid_subtree.loc[invalid_selection]
+
+                    # invalid_subtree is ordered by descending level
+                    for _, level_nodes in invalid_nodes.groupby("level", sort=False):
+                        sample_sizes = level_nodes["_n_objects"].clip(
+                            upper=CONSOLIDATE_SAMPLE_SIZE
                         )
 
-                        # 2. _n_objects_deep
-                        _n_objects = invalid_subtree.loc[node_id, "_n_objects"]
-                        _n_objects_deep = _n_objects + children["_n_objects_deep"].sum()
-                        invalid_subtree.at[node_id, "_n_objects_deep"] = _n_objects_deep
-
-                        # Sample 1000 objects to speed up the calculation
-                        with t.child("get_objects"):
-                            objects_ = MemberCollection(
-                                self.get_objects(
-                                    node_id, order_by=objects.c.rand, limit=1000
-                                ),
-                                "raise",
-                            )
-
-                        # 3. _own_type_objects, _type_objects
-                        # TODO: Replace _own_type_objects with "_atypical_objects"
-                        with t.child("_calc_own_type_objects"):
-                            invalid_subtree.at[node_id, "_own_type_objects"] = (
-                                self._calc_own_type_objects(children_dict, objects_)
+                        # Distribute the level evenly among the workers
+                        batch_size = CONSOLIDATE_BATCH_SIZE
+                        if executor is not None:
+                            batch_size = min(
+                                batch_size, -(-sample_sizes.sum() // n_workers)
                             )
-                            # self._calc_own_type_objects(children_dict, objects_)
-
-                        with t.child("_calc_type_objects"):
-                            invalid_subtree.at[node_id, "_type_objects"] = (
-                                self._calc_type_objects(children_dict, objects_)
-                            )
-
-                        if (
-                            len(children_dict) > 0
-                            and len(invalid_subtree.at[node_id, "_type_objects"]) == 0
-                        ):
-                            print(
-                                "\nNode {} has no type objects although it has children!".format(
-                                    node_id
-                                )
-                            )
-
-                        # 4. _centroid
-                        with t.child("_centroid"):
-                            _centroid_vectors = []
-                            _centroid_supports = 0
 
-                            if len(objects_) > 0:
-                                # Object mean, weighted with number of objects
-                                _centroid_vectors.append(
-                                    np.sum(objects_.vectors, axis=0)
-                                )
-                                _centroid_supports += len(objects_)
+                        batches = _batches(
+                            level_nodes.index.tolist(),
+                            sample_sizes.tolist(),
+                            batch_size,
+                        )
 
-                            if len(children_dict) > 0:
-                                children_support, children_vector = (
-                                    children_dict.get_support_and_vector()
-                                )
-                                if children_support > 0:
-                                    _centroid_vectors.append(children_vector)
-                                    _centroid_supports += children_support
-
-                            if len(_centroid_vectors) > 0 and _centroid_supports > 0:
-                                _centroid = (
-                                    np.sum(_centroid_vectors, axis=0)
-                                    / _centroid_supports
+                        for batch in map_(sample_and_fit, batches):
+                            for nid, objects_, prots, vector_sum in batch:
+                                self._consolidate_aggregate(
+                                    invalid_subtree, nid, objects_, prots, vector_sum, t
                                 )
-                            else:
-                                _centroid = None
-
-                            invalid_subtree.at[node_id, "_centroid"] = _centroid
-
-                            if invalid_subtree.loc[node_id, "_centroid"] is None:
-                                print("\nNode {} has no centroid!".format(node_id))
-
-                        # 5. _prototypes
-                        with t.child("_prototypes"):
-                            _prototypes = []
-
-                            if len(objects_) > 0:
-                                prots = Prototypes(clusterer)
-                                prots.fit(objects_.vectors)
-                                _prototypes.append(prots)
-                            if len(children_dict) > 0:
-                                _prototypes.extend(
-                                    c["_prototypes"]
-                                    for c in children_dict
-                                    if c["_prototypes"] is not None
-                                )
-
-                            if len(_prototypes) > 0:
-                                try:
-                                    _prototypes = merge_prototypes(
-                                        _prototypes, N_PROTOTYPES
-                                    )
-                                except:
-                                    for prots in _prototypes:
-                                        print(prots.prototypes_)
-                                    raise
-                            else:
-                                _prototypes = None
-                                print("\nNode {} has no prototypes!".format(node_id))
 
-                            invalid_subtree.at[node_id, "_prototypes"] = _prototypes
-
-                        # Finally, flag as updated
-                        invalid_subtree.at[node_id, "__updated"] = True
-
-                        progress_bar.update(1)
-                        progress_bar.set_postfix(node_id=node_id)
-                    except:
-                        print(f"Error processing node {node_id}")
-                        raise
+                                progress_bar.update(1)
+                                progress_bar.set_postfix(node_id=nid)
+                finally:
+                    if executor is not None:
+                        executor.shutdown(cancel_futures=True)
                 progress_bar.close()
 
                 # Convert _n_objects_deep to int (might be object when containing NULL values in the database)
@@ -1748,18 +2826,23 @@ class Tree(object):
                 updated_selection = invalid_subtree["__updated"] == True
                 n_updated = updated_selection.sum()
 
+                invalid_subtree.loc[updated_selection, "prototypes_valid"] = True
+
                 # Write back to database (if necessary)
                 if n_updated > 0:
                     # Write results back to database
                     update_fields = [
                         "cache_valid",
+                        "prototypes_valid",
                         "_centroid",
                         "_prototypes",
+                        "_own_prototypes",
                         "_type_objects",
                         "_own_type_objects",
                         "_n_objects_deep",
                         "_n_objects",
                         "_n_children",
+                        "_vector_sum",
                     ]
 
                     stmt = (
@@ -0,0 +1,238 @@
+"""
+Approximate nearest neighbour (ANN) index over the object vectors of a project.
+
+Used by Tree.recommend_objects (method="ann").
+The index of a project is cached per process and rebuilt when the vectors
+of the project change (``projects.vectors_version``, bumped by ``flask load-features``).
+
+hnswlib (HNSW graph) is used if it is installed,
+otherwise sklearn's NearestNeighbors (ball tree).
+"""
+
+import threading
+
+import numpy as np
+from sqlalchemy import String
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.sql.expression import any_, bindparam, select
+
+from morphocluster.feature_store import get_feature_store
+from morphocluster.models import nodes_objects, objects, projects
+from morphocluster.sql.points import as_text, fetch_points
+from morphocluster.sql.types import parse_points
+
+#: Rows that are fetched at once when building an index
+LOAD_CHUNK_SIZE = 100000
+
+#: Construction parameters of the HNSW graph
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+
+
+def _fill_missing(connection, object_ids, chunks):
+    """
+    Read the vectors that were not found in the feature store from the database.
+
+    Parameters:
+        chunks: List of (vectors, found) as returned by FeatureStore.get.
+
+    Returns:
+        List of vector arrays.
+    """
+    if not chunks:
+        return []
+
+    found = np.concatenate([f for _, f in chunks])
+    missing = np.asarray(object_ids, dtype=object)[~found]
+
+    vectors = [np.array(v, dtype=np.float32) for v, _ in chunks]
+
+    if len(missing):
+        stmt = select(objects.c.object_id, objects.c.vector).where(
+            objects.c.object_id
+            == any_(bindparam("object_ids", missing.tolist(), type_=ARRAY(String)))
+        )
+        (db_object_ids,), db_vectors = fetch_points(connection, stmt)
+        db_idx = dict(zip(db_object_ids, range(len(db_object_ids))))
+
+        missing_vectors = iter(db_vectors[[db_idx[o] for o in missing]])
+        for v, (_, f) in zip(vectors, chunks):
+            for i in np.flatnonzero(~f):
+                v[i] = next(missing_vectors)
+
+    return vectors
+
+
+def _hnswlib():
+    try:
+        import hnswlib
+    except ImportError:
+        return None
+    return hnswlib
+
+
+class VectorIndex:
+    """
+    Nearest neighbour index over the vectors of the objects of a project.
+
+    Attributes:
+        object_ids: Object IDs (in the order of the index).
+        vectors: Vectors of the objects (float32).
+        backend: "hnswlib" or "sklearn".
+    """
+
+    def __init__(self, project_id, version, object_ids, vectors, backend=None):
+        self.project_id = project_id
+        self.version = version
+        self.object_ids = np.asarray(object_ids, dtype=object)
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+
+        if backend is None:
+            backend = "hnswlib" if _hnswlib() is not None else "sklearn"
+
+        self.backend = backend
+
+        if not len(self):
+            self._index = None
+        elif backend == "hnswlib":
+            hnswlib = _hnswlib()
+            if hnswlib is None:
+                raise ImportError("You must have hnswlib installed to use HNSW")
+
+            self._index = hnswlib.Index(space="l2", dim=self.vectors.shape[1])
+            self._index.init_index(
+                max_elements=len(self),
+                ef_construction=HNSW_EF_CONSTRUCTION,
+                M=HNSW_M,
+            )
+            self._index.add_items(self.vectors, np.arange(len(self)))
+        elif backend == "sklearn":
+            from sklearn.neighbors import NearestNeighbors
+
+            self._index = NearestNeighbors(algorithm="ball_tree").fit(self.vectors)
+        else:
+            raise ValueError("Unknown backend: {!r}".format(backend))
+
+    @classmethod
+    def load(cls, connection, project_id, version, backend=None, feature_store=None):
+        """
+        Build the index of a project from the vectors in the database.
+
+        With a feature store, only the vectors of objects that are missing in the store
+        are read from the database.
+        """
+        columns = [objects.c.object_id]
+        if feature_store is None:
+            # Vectors are fetched as text and parsed chunk-wise
+            columns.append(as_text(objects.c.vector))
+
+        stmt = (
+            select(*columns)
+            .select_from(objects.join(nodes_objects))
+            .where(
+                (nodes_objects.c.project_id == project_id)
+                & (objects.c.vector != None)
+            )
+            .execution_options(stream_results=True, max_row_buffer=LOAD_CHUNK_SIZE)
+        )
+
+        object_ids = []
+        vectors = []
+        for chunk in connection.execute(stmt).partitions(LOAD_CHUNK_SIZE):
+            object_ids.extend(r.object_id for r in chunk)
+
+            if feature_store is None:
+                vectors.append(
+                    parse_points([r.vector for r in chunk]).astype(np.float32)
+                )
+            else:
+                vectors.append(feature_store.get([r.object_id for r in chunk]))
+
+        if feature_store is not None:
+            vectors = _fill_missing(connection, object_ids, vectors)
+
+        vectors = np.concatenate(vectors) if vectors else np.empty((0, 0), np.float32)
+
+        return cls(project_id, version, object_ids, vectors, backend)
+
+    def __len__(self):
+        return len(self.object_ids)
+
+    def _knn(self, queries, k):
+        """
+        Get the indices of the k nearest neighbours of each query.
+        """
+        if self.backend == "hnswlib":
+            self._index.set_ef(max(k, 64))
+            labels, _ = self._index.knn_query(queries, k=k)
+            return labels
+
+        return self._index.kneighbors(queries, n_neighbors=k, return_distance=False)
+
+    def search(self, prototypes, k):
+        """
+        Find the objects closest to any of the prototypes.
+
+        Up to k neighbours are retrieved for every prototype.
+        The distances of the union of the neighbours are then calculated exactly.
+
+        Returns:
+            (object_ids, distances) sorted by ascending distance.
+        """
+        k = min(k, len(self))
+
+        if k <= 0:
+            return self.object_ids[:0], np.empty(0)
+
+        prototypes = np.atleast_2d(np.asarray(prototypes, dtype=np.float32))
+
+        idx = np.unique(self._knn(prototypes, k))
+
+        # Minimum euclidean distance to any prototype
+        vectors = self.vectors[idx]
+        sqdist = (
+            (vectors**2).sum(axis=1)[:, np.newaxis]
+            - 2 * vectors @ prototypes.T
+            + (prototypes**2).sum(axis=1)[np.newaxis, :]
+        )
+        distances = np.sqrt(np.maximum(sqdist.min(axis=1), 0))
+
+        order = np.argsort(distances, kind="stable")
+
+        return self.object_ids[idx[order]], distances[order]
+
+
+#: Vector indices by project_id
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def get_vector_index(connection, project_id):
+    """
+    Get the vector index of a project, rebuilding it if the vectors changed.
+    """
+    stmt = select(projects.c.vectors_version).where(
+        projects.c.project_id == project_id
+    )
+    version = connection.execute(stmt).scalar()
+
+    if version is None:
+        raise KeyError(project_id)
+
+    with _cache_lock:
+        index = _cache.get(project_id)
+
+    if index is not None and index.version == version:
+        return index
+
+    index = VectorIndex.load(
+        connection,
+        project_id,
+        version,
+        feature_store=get_feature_store(connection=connection),
+    )
+
+    with _cache_lock:
+        _cache[project_id] = index
+
+    return index
@@ -0,0 +1,83 @@
+"""
+Benchmark the extraction of images from an uploaded archive:
+The previous loop of initial_clustering_job (zf.namelist() for every row,
+zf.extract and shutil.move) against ArchiveExtractor.
+
+Usage:
+    python tests/benchmarks/bench_archive_extract.py --n_images=5000 --workers=4
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+import fire
+import numpy as np
+
+from morphocluster.archive import ArchiveExtractor
+
+
+def make_archive(archive_fn, n_images, image_size):
+    rng = np.random.default_rng(0)
+    paths = [f"images/{i % 100:02d}/{i:08d}.jpg" for i in range(n_images)]
+    with zipfile.ZipFile(archive_fn, "w", zipfile.ZIP_DEFLATED) as zf:
+        for path in paths:
+            # Compressible, like image data
+            data = rng.integers(0, 16, image_size, dtype=np.uint8).tobytes()
+            zf.writestr(path, data)
+    return paths
+
+
+def extract_reference(archive_fn, paths, target_dir):
+    """Previous loop of initial_clustering_job."""
+    with zipfile.ZipFile(archive_fn) as zf:
+        for image_path in paths:
+            if image_path in zf.namelist():
+                extracted_path = zf.extract(image_path, target_dir)
+
+                final_path = target_dir / Path(image_path).name
+                if Path(extracted_path) != final_path:
+                    shutil.move(extracted_path, final_path)
+
+
+def extract_parallel(archive_fn, paths, target_dir, workers):
+    with ArchiveExtractor(archive_fn, n_workers=workers) as extractor:
+        for image_path in paths:
+            if image_path in extractor:
+                extractor.extract(image_path, target_dir / Path(image_path).name)
+    return extractor.stats()
+
+
+def main(n_images=5000, image_size=32768, workers=4):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        archive_fn = tmp_dir / "objects.zip"
+        paths = make_archive(archive_fn, n_images, image_size)
+
+        print(f"{n_images:,d} images, {os.path.getsize(archive_fn) / 2**20:.1f}MiB")
+
+        start = time.perf_counter()
+        extract_reference(archive_fn, paths, tmp_dir / "reference")
+        t_reference = time.perf_counter() - start
+
+        start = time.perf_counter()
+        stats = extract_parallel(archive_fn, paths, tmp_dir / "parallel", workers)
+        t_parallel = time.perf_counter() - start
+
+        # The reference leaves the emptied subdirectories behind
+        assert sorted(p.name for p in (tmp_dir / "parallel").iterdir()) == sorted(
+            p.name for p in (tmp_dir / "reference").iterdir() if p.is_file()
+        )
+
+        print(f"Reference (namelist, extract, move): {t_reference:.2f}s")
+        print(
+            f"ArchiveExtractor ({workers} workers): {t_parallel:.2f}s ({t_reference / t_parallel:.1f}x)"
+            f", {stats['files_per_second']:,.0f} images/s"
+        )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
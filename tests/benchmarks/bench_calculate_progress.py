@@ -0,0 +1,105 @@
+"""
+Benchmark the bottom-up aggregation of Tree.calculate_progress
+on a synthetic tree against the previous per-node implementation.
+
+Usage:
+    python tests/benchmarks/bench_calculate_progress.py --n_nodes=100000
+"""
+
+import time
+
+import fire
+import numpy as np
+import pandas as pd
+
+from morphocluster.tree import _aggregate_progress
+
+
+def make_subtree(n_nodes, seed=0):
+    """
+    Build a random tree in the format returned by Tree.consolidate_node(return_="raw").
+    """
+    rng = np.random.default_rng(seed)
+
+    parent_idx = np.empty(n_nodes, dtype=np.int64)
+    parent_idx[0] = -1
+    # Attach every node to a random predecessor, favoring recent ones to get deep trees
+    predecessors = np.arange(1, n_nodes)
+    parent_idx[1:] = np.minimum(
+        predecessors * (1 - rng.random(n_nodes - 1) ** 4), predecessors - 1
+    ).astype(np.int64)
+
+    level = np.zeros(n_nodes, dtype=np.int64)
+    for i in range(1, n_nodes):
+        level[i] = level[parent_idx[i]] + 1
+
+    node_ids = np.arange(n_nodes) + 1000
+    n_objects_deep = rng.integers(0, 1000, n_nodes)
+    approved = rng.random(n_nodes) < 0.3
+    filled = rng.random(n_nodes) < 0.1
+    named = rng.random(n_nodes) < 0.1
+
+    subtree = pd.DataFrame(
+        {
+            "node_id": node_ids,
+            "parent_id": np.where(parent_idx >= 0, node_ids[parent_idx], np.nan),
+            "level": level,
+            "n_approved_objects": approved * n_objects_deep,
+            "n_named_objects": named * n_objects_deep,
+            "n_approved_nodes": approved.astype(int),
+            "n_filled_nodes": filled.astype(int),
+            "n_nodes": 1,
+        }
+    ).set_index("node_id")
+
+    # subtree is ordered deep-first
+    return subtree.sort_values("level", ascending=False, kind="stable")
+
+
+def aggregate_progress_reference(subtree):
+    """Previous implementation: One boolean scan of the DataFrame per node."""
+    for nid in subtree.index:
+        child_selector = subtree["parent_id"] == nid
+
+        subtree.at[nid, "n_approved_objects"] = max(
+            subtree.at[nid, "n_approved_objects"],
+            subtree.loc[child_selector, "n_approved_objects"].sum(),
+        )
+
+        subtree.at[nid, "n_named_objects"] = max(
+            subtree.at[nid, "n_named_objects"],
+            subtree.loc[child_selector, "n_named_objects"].sum(),
+        )
+
+        for field in ("n_approved_nodes", "n_filled_nodes", "n_nodes"):
+            subtree.at[nid, field] = (
+                subtree.at[nid, field] + subtree.loc[child_selector, field].sum()
+            )
+
+
+def main(n_nodes=100000, reference=True):
+    subtree = make_subtree(n_nodes)
+    print(f"Tree with {n_nodes} nodes and depth {subtree['level'].max()}")
+
+    vectorized = subtree.copy()
+    start = time.perf_counter()
+    _aggregate_progress(vectorized)
+    time_vectorized = time.perf_counter() - start
+    print(f"Vectorized: {time_vectorized:.3f}s")
+
+    if not reference:
+        return
+
+    expected = subtree.copy()
+    start = time.perf_counter()
+    aggregate_progress_reference(expected)
+    time_reference = time.perf_counter() - start
+    print(f"Reference: {time_reference:.3f}s")
+
+    pd.testing.assert_frame_equal(vectorized, expected, check_dtype=False)
+
+    print(f"Speedup: {time_reference / time_vectorized:.0f}x")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
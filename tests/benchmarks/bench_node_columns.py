@@ -0,0 +1,100 @@
+"""
+Benchmark the storage format of the cached node columns
+(_centroid, _vector_sum and _prototypes) for a page of children:
+Pickles (previous format) against raw float arrays.
+
+Usage:
+    python tests/benchmarks/bench_node_columns.py --n_children=100 --n_features=32
+"""
+
+import pickle
+import time
+
+import fire
+import numpy as np
+from sklearn.cluster import KMeans
+
+from morphocluster.processing.prototypes import Prototypes
+from morphocluster.sql.types import NumpyArray, PrototypesType
+from morphocluster.tree import CONSOLIDATE_SAMPLE_SIZE, N_PROTOTYPES
+
+
+def make_page(n_children, n_features, seed=0):
+    """
+    Build the cached values of a page of children like Tree.consolidate_node does.
+    """
+    rng = np.random.default_rng(seed)
+
+    page = []
+    for i in range(n_children):
+        vectors = rng.normal(size=(CONSOLIDATE_SAMPLE_SIZE, n_features))
+        prototypes = Prototypes(KMeans(N_PROTOTYPES, n_init=1, random_state=i))
+        prototypes.fit(vectors)
+        vector_sum = vectors.sum(axis=0)
+        page.append(
+            {
+                "_centroid": vector_sum / len(vectors),
+                "_vector_sum": vector_sum,
+                "_prototypes": prototypes,
+            }
+        )
+
+    return page
+
+
+def _timeit(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main(n_children=100, n_features=32, repeat=20):
+    page = make_page(n_children, n_features)
+
+    pickled = [{k: pickle.dumps(v) for k, v in row.items()} for row in page]
+
+    types = {
+        "_centroid": NumpyArray("<f4"),
+        "_vector_sum": NumpyArray("<f8"),
+        "_prototypes": PrototypesType(),
+    }
+    binary = [
+        {k: types[k].process_bind_param(v, None) for k, v in row.items()}
+        for row in page
+    ]
+
+    def decode_pickled():
+        return [{k: pickle.loads(v) for k, v in row.items()} for row in pickled]
+
+    def decode_binary():
+        return [
+            {k: types[k].process_result_value(v, None) for k, v in row.items()}
+            for row in binary
+        ]
+
+    # Both formats contain the same values (up to float32 precision)
+    for row, decoded in zip(page, decode_binary()):
+        np.testing.assert_allclose(decoded["_centroid"], row["_centroid"], rtol=1e-6)
+        np.testing.assert_allclose(
+            decoded["_prototypes"].prototypes_,
+            row["_prototypes"].prototypes_,
+            rtol=1e-6,
+        )
+
+    size_pickled = sum(len(v) for row in pickled for v in row.values())
+    size_binary = sum(len(v) for row in binary for v in row.values())
+    time_pickled = _timeit(decode_pickled, repeat)
+    time_binary = _timeit(decode_binary, repeat)
+
+    print(f"Page of {n_children} children with {n_features} features")
+    print(f"Pickle: {size_pickled / n_children:.0f}B/row, {time_pickled * 1000:.2f}ms")
+    print(f"Binary: {size_binary / n_children:.0f}B/row, {time_binary * 1000:.2f}ms")
+    print(
+        f"Size: {size_pickled / size_binary:.1f}x smaller, "
+        f"decoding: {time_pickled / time_binary:.1f}x faster"
+    )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,107 @@
+"""
+Benchmark the transport of Point columns (objects.vector):
+The previous text codec (one value at a time) against
+bulk parsing of the text representation and binary COPY (cube_send).
+
+No database is required, the results are simulated.
+
+Usage:
+    python tests/benchmarks/bench_point_codec.py --n_rows=100000 --n_features=32
+"""
+
+import struct
+import time
+
+import fire
+import numpy as np
+
+from morphocluster.sql.points import parse_copy_binary
+from morphocluster.sql.types import (
+    CUBE_POINT_BIT,
+    decode_points_binary,
+    format_point,
+    parse_points,
+)
+
+
+def encode_reference(value):
+    """Previous Point.bind_processor."""
+    return "(" + ",".join(str(v) for v in value) + ")"
+
+
+def decode_reference(values):
+    """Previous Point.result_processor(numpy=True), followed by stacking the rows."""
+    return np.array([np.fromstring(v[1:-1], sep=",") for v in values])
+
+
+def make_copy_binary(object_ids, vectors):
+    """
+    Build the output of COPY (SELECT object_id, vector ...) TO STDOUT (FORMAT binary).
+    """
+    header = struct.pack(">I", CUBE_POINT_BIT | vectors.shape[1])
+
+    parts = [b"PGCOPY\n\377\r\n\0", struct.pack(">ii", 0, 0)]
+    for object_id, vector in zip(object_ids, vectors):
+        object_id = object_id.encode("utf-8")
+        vector = header + vector.astype(">f8").tobytes()
+        parts.append(
+            struct.pack(">hi", 2, len(object_id))
+            + object_id
+            + struct.pack(">i", len(vector))
+            + vector
+        )
+    parts.append(struct.pack(">h", -1))
+
+    return b"".join(parts)
+
+
+def decode_binary(data):
+    object_ids, vectors = parse_copy_binary(data, 2)
+    return [o.decode("utf-8") for o in object_ids], decode_points_binary(vectors)
+
+
+def _timeit(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def main(n_rows=100000, n_features=32, repeat=3):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(n_rows, n_features)).astype(np.float32)
+    object_ids = ["object_{:010d}".format(i) for i in range(n_rows)]
+
+    print(f"{n_rows:,d} rows, {n_features}d")
+
+    # Features are float32, prototypes (recommend_objects) are float64
+    for dtype in (np.float32, np.float64):
+        values = vectors.astype(dtype)
+        t_reference, _ = _timeit(lambda: [encode_reference(v) for v in values], repeat)
+        t_encode, _ = _timeit(lambda: [format_point(v) for v in values], repeat)
+        print(f"Encode {np.dtype(dtype).name} (text, reference):    {t_reference:.3f}s")
+        print(
+            f"Encode {np.dtype(dtype).name} (text, format_point): {t_encode:.3f}s ({t_reference / t_encode:.1f}x)"
+        )
+
+    # PostgreSQL outputs cubes like "(1, 2, 3)"
+    text = ["(" + ", ".join(map(repr, v.tolist())) + ")" for v in vectors]
+    data = make_copy_binary(object_ids, vectors)
+
+    t_reference, decoded_reference = _timeit(lambda: decode_reference(text), repeat)
+    t_bulk, decoded_bulk = _timeit(lambda: parse_points(text), repeat)
+    t_binary, (_, decoded_binary) = _timeit(lambda: decode_binary(data), repeat)
+
+    np.testing.assert_array_equal(decoded_bulk, decoded_reference)
+    np.testing.assert_array_equal(decoded_binary, vectors)
+
+    print(f"Decode (text, reference):    {t_reference:.3f}s")
+    print(f"Decode (text, bulk):      {t_bulk:.3f}s ({t_reference / t_bulk:.1f}x)")
+    print(f"Decode (binary COPY):     {t_binary:.3f}s ({t_reference / t_binary:.1f}x)")
+    print(
+        f"Transferred: {sum(map(len, text)) / 2**20:.1f}MiB (text), {len(data) / 2**20:.1f}MiB (binary)"
+    )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
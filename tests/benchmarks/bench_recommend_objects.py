@@ -0,0 +1,190 @@
+"""
+Benchmark Tree.recommend_objects on a synthetic project:
+Fetching and sorting all candidates (previous implementation)
+against querying the closest candidates per prototype (top-k pushdown).
+
+The approximate method (method="ann", see morphocluster.vector_index) is compared
+with the exact method (candidate filtering and per-prototype LIMIT in the database)
+in terms of time and recall@max_n.
+
+Requires a PostgreSQL database with the morphocluster schema (flask db upgrade).
+Everything is done in a transaction that is rolled back in the end.
+
+Usage:
+    python tests/benchmarks/bench_recommend_objects.py postgresql://... --n_objects=1000000
+"""
+
+import time
+
+import fire
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.sql.expression import func, select
+
+from morphocluster import processing
+from morphocluster.models import nodes_objects, nodes_rejected_objects, objects
+from morphocluster.sql.staging import copy_rows
+from morphocluster.tree import Tree
+from morphocluster.vector_index import get_vector_index
+
+
+def make_project(tree: Tree, n_objects, n_features, n_node_objects, seed=0):
+    """
+    Create a project where all objects are in the root except for a small child.
+
+    Returns:
+        node_id of the child.
+    """
+    rng = np.random.default_rng(seed)
+
+    centers = rng.normal(size=(100, n_features))
+    labels = rng.integers(0, len(centers), n_objects)
+    vectors = centers[labels] + 0.5 * rng.normal(size=(n_objects, n_features))
+
+    object_ids = ["bench_{:09d}".format(i) for i in range(n_objects)]
+
+    print("Inserting objects...")
+    copy_rows(
+        tree.connection,
+        objects,
+        (
+            (object_id, object_id + ".jpg", "(" + ",".join(map(str, v)) + ")")
+            for object_id, v in zip(object_ids, vectors)
+        ),
+        ["object_id", "path", "vector"],
+    )
+
+    # The child contains objects of one cluster
+    child_object_ids = [
+        object_ids[i] for i in np.flatnonzero(labels == 0)[:n_node_objects]
+    ]
+    child_object_ids_set = set(child_object_ids)
+
+    processing_tree = processing.Tree(
+        [{"node_id": 0, "parent_id": None}, {"node_id": 1, "parent_id": 0}],
+        [
+            {
+                "node_id": 1 if object_id in child_object_ids_set else 0,
+                "object_id": object_id,
+            }
+            for object_id in object_ids
+        ],
+    )
+
+    project_id = tree.load_project("bench_recommend_objects", processing_tree)
+    root_id = tree.get_root_id(project_id)
+
+    print("Consolidating...")
+    tree.consolidate_node(root_id)
+    tree.connection.exec_driver_sql("ANALYZE objects")
+    tree.connection.exec_driver_sql("ANALYZE nodes_objects")
+
+    (child_id,) = tree.get_children_ids(root_id)
+
+    return child_id
+
+
+def recommend_objects_fetch_all(tree: Tree, node_id, max_n):
+    """
+    Previous implementation: Fetch all candidates of the nearest ancestors, then sort.
+    """
+    node = tree.get_node(node_id, refresh_prototypes=True)
+    path = tree.get_path_ids(node_id)[:-1]
+
+    rejected_object_ids = select(nodes_rejected_objects.c.object_id).where(
+        nodes_rejected_objects.c.node_id == node_id
+    )
+    distances_expression = [
+        objects.c.vector.dist_euclidean(p) for p in node["_prototypes"].prototypes_
+    ]
+
+    objects_ = []
+    for parent_id in path[::-1]:
+        if len(objects_) >= max_n:
+            break
+
+        stmt = (
+            select(
+                objects.c.object_id,
+                objects.c.path,
+                func.least(*distances_expression).label("distance"),
+            )
+            .select_from(objects.join(nodes_objects))
+            .where(
+                (nodes_objects.c.node_id == parent_id)
+                & (nodes_objects.c.project_id == node["project_id"])
+                & (~objects.c.object_id.in_(rejected_object_ids))
+            )
+        )
+        objects_.extend(r._asdict() for r in tree.connection.execute(stmt))
+
+    distances = np.array([o["distance"] for o in objects_])
+    return [objects_[i] for i in np.argsort(distances)[:max_n]]
+
+
+def _timeit(fn, repeat):
+    result = fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def main(
+    database_uri,
+    n_objects=1000000,
+    n_features=32,
+    n_node_objects=100,
+    max_n=1000,
+    repeat=5,
+):
+    engine = create_engine(database_uri)
+
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        try:
+            tree = Tree(connection)
+            node_id = make_project(tree, n_objects, n_features, n_node_objects)
+
+            time_fetch_all, expected = _timeit(
+                lambda: recommend_objects_fetch_all(tree, node_id, max_n), repeat
+            )
+            time_pushdown, result = _timeit(
+                lambda: tree.recommend_objects(node_id, max_n), repeat
+            )
+
+            # Same objects (up to ties)
+            assert np.allclose(
+                [o["distance"] for o in expected], [o["distance"] for o in result]
+            )
+
+            print(f"{n_objects:,d} objects, {n_features}d, max_n={max_n}")
+            print(f"Fetch all: {time_fetch_all * 1000:.0f}ms")
+            print(f"Pushdown:  {time_pushdown * 1000:.0f}ms")
+            print(f"Speedup: {time_fetch_all / time_pushdown:.1f}x")
+
+            # Approximate nearest neighbours against the exact method
+            start = time.perf_counter()
+            get_vector_index(connection, tree.get_node(node_id)["project_id"])
+            time_build = time.perf_counter() - start
+
+            time_ann, result_ann = _timeit(
+                lambda: tree.recommend_objects(node_id, max_n, method="ann"), repeat
+            )
+
+            expected_ids = {o["object_id"] for o in result}
+            recall = len(expected_ids & {o["object_id"] for o in result_ann}) / max(
+                len(expected_ids), 1
+            )
+
+            print(
+                f"ANN:       {time_ann * 1000:.0f}ms (index built in {time_build:.1f}s)"
+            )
+            print(f"Speedup (ANN vs. pushdown): {time_pushdown / time_ann:.1f}x")
+            print(f"Recall@{max_n} (ANN vs. pushdown): {recall:.3f}")
+        finally:
+            transaction.rollback()
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,88 @@
+"""
+Benchmark the archive formats of processing.Tree:
+CSV (default) against parquet.
+
+Usage:
+    python tests/benchmarks/bench_tree_archive.py --n_objects=5000000 --n_nodes=50000
+"""
+
+import os
+import tempfile
+import time
+
+import fire
+import numpy as np
+import pandas as pd
+
+from morphocluster import processing
+
+
+def make_tree(n_objects, n_nodes, seed=0):
+    """
+    Build a random tree with string object IDs.
+    """
+    rng = np.random.default_rng(seed)
+
+    node_ids = np.arange(n_nodes)
+    parent_ids = np.concatenate(([np.nan], rng.integers(0, node_ids[1:])))
+    nodes = pd.DataFrame(
+        {
+            "node_id": node_ids,
+            "parent_id": parent_ids,
+            "name": [None] * n_nodes,
+            "approved": rng.random(n_nodes) < 0.5,
+        }
+    )
+
+    objects = pd.DataFrame(
+        {
+            "node_id": rng.integers(0, n_nodes, n_objects),
+            "object_id": ["object_{:010d}".format(i) for i in range(n_objects)],
+        }
+    )
+
+    return processing.Tree(nodes, objects)
+
+
+def _timeit(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def main(n_objects=5000000, n_nodes=50000):
+    tree = make_tree(n_objects, n_nodes)
+
+    print(f"Tree with {n_nodes:,d} nodes and {n_objects:,d} objects")
+
+    times = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for format in ("csv", "parquet"):
+            tree_fn = os.path.join(tmpdir, f"tree-{format}.zip")
+
+            time_save, _ = _timeit(lambda: tree.save(tree_fn, format=format))
+            time_load, loaded = _timeit(lambda: processing.Tree.from_saved(tree_fn))
+            time_nodes, _ = _timeit(
+                lambda: processing.Tree.from_saved(tree_fn, tables=("nodes",))
+            )
+
+            assert len(loaded.objects) == n_objects
+            assert loaded.objects["object_id"].iloc[0] == "object_0000000000"
+
+            times[format] = (time_save, time_load)
+
+            print(
+                f"{format:8s} {os.path.getsize(tree_fn) / 2**20:8.1f}MiB, "
+                f"save: {time_save:.2f}s, load: {time_load:.2f}s, "
+                f"load nodes: {time_nodes:.2f}s"
+            )
+
+    print(
+        "Parquet: save {:.1f}x, load {:.1f}x faster".format(
+            times["csv"][0] / times["parquet"][0], times["csv"][1] / times["parquet"][1]
+        )
+    )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,112 @@
+"""
+Benchmark the vector index used by Tree.recommend_objects(method="ann")
+against the exact method (minimum distance to the prototypes over all candidates).
+
+The candidates (objects of the ancestors that are not rejected)
+are simulated by a random subset of the objects, and the exact result
+is calculated in memory. This allows to compare the backends on many queries
+without a database. The comparison of Tree.recommend_objects(method="ann")
+with the exact database method is part of bench_recommend_objects.py.
+
+Usage:
+    python tests/benchmarks/bench_vector_index.py --n_objects=200000 --candidate_fraction=0.3
+"""
+
+import time
+
+import fire
+import numpy as np
+
+from morphocluster.tree import N_PROTOTYPES, RECOMMEND_ANN_OVERSAMPLING
+from morphocluster.vector_index import VectorIndex, _hnswlib
+
+
+def make_vectors(n_objects, n_features, n_clusters=100, seed=0):
+    """
+    Generate clustered vectors.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, n_features))
+    labels = rng.integers(0, n_clusters, n_objects)
+    vectors = centers[labels] + 0.5 * rng.normal(size=(n_objects, n_features))
+    return vectors.astype(np.float32)
+
+
+def exact(vectors, candidates, prototypes, max_n):
+    candidate_idx = np.flatnonzero(candidates)
+    v = vectors[candidate_idx]
+    sqdist = (
+        (v**2).sum(axis=1)[:, np.newaxis]
+        - 2 * v @ prototypes.T
+        + (prototypes**2).sum(axis=1)[np.newaxis, :]
+    ).min(axis=1)
+    return candidate_idx[np.argsort(sqdist)[:max_n]]
+
+
+def ann(index, candidates, prototypes, max_n):
+    # Same loop as Tree._recommend_objects_ann
+    n_candidates = candidates.sum()
+    k = int(np.ceil(RECOMMEND_ANN_OVERSAMPLING * max_n * len(index) / n_candidates))
+    while True:
+        object_ids, _ = index.search(prototypes, k)
+        object_ids = object_ids.astype(np.int64)
+        result = object_ids[candidates[object_ids]]
+        if len(result) >= max_n or k >= len(index):
+            return result[:max_n]
+        k *= 4
+
+
+def main(
+    n_objects=200000,
+    n_features=32,
+    candidate_fraction=0.3,
+    max_n=1000,
+    n_queries=20,
+    seed=0,
+):
+    rng = np.random.default_rng(seed)
+    vectors = make_vectors(n_objects, n_features, seed=seed)
+    object_ids = np.arange(n_objects)
+
+    backends = ["sklearn"]
+    if _hnswlib() is not None:
+        backends.insert(0, "hnswlib")
+
+    print(
+        f"{n_objects:,d} objects, {n_features}d, "
+        f"{candidate_fraction:.0%} candidates, max_n={max_n}"
+    )
+
+    queries = []
+    for _ in range(n_queries):
+        candidates = rng.random(n_objects) < candidate_fraction
+        center = vectors[rng.integers(n_objects)]
+        prototypes = center + 0.5 * rng.normal(size=(N_PROTOTYPES, n_features))
+        queries.append((candidates, prototypes.astype(np.float32)))
+
+    start = time.perf_counter()
+    expected = [exact(vectors, c, p, max_n) for c, p in queries]
+    time_exact = (time.perf_counter() - start) / n_queries
+    print(f"exact (numpy): {time_exact * 1000:.1f}ms/query")
+
+    for backend in backends:
+        start = time.perf_counter()
+        index = VectorIndex(None, 0, object_ids, vectors, backend=backend)
+        time_build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = [ann(index, c, p, max_n) for c, p in queries]
+        time_query = (time.perf_counter() - start) / n_queries
+
+        recall = np.mean(
+            [len(np.intersect1d(r, e)) / len(e) for r, e in zip(results, expected)]
+        )
+
+        print(
+            f"{backend}: build {time_build:.1f}s, {time_query * 1000:.1f}ms/query, "
+            f"recall@{max_n}: {recall:.3f}"
+        )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,147 @@
+import struct
+
+import numpy as np
+import pytest
+from sqlalchemy import BigInteger, String, bindparam, select
+from sqlalchemy.dialects.postgresql import ARRAY, psycopg2
+from sqlalchemy.sql.expression import any_
+
+from morphocluster.models import objects
+from morphocluster.sql.points import (
+    _decode_binary_column,
+    parse_copy_binary,
+    render_copy_query,
+)
+from morphocluster.sql.types import (
+    CUBE_POINT_BIT,
+    FLOAT4_OID,
+    Float4Array,
+    Point,
+    decode_float4_arrays_binary,
+    decode_points_binary,
+    format_point,
+    parse_points,
+)
+
+
+def _cube_send(vector):
+    return (
+        struct.pack(">I", CUBE_POINT_BIT | len(vector))
+        + np.asarray(vector, ">f8").tobytes()
+    )
+
+
+def _array_send(vector):
+    header = struct.pack(">iiiii", 1, 0, FLOAT4_OID, len(vector), 1)
+    return header + b"".join(struct.pack(">if", 4, v) for v in vector)
+
+
+def _field(value):
+    if value is None:
+        return struct.pack(">i", -1)
+    return struct.pack(">i", len(value)) + value
+
+
+def test_point_text_codec():
+    vectors = np.random.default_rng(0).normal(size=(10, 5))
+
+    # PostgreSQL separates the coordinates with ", "
+    values = [format_point(v).replace(",", ", ") for v in vectors]
+    np.testing.assert_array_equal(parse_points(values), vectors)
+
+    assert format_point((1, 2.5)) == "(1,2.5)"
+    assert format_point(np.array([0.1], dtype=np.float32)) == "(0.1)"
+    assert parse_points([], 3).shape == (0, 3)
+
+    process = Point(numpy=True).result_processor(None, None)
+    np.testing.assert_array_equal(process(values[1]), vectors[1])
+    assert process(None) is None
+
+    with pytest.raises(ValueError, match="None entries"):
+        parse_points([values[0], None])
+
+    with pytest.raises(ValueError):
+        parse_points(["(1, 2)", "(1, 2, 3)"])
+
+    with pytest.raises(ValueError):
+        parse_points(["(1, 2),(3, 4)"])
+
+
+def test_point_binary_codec():
+    vectors = np.random.default_rng(1).normal(size=(10, 5))
+
+    np.testing.assert_array_equal(
+        decode_points_binary([_cube_send(v) for v in vectors]), vectors
+    )
+
+    # Not a point
+    value = struct.pack(">I", 5) + vectors[0].astype(">f8").tobytes()
+    with pytest.raises(ValueError):
+        decode_points_binary([value])
+
+
+def test_float4_array_codec():
+    vectors = np.random.default_rng(3).normal(size=(10, 200)).astype(np.float32)
+
+    np.testing.assert_array_equal(
+        decode_float4_arrays_binary([_array_send(v) for v in vectors]), vectors
+    )
+    # PostgreSQL outputs the shortest representation of the float4 values
+    decoded = parse_points(["{" + ",".join(map(str, v)) + "}" for v in vectors])
+    np.testing.assert_array_equal(decoded.astype(np.float32), vectors)
+
+    # NULL element
+    value = bytearray(_array_send(vectors[0]))
+    value[20:24] = struct.pack(">i", -1)
+    with pytest.raises(ValueError):
+        decode_float4_arrays_binary([bytes(value)])
+
+    type_ = Float4Array(numpy=True)
+    value = type_.process_bind_param(vectors[0].astype(float), None)
+    assert value == vectors[0].tolist()
+    np.testing.assert_array_equal(type_.process_result_value(value, None), vectors[0])
+    assert type_.process_bind_param(None, None) is None
+    assert Float4Array().process_result_value([1.0, 2.0], None) == (1.0, 2.0)
+
+
+def test_parse_copy_binary():
+    vectors = np.random.default_rng(2).normal(size=(4, 3))
+
+    data = b"PGCOPY\n\377\r\n\0" + struct.pack(">ii", 0, 0)
+    for i, v in enumerate(vectors):
+        data += (
+            struct.pack(">h", 3)
+            + _field(struct.pack(">q", i - 2))
+            + _field(None if i == 1 else "objekt_{}_ä".format(i).encode("utf-8"))
+            + _field(_cube_send(v))
+        )
+    data += struct.pack(">h", -1)
+
+    node_ids, object_ids, points = parse_copy_binary(data, 3)
+
+    assert _decode_binary_column(BigInteger(), node_ids) == [-2, -1, 0, 1]
+    assert _decode_binary_column(String(), object_ids) == [
+        "objekt_0_ä",
+        None,
+        "objekt_2_ä",
+        "objekt_3_ä",
+    ]
+    np.testing.assert_array_equal(decode_points_binary(points), vectors)
+
+    with pytest.raises(ValueError):
+        parse_copy_binary(data, 2)
+
+
+def test_render_copy_query():
+    object_ids = ["a%b", "c'd", "%(x)s", "e%%f"]
+    stmt = select(objects.c.object_id, objects.c.vector).where(
+        (objects.c.object_id == any_(bindparam("ids", object_ids, type_=ARRAY(String))))
+        | objects.c.object_id.in_(object_ids)
+    )
+
+    # The values arrive at the database as they are
+    query = render_copy_query(psycopg2.dialect(), stmt)
+    assert query.startswith("COPY (SELECT")
+    assert query.endswith(") TO STDOUT WITH (FORMAT binary)")
+    for literal in ["'a%b'", "'c''d'", "'%(x)s'", "'e%%f'"]:
+        assert query.count(literal) == 2, query
@@ -0,0 +1,54 @@
+import csv
+import io
+
+import numpy as np
+
+from morphocluster.sql import staging
+from morphocluster.sql.points import parse_copy_binary
+from morphocluster.sql.staging import _BinaryFile, _CSVFile, _encode_vector_rows
+from morphocluster.sql.types import decode_float4_arrays_binary
+
+
+def test_csv_file(monkeypatch):
+    monkeypatch.setattr(staging, "COPY_CHUNK_SIZE", 3)
+
+    rows = [(str(i), i, None if i % 2 else 1.5) for i in range(10)]
+
+    # Read in small pieces like copy_expert does
+    f = _CSVFile(rows)
+    data = ""
+    while True:
+        chunk = f.read(7)
+        if not chunk:
+            break
+        data += chunk
+
+    assert list(csv.reader(io.StringIO(data))) == [
+        [str(i), str(i), "" if i % 2 else "1.5"] for i in range(10)
+    ]
+
+    f = _CSVFile(rows)
+    assert f.readline() == "0,0,1.5\n"
+    assert f.read() == data[len("0,0,1.5\n") :]
+
+
+def test_binary_file(monkeypatch):
+    monkeypatch.setattr(staging, "COPY_CHUNK_SIZE", 3)
+
+    vectors = np.random.default_rng(0).normal(size=(10, 4)).astype(np.float32)
+    object_ids = [str(i) for i in range(10)]
+    paths = [None if i % 2 else "path/{}.jpg".format(i) for i in range(10)]
+
+    # Read in small pieces like copy_expert does
+    f = _BinaryFile(_encode_vector_rows([object_ids, paths], vectors, "f4"))
+    data = b""
+    while True:
+        chunk = f.read(7)
+        if not chunk:
+            break
+        data += chunk
+
+    columns = parse_copy_binary(data, 3)
+    assert [v.decode() for v in columns[0]] == object_ids
+    assert [v if v is None else v.decode() for v in columns[1]] == paths
+    np.testing.assert_array_equal(decode_float4_arrays_binary(columns[2]), vectors)
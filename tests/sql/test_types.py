@@ -44,3 +44,131 @@ def test_point(point_table, db_connection):
     ]
 
     assert values_actual == [v[1] for v in values_target]
+
+
+def test_prototypes_type():
+    import numpy as np
+
+    from morphocluster.processing.prototypes import Prototypes
+    from morphocluster.sql.types import NumpyArray, PrototypesType
+
+    prototypes = Prototypes(None)
+    prototypes.prototypes_ = np.arange(12, dtype=float).reshape((3, 4))
+    prototypes.support_ = np.array([1, 5, 2])
+
+    type_ = PrototypesType()
+    value = type_.process_bind_param(prototypes, None)
+    assert len(value) == 8 + 4 * (3 * 4 + 3)
+
+    decoded = type_.process_result_value(value, None)
+    np.testing.assert_array_equal(decoded.prototypes_, prototypes.prototypes_)
+    np.testing.assert_array_equal(decoded.support_, prototypes.support_)
+
+    # Unfitted prototypes are stored as NULL
+    assert type_.process_bind_param(Prototypes(None), None) is None
+    assert type_.process_result_value(None, None) is None
+
+    type_ = NumpyArray("<f8")
+    vector = np.array([0.5, 1.5, -2.0])
+    value = type_.process_bind_param(vector, None)
+    np.testing.assert_array_equal(type_.process_result_value(value, None), vector)
+
+
+def test_fetch_points(point_table, db_connection):
+    import numpy as np
+    from sqlalchemy import select
+
+    from morphocluster.sql.points import binary_points_supported, fetch_points
+
+    vectors = np.random.default_rng(0).normal(size=(10, 4))
+
+    db_connection.execute(point_table.delete())
+    db_connection.execute(point_table.insert(), [dict(point=v) for v in vectors])
+
+    stmt = select(point_table.c.point)
+
+    _, decoded = fetch_points(db_connection, stmt, binary=False)
+    np.testing.assert_array_equal(decoded, vectors)
+
+    if binary_points_supported(db_connection):
+        _, decoded = fetch_points(db_connection, stmt, binary=True)
+        np.testing.assert_array_equal(decoded, vectors)
+
+
+def test_float4_array(db_connection):
+    import numpy as np
+    from sqlalchemy import MetaData, String, select
+
+    from morphocluster.sql.points import fetch_points
+    from morphocluster.sql.types import Float4Array
+
+    table = Table(
+        "float4_array_table",
+        MetaData(),
+        Column("object_id", String),
+        Column("vector", Float4Array(numpy=True)),
+    )
+    table.create(db_connection)
+
+    try:
+        vectors = np.random.default_rng(0).normal(size=(10, 512)).astype(np.float32)
+        db_connection.execute(
+            table.insert(),
+            [dict(object_id=str(i), vector=v) for i, v in enumerate(vectors)],
+        )
+
+        for binary in (False, True):
+            (object_ids,), decoded = fetch_points(
+                db_connection, select(table.c.object_id, table.c.vector), binary=binary
+            )
+            assert object_ids == [str(i) for i in range(10)]
+            np.testing.assert_array_equal(decoded, vectors)
+
+        query = vectors[3] + 0.01
+        distance = table.c.vector.dist_euclidean(query)
+        stmt = select(table.c.object_id, distance.label("distance")).order_by(distance)
+        closest = db_connection.execute(stmt).first()
+        assert closest.object_id == "3"
+        np.testing.assert_allclose(
+            closest.distance, np.linalg.norm(vectors[3] - query), rtol=1e-5
+        )
+    finally:
+        table.drop(db_connection)
+
+
+def test_fetch_points_percent(db_connection):
+    import numpy as np
+    from sqlalchemy import MetaData, String, select
+
+    from morphocluster.sql.points import fetch_points
+    from morphocluster.sql.types import Float4Array
+
+    table = Table(
+        "float4_percent_table",
+        MetaData(),
+        Column("object_id", String),
+        Column("vector", Float4Array(numpy=True)),
+    )
+    table.create(db_connection)
+
+    try:
+        object_ids = ["a%b", "a%%b", "100%", "%(x)s"]
+        vectors = np.random.default_rng(0).normal(size=(4, 3)).astype(np.float32)
+        db_connection.execute(
+            table.insert(),
+            [dict(object_id=o, vector=v) for o, v in zip(object_ids, vectors)],
+        )
+
+        for binary in (False, True):
+            stmt = (
+                select(table.c.object_id, table.c.vector)
+                .where(table.c.object_id.in_(object_ids[::2]))
+                .order_by(table.c.object_id)
+            )
+            (fetched_ids,), decoded = fetch_points(db_connection, stmt, binary=binary)
+            assert fetched_ids == sorted(object_ids[::2])
+            np.testing.assert_array_equal(
+                decoded, vectors[[object_ids.index(o) for o in fetched_ids]]
+            )
+    finally:
+        table.drop(db_connection)
@@ -0,0 +1,71 @@
+import os
+import zipfile
+
+import pytest
+
+from morphocluster.archive import ArchiveExtractor, member_target
+
+
+@pytest.fixture
+def archive_fn(tmp_path):
+    archive_fn = tmp_path / "objects.zip"
+    with zipfile.ZipFile(archive_fn, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("index.csv", "object_id,path\n")
+        for i in range(100):
+            zf.writestr(f"images/{i % 3}/{i}.jpg", bytes([i]) * (i + 1))
+    return archive_fn
+
+
+def test_extract(tmp_path, archive_fn):
+    target_dir = tmp_path / "images"
+    reports = []
+
+    with ArchiveExtractor(
+        archive_fn,
+        n_workers=4,
+        max_pending=8,
+        callback=lambda e: reports.append(e.n_extracted),
+        callback_interval=0,
+    ) as extractor:
+        assert "images/0/0.jpg" in extractor
+        assert "images/0/1.jpg" not in extractor
+
+        for i in range(100):
+            # Flat target path
+            extractor.extract(f"images/{i % 3}/{i}.jpg", target_dir / f"{i}.jpg")
+
+        with pytest.raises(KeyError):
+            extractor.extract("missing.jpg", target_dir / "missing.jpg")
+
+    assert sorted(p.name for p in target_dir.iterdir()) == sorted(
+        f"{i}.jpg" for i in range(100)
+    )
+    for i in range(100):
+        assert (target_dir / f"{i}.jpg").read_bytes() == bytes([i]) * (i + 1)
+
+    stats = extractor.stats()
+    assert stats["n_extracted"] == 100
+    assert stats["n_bytes"] == sum(range(1, 101))
+    assert reports[-1] == 100
+
+
+def test_extract_error(tmp_path, archive_fn):
+    # The target directory is a file
+    (tmp_path / "file").touch()
+
+    with pytest.raises(OSError):
+        with ArchiveExtractor(archive_fn, n_workers=2) as extractor:
+            extractor.extract("images/0/0.jpg", tmp_path / "file" / "0.jpg")
+
+
+def test_member_target(tmp_path):
+    target_dir = str(tmp_path / "images")
+
+    assert member_target(target_dir, "a/b.jpg") == os.path.join(
+        target_dir, "a", "b.jpg"
+    )
+    assert member_target(target_dir, "a/../b.jpg") == os.path.join(target_dir, "b.jpg")
+
+    for name in ["../evil", "a/../../evil", "/evil", "", "."]:
+        with pytest.raises(ValueError):
+            member_target(target_dir, name)
@@ -1,5 +1,7 @@
+import os
 import re
 import uuid
+import zipfile
 
 from flask.app import Flask
 
@@ -20,6 +22,18 @@ def test_load(flask_app, datadir):
     match = re.search(r"Done\.", result.output)
     assert match is not None, result.output
 
+    # Loading the same archive again only re-extracts the images
+    result = runner.invoke(
+        args=[
+            "load-objects",
+            str(datadir / "example" / "objects.zip"),
+        ],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    assert "Added" not in result.output, result.output
+    assert "Changed the path of 0 existing objects." in result.output, result.output
+
     # Load features
     result = runner.invoke(
         args=[
@@ -33,6 +47,9 @@ def test_load(flask_app, datadir):
     match = re.search(r"Done\.", result.output)
     assert match is not None, result.output
 
+    # All features belong to loaded objects
+    assert "do not exist" not in result.output, result.output
+
     # Load project
     result = runner.invoke(
         args=[
@@ -74,3 +91,20 @@ def test_user(flask_app: Flask):
 
     match = re.search(re.escape(f"User {username} changed."), result.output)
     assert match is not None, result.output
+
+
+def test_load_objects_outside_images_dir(flask_app, tmp_path):
+    runner = flask_app.test_cli_runner()
+
+    name = f"evil_{uuid.uuid4().hex}.jpg"
+    archive_fn = tmp_path / "evil.zip"
+    with zipfile.ZipFile(archive_fn, "w") as zf:
+        zf.writestr("index.csv", f"object_id,path\n{name},../{name}\n")
+        zf.writestr(f"../{name}", b"evil")
+
+    result = runner.invoke(args=["load-objects", str(archive_fn)])
+    assert result.exit_code != 0, result.output
+    assert isinstance(result.exception, ValueError), result.exception
+
+    images_dir = flask_app.config["IMAGES_DIR"]
+    assert not os.path.exists(os.path.join(images_dir, "..", name))
@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+
+from morphocluster import feature_store
+from morphocluster.feature_store import (
+    FeatureStore,
+    get_feature_store,
+    write_feature_store,
+)
+
+
+def test_feature_store(tmp_path):
+    path = str(tmp_path / "features")
+
+    assert get_feature_store(path) is None
+
+    vectors = np.arange(12, dtype=np.float32).reshape((4, 3))
+    store = write_feature_store(path, ["d", "b", "a", "c"], vectors)
+
+    assert len(store) == 4
+    assert store.n_features == 3
+    np.testing.assert_array_equal(store.rows(["a", "x", "d", "zz"]), [0, -1, 3, -1])
+
+    found_vectors, found = store.get(["c", "x", "d"])
+    np.testing.assert_array_equal(found, [True, False, True])
+    np.testing.assert_array_equal(found_vectors[found], vectors[[3, 0]])
+
+    # Merge: New vectors replace existing ones
+    write_feature_store(path, ["a", "e"], np.full((2, 3), -1, dtype=np.float32))
+    store = get_feature_store(path)
+    assert len(store) == 5
+    np.testing.assert_array_equal(store.get(["a", "b", "e"])[0][:, 0], [-1, 3, -1])
+
+    # Unchanged stores are cached
+    assert get_feature_store(path) is store
+
+    # Different dimensionality
+    with pytest.raises(ValueError):
+        write_feature_store(path, ["f"], np.zeros((1, 2), dtype=np.float32))
+
+    store = write_feature_store(
+        path, ["f"], np.zeros((1, 2), dtype=np.float32), clear=True
+    )
+    assert len(store) == 1
+    assert store.n_features == 2
+
+
+def test_feature_store_empty(tmp_path):
+    path = str(tmp_path / "features")
+
+    store = write_feature_store(path, [], np.zeros((0, 3), dtype=np.float32))
+    assert len(store) == 0
+    np.testing.assert_array_equal(store.rows(["a"]), [-1])
+
+    assert len(FeatureStore(path)) == 0
+
+
+def test_feature_store_version(tmp_path, monkeypatch):
+    path = str(tmp_path / "features")
+
+    vectors = np.arange(6, dtype=np.float32).reshape((2, 3))
+    store = write_feature_store(path, ["a", "b"], vectors, version=1)
+    assert store.version == 1
+
+    # The store is up to date: Merge
+    store = write_feature_store(
+        path, ["c"], np.zeros((1, 3), dtype=np.float32), version=2, base_version=1
+    )
+    assert store.version == 2
+    assert len(store) == 3
+
+    # The store is outdated: Its contents are discarded
+    store = write_feature_store(
+        path, ["d"], np.zeros((1, 3), dtype=np.float32), version=4, base_version=3
+    )
+    assert store.version == 4
+    np.testing.assert_array_equal(store.rows(["a", "d"]), [-1, 0])
+
+    # Stores of another version of the vectors in the database are ignored
+    monkeypatch.setattr(feature_store, "get_vectors_version", lambda connection: 5)
+    assert get_feature_store(path, connection=object()) is None
+
+    monkeypatch.setattr(feature_store, "get_vectors_version", lambda connection: 4)
+    assert get_feature_store(path, connection=object()).version == 4
+
+
+def test_feature_store_merge_chunks(tmp_path, monkeypatch):
+    path = str(tmp_path / "features")
+
+    monkeypatch.setattr(feature_store, "MERGE_CHUNK_SIZE", 3)
+
+    rng = np.random.default_rng(0)
+    object_ids = ["{:03d}".format(i) for i in range(0, 100, 2)]
+    vectors = rng.random((len(object_ids), 4), dtype=np.float32)
+    write_feature_store(path, object_ids, vectors)
+
+    new_object_ids = ["{:03d}".format(i) for i in range(0, 100, 3)]
+    new_vectors = rng.random((len(new_object_ids), 4), dtype=np.float32)
+    store = write_feature_store(path, new_object_ids, new_vectors)
+
+    expected = dict(zip(object_ids, vectors))
+    expected.update(zip(new_object_ids, new_vectors))
+
+    assert len(store) == len(expected)
+    np.testing.assert_array_equal(
+        store.object_ids, np.char.encode(sorted(expected), "utf-8")
+    )
+    np.testing.assert_array_equal(
+        store.vectors, [expected[object_id] for object_id in sorted(expected)]
+    )
+
+
+def test_feature_store_tolerance(tmp_path):
+    path = str(tmp_path / "features")
+
+    # The database stores float64 vectors (cube)
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(scale=100, size=(100, 8))
+    store = write_feature_store(path, [str(i) for i in range(100)], vectors)
+
+    assert store.vectors.dtype == np.float32
+    np.testing.assert_allclose(
+        store.get([str(i) for i in range(100)])[0], vectors, rtol=2**-24, atol=0
+    )
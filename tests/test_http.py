@@ -1,5 +1,13 @@
+import uuid
+
+import numpy as np
+import pytest
 from requests.auth import _basic_auth_str
 
+from morphocluster.extensions import database
+from morphocluster.loading import insert_objects
+from morphocluster.tree import Tree
+
 
 def test_auth(flask_client):
     # A request without authorization should fail with 401
@@ -10,3 +18,38 @@ def test_auth(flask_client):
     headers = {"Authorization": _basic_auth_str("test_user", "test_user")}
     response = flask_client.get("/", headers=headers)
     assert response.status_code != 401
+
+
+@pytest.mark.parametrize("endpoint", ["recommended_objects", "recommended_children"])
+def test_progressive_first_page(flask_client, endpoint):
+    rng = np.random.default_rng(0)
+    prefix = uuid.uuid4().hex
+
+    object_ids = [f"{prefix}_{i}" for i in range(1500)]
+    vectors = rng.normal(size=(len(object_ids), 8)).astype(np.float32)
+
+    with database.engine.begin() as connection:
+        insert_objects(connection, object_ids, object_ids, vectors)
+
+        tree = Tree(connection)
+        project_id = tree.create_project(prefix)
+        root_id = tree.create_node(project_id, object_ids=object_ids[:1200])
+        child_ids = [
+            tree.create_node(
+                project_id,
+                parent_id=root_id,
+                object_ids=object_ids[1200 + 10 * i : 1210 + 10 * i],
+            )
+            for i in range(30)
+        ]
+        tree.consolidate_node(root_id, depth="full")
+
+    headers = {"Authorization": _basic_auth_str("test_user", "test_user")}
+    url = f"/api/nodes/{child_ids[0]}/{endpoint}"
+
+    full = flask_client.get(url, headers=headers)
+    progressive = flask_client.get(url + "?progressive=1", headers=headers)
+    assert full.status_code == progressive.status_code == 200
+
+    # The first page of the progressive result is the first page of the full result
+    assert progressive.json["data"] == full.json["data"]
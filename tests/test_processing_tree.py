@@ -0,0 +1,110 @@
+import pandas as pd
+import pytest
+
+from morphocluster import processing
+
+
+@pytest.mark.parametrize("format", ["csv", "parquet"])
+def test_save_from_saved(tmp_path, format):
+    if format == "parquet":
+        pytest.importorskip("pyarrow")
+
+    tree = processing.Tree(
+        pd.DataFrame(
+            {"node_id": [1, 2], "parent_id": [None, 1], "name": ["a,b", None]}
+        ),
+        pd.DataFrame({"node_id": [1, 2, 2], "object_id": ["001", "002", "x"]}),
+        meta={"foo": "bar"},
+    )
+
+    tree_fn = tmp_path / "tree.zip"
+    tree.save(tree_fn, format=format)
+
+    loaded = processing.Tree.from_saved(tree_fn)
+    pd.testing.assert_frame_equal(loaded.nodes, tree.nodes, check_dtype=False)
+    pd.testing.assert_frame_equal(loaded.objects, tree.objects)
+    assert loaded.rejected_objects is None
+    assert loaded.meta["foo"] == "bar"
+
+    # Only selected tables and columns
+    loaded = processing.Tree.from_saved(
+        tree_fn, tables=("nodes",), columns={"nodes": ["node_id", "parent_id"]}
+    )
+    assert list(loaded.nodes.columns) == ["node_id", "parent_id"]
+    assert loaded.objects is None
+
+
+def test_to_flat():
+    #      1
+    #    /   \
+    #   2 a   3
+    #  / \     \
+    # 4 b  5    6 c
+    tree = processing.Tree(
+        pd.DataFrame(
+            {
+                "node_id": [6, 5, 4, 3, 2, 1],
+                "parent_id": [3, 2, 2, 1, 1, None],
+                "name": ["c", None, "a/b", None, "a", None],
+            }
+        ),
+        pd.DataFrame(
+            {
+                "node_id": [1, 2, 3, 4, 5, 6],
+                "object_id": ["o1", "o2", "o3", "o4", "o5", "o6"],
+            }
+        ),
+    )
+
+    flat = tree.to_flat()
+    assert dict(zip(flat["object_id"], flat["label"])) == {
+        "o2": "a",
+        "o3": "",
+        "o4": "a/b",
+        "o5": "a",
+        "o6": "",
+    }
+
+    flat = tree.to_flat(clean_name=False)
+    assert dict(zip(flat["object_id"], flat["label"])) == {
+        "o2": "/a",
+        "o3": "",
+        "o4": "a/a/b",
+        "o5": "a",
+        "o6": "",
+    }
+
+    assert [list(path) for path, _ in tree.walk()] == [[], [1], [1, 2], [1, 3]]
+    assert tree.get_path(4) == [1, 2]
+
+
+def test_index_in_place_changes():
+    #   1
+    #  / \
+    # 2   3
+    tree = processing.Tree(
+        pd.DataFrame({"node_id": [1, 2, 3], "parent_id": [None, 1, 1]}),
+        pd.DataFrame({"node_id": [1, 2, 3], "object_id": ["o1", "o2", "o3"]}),
+    )
+
+    assert tree.get_path(3) == [1]
+
+    # Move 3 below 2
+    tree.nodes.loc[tree.nodes["node_id"] == 3, "parent_id"] = 2
+    assert tree.get_path(3) == [1, 2]
+    assert [list(path) for path, _ in tree.walk()] == [[], [1], [1, 2]]
+
+    # Other columns do not matter
+    tree.nodes["approved"] = False
+    assert tree.get_path(3) == [1, 2]
+
+    # Renumber
+    tree.nodes["node_id"] += 10
+    tree.nodes["parent_id"] += 10
+    assert tree.get_path(13) == [11, 12]
+
+    tree.nodes = pd.concat(
+        (tree.nodes, pd.DataFrame({"node_id": [14], "parent_id": [13]})),
+        ignore_index=True,
+    )
+    assert tree.get_path(14) == [11, 12, 13]
@@ -0,0 +1,81 @@
+import numpy as np
+from scipy.spatial.distance import cdist
+from sklearn.cluster import KMeans
+
+from morphocluster.processing.prototypes import Prototypes, merge_prototypes
+
+
+def _fit(X, k=4, seed=0):
+    prototypes = Prototypes(KMeans(k, n_init=1, random_state=seed))
+    prototypes.fit(X)
+    return prototypes
+
+
+def _assert_covers(prototypes, X):
+    # Every vector lies within the radius of some prototype
+    dist = cdist(X, prototypes.prototypes_)
+    assert np.all(np.any(dist <= prototypes.radii_ + 1e-9, axis=1))
+
+
+def test_prototypes_radii():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(200, 8))
+
+    prototypes = _fit(X[:100])
+    _assert_covers(prototypes, X[:100])
+
+    prototypes.expand_radii(X[100:])
+    _assert_covers(prototypes, X)
+
+    # Few samples and a single prototype
+    _assert_covers(_fit(X[:3]), X[:3])
+    _assert_covers(_fit(X, k=1), X)
+
+
+def test_prototypes_lower_bound():
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(300, 8))
+    queries = rng.normal(size=(20, 8)) * 3
+
+    prototypes = _fit(X)
+    bound = prototypes.lower_bound(queries)
+    assert np.all(bound <= cdist(queries, X).min(axis=1))
+    assert np.any(bound > 0)
+
+    # The bound survives the float32 serialization
+    decoded = Prototypes.from_bytes(prototypes.to_bytes())
+    assert np.all(decoded.lower_bound(queries) <= cdist(queries, X).min(axis=1))
+
+    # Without radii, nothing is known
+    del decoded.radii_
+    np.testing.assert_array_equal(decoded.lower_bound(queries), 0)
+
+
+def test_prototypes_bytes_without_radii():
+    prototypes = Prototypes(None)
+    prototypes.prototypes_ = np.arange(12, dtype=float).reshape((3, 4))
+    prototypes.support_ = np.array([1, 5, 2])
+
+    decoded = Prototypes.from_bytes(prototypes.to_bytes())
+    assert getattr(decoded, "radii_", None) is None
+
+    prototypes.radii_ = np.array([0.5, 1, 2])
+    decoded = Prototypes.from_bytes(prototypes.to_bytes())
+    np.testing.assert_array_equal(decoded.radii_, prototypes.radii_)
+
+
+def test_merge_prototypes_radii():
+    rng = np.random.default_rng(2)
+    Xs = [rng.normal(loc=i, size=(100, 8)) for i in range(6)]
+
+    merged = merge_prototypes([_fit(X, seed=i) for i, X in enumerate(Xs)], 5)
+    _assert_covers(merged, np.concatenate(Xs))
+
+    # Fewer prototypes than k
+    merged = merge_prototypes([_fit(X, k=2) for X in Xs[:2]], 5)
+    _assert_covers(merged, np.concatenate(Xs[:2]))
+
+    # Radii are unknown if unknown for one of the children
+    children = [_fit(X) for X in Xs]
+    children[0].radii_ = None
+    assert merge_prototypes(children, 5).radii_ is None
@@ -0,0 +1,134 @@
+import numpy as np
+
+from morphocluster.topology import Topology
+
+
+def _topology():
+    #       10
+    #      /  \
+    #    20    30*
+    #   /  \     \
+    #  40   50    60
+    #  |
+    #  70
+    return Topology(
+        1,
+        0,
+        node_ids=[70, 60, 50, 40, 30, 20, 10],
+        parent_ids=[40, 30, 20, 20, 10, 10, -1],
+        approved=[False] * 7,
+        starred=[False, False, False, False, True, False, False],
+        filled=[False] * 7,
+        preferred=[False] * 7,
+    )
+
+
+def test_topology():
+    topology = _topology()
+
+    assert topology.get_path_ids(70) == [10, 20, 40, 70]
+    assert topology.get_path_ids(10) == [10]
+    assert sorted(topology.get_children_ids(20)) == [40, 50]
+    assert topology.get_children_ids(70) == []
+
+    depth = dict(zip(topology.node_ids.tolist(), topology.depth.tolist()))
+    assert depth == {10: 0, 20: 1, 30: 1, 40: 2, 50: 2, 60: 2, 70: 3}
+
+    assert 30 in topology
+    assert 35 not in topology
+
+    subtree = topology.node_ids[topology.subtree(20)]
+    assert sorted(subtree.tolist()) == [20, 40, 50, 70]
+
+    # Do not descend into starred nodes
+    subtree = topology.node_ids[topology.subtree(10, ~topology.starred)]
+    assert sorted(subtree.tolist()) == [10, 20, 40, 50, 70]
+
+
+def test_topology_get_tip():
+    topology = _topology()
+
+    assert topology.get_tip(10) == 40
+    assert topology.get_tip(30) == 30
+    assert topology.get_tip(70) is None
+
+    topology.approved[np.searchsorted(topology.node_ids, 40)] = True
+    assert topology.get_tip(10) == 20
+
+
+def _baseline_superparents(node_ids, parent_ids, starred, root_id):
+    # The recursive walk of the previous Tree.connect_supertree:
+    # For the root and every starred descendant, assign it to all nodes
+    # that are reachable by descending only from nodes that are not starred.
+    children = {}
+    for node_id, parent_id in zip(node_ids, parent_ids):
+        children.setdefault(parent_id, []).append(node_id)
+    starred = dict(zip(node_ids, starred))
+
+    def walk(node_id, recurse_cb):
+        successors = [node_id]
+        for successor_id in successors:
+            if recurse_cb(successor_id):
+                successors.extend(children.get(successor_id, []))
+        return successors
+
+    supersuccessor_ids = [
+        n for n in walk(root_id, lambda _: True) if starred[n] and n != root_id
+    ]
+    supersuccessor_ids.insert(0, root_id)
+
+    superparents = {}
+    for node_id in supersuccessor_ids:
+        for successor_id in walk(node_id, lambda n: not starred[n]):
+            if successor_id != node_id:
+                superparents[successor_id] = node_id
+    return superparents
+
+
+def _superparents(topology, node_id):
+    idx, superparent_idx = topology.superparents(node_id)
+    return dict(
+        zip(
+            topology.node_ids[idx].tolist(),
+            topology.node_ids[superparent_idx].tolist(),
+        )
+    )
+
+
+def test_topology_superparents():
+    topology = _topology()
+
+    # Nodes below the starred 30 are not connected
+    assert _superparents(topology, 10) == {20: 10, 30: 10, 40: 10, 50: 10, 70: 10}
+    assert _superparents(topology, 20) == {40: 20, 50: 20, 70: 20}
+
+    # Starred roots are not connected
+    assert _superparents(topology, 30) == {}
+
+
+def test_topology_superparents_baseline():
+    rng = np.random.default_rng(0)
+
+    for _ in range(20):
+        n_nodes = 200
+        node_ids = rng.permutation(np.arange(1, n_nodes + 1) * 7).tolist()
+        # Random tree with node_ids[0] as the root
+        parent_ids = [-1] + [node_ids[rng.integers(i)] for i in range(1, n_nodes)]
+        # Nested starred nodes
+        starred = (rng.random(n_nodes) < 0.2).tolist()
+
+        topology = Topology(
+            1,
+            0,
+            node_ids=node_ids,
+            parent_ids=parent_ids,
+            approved=[False] * n_nodes,
+            starred=starred,
+            filled=[False] * n_nodes,
+            preferred=[False] * n_nodes,
+        )
+
+        for root_id in [node_ids[0]] + node_ids[1:5]:
+            assert _superparents(topology, root_id) == _baseline_superparents(
+                node_ids, parent_ids, starred, root_id
+            )
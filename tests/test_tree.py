@@ -0,0 +1,52 @@
+import pandas as pd
+
+from morphocluster.tree import _aggregate_progress
+
+
+def test_aggregate_progress():
+    #     1
+    #    / \
+    #   2   3
+    #  / \
+    # 4   5
+    subtree = pd.DataFrame(
+        {
+            "node_id": [4, 5, 2, 3, 1],
+            "parent_id": [2, 2, 1, 1, None],
+            "level": [2, 2, 1, 1, 0],
+            "n_approved_objects": [3, 0, 0, 5, 0],
+            "n_named_objects": [3, 4, 10, 0, 0],
+            "n_approved_nodes": [1, 0, 0, 1, 0],
+            "n_filled_nodes": [0, 1, 0, 0, 0],
+            "n_nodes": [1, 1, 1, 1, 1],
+        }
+    ).set_index("node_id")
+
+    _aggregate_progress(subtree)
+
+    assert subtree.loc[2].to_dict() == {
+        "parent_id": 1,
+        "level": 1,
+        "n_approved_objects": 3,
+        "n_named_objects": 10,
+        "n_approved_nodes": 1,
+        "n_filled_nodes": 1,
+        "n_nodes": 3,
+    }
+
+    assert subtree.loc[
+        1,
+        [
+            "n_approved_objects",
+            "n_named_objects",
+            "n_approved_nodes",
+            "n_filled_nodes",
+            "n_nodes",
+        ],
+    ].to_dict() == {
+        "n_approved_objects": 8,
+        "n_named_objects": 10,
+        "n_approved_nodes": 2,
+        "n_filled_nodes": 1,
+        "n_nodes": 5,
+    }
@@ -0,0 +1,342 @@
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import numpy as np
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.pool import NullPool
+
+from morphocluster import processing
+from morphocluster.extensions import database
+from morphocluster.loading import get_vectors_version, insert_objects, load_vectors
+from morphocluster.models import nodes
+from morphocluster.tree import CONSOLIDATE_SAMPLE_SIZE, Tree, TreeError
+
+
+@pytest.fixture
+def connection(flask_app):
+    with database.engine.connect() as connection:
+        transaction = connection.begin()
+        yield connection
+        transaction.rollback()
+
+
+def _aggregates(connection, project_id):
+    stmt = select(
+        nodes.c.node_id,
+        nodes.c._n_objects_deep,
+        nodes.c._vector_sum,
+        nodes.c._centroid,
+    ).where(nodes.c.project_id == project_id)
+
+    return {r.node_id: r for r in connection.execute(stmt)}
+
+
+def test_incremental_aggregates(connection):
+    rng = np.random.default_rng(0)
+    prefix = uuid.uuid4().hex
+
+    # The root has more objects than are sampled during the consolidation
+    sizes = {"root": CONSOLIDATE_SAMPLE_SIZE + 200, "a": 300, "b": 50, "c": 20}
+    object_ids = {
+        name: [f"{prefix}_{name}_{i}" for i in range(n)] for name, n in sizes.items()
+    }
+    all_object_ids = sum(object_ids.values(), [])
+    vectors = rng.normal(size=(len(all_object_ids), 8)).astype(np.float32)
+    insert_objects(connection, all_object_ids, all_object_ids, vectors)
+
+    tree = Tree(connection)
+    project_id = tree.create_project(prefix)
+    root_id = tree.create_node(project_id, object_ids=object_ids["root"])
+    a_id = tree.create_node(project_id, parent_id=root_id, object_ids=object_ids["a"])
+    b_id = tree.create_node(project_id, parent_id=root_id, object_ids=object_ids["b"])
+    c_id = tree.create_node(project_id, parent_id=a_id, object_ids=object_ids["c"])
+
+    tree.consolidate_node(root_id, depth="full")
+
+    # The vector sum of the root is exact
+    root = _aggregates(connection, project_id)[root_id]
+    np.testing.assert_allclose(
+        root._vector_sum, vectors.sum(axis=0, dtype=float), rtol=1e-9, atol=1e-9
+    )
+
+    # Move most own objects out of the root, a subtree to another parent
+    # and objects back into the root
+    tree.relocate_objects(object_ids["root"][:-10], b_id)
+    tree.relocate_nodes([c_id], b_id)
+    tree.relocate_objects(object_ids["a"][:100], root_id)
+    tree.relocate_objects(object_ids["c"][:5], a_id)
+
+    incremental = _aggregates(connection, project_id)
+
+    # Recompute everything
+    stmt = (
+        nodes.update().values(cache_valid=False).where(nodes.c.project_id == project_id)
+    )
+    connection.execute(stmt)
+    tree.consolidate_node(root_id, depth="full")
+
+    recomputed = _aggregates(connection, project_id)
+
+    assert incremental.keys() == recomputed.keys()
+    for node_id, expected in recomputed.items():
+        actual = incremental[node_id]
+        assert actual._n_objects_deep == expected._n_objects_deep
+        np.testing.assert_allclose(
+            actual._vector_sum, expected._vector_sum, rtol=1e-6, atol=1e-6
+        )
+        np.testing.assert_allclose(
+            actual._centroid, expected._centroid, rtol=1e-5, atol=1e-5
+        )
+
+    # Nothing was lost on the way
+    assert recomputed[root_id]._n_objects_deep == len(all_object_ids)
+    np.testing.assert_allclose(
+        recomputed[root_id]._vector_sum,
+        vectors.sum(axis=0, dtype=float),
+        rtol=1e-9,
+        atol=1e-9,
+    )
+
+
+def test_load_vectors_invalidates_nodes(connection):
+    rng = np.random.default_rng(1)
+    prefix = uuid.uuid4().hex
+
+    object_ids = [f"{prefix}_{i}" for i in range(30)]
+    vectors = rng.normal(size=(len(object_ids), 8)).astype(np.float32)
+    insert_objects(connection, object_ids, object_ids, vectors)
+
+    tree = Tree(connection)
+    project_id = tree.create_project(prefix)
+    root_id = tree.create_node(project_id, object_ids=object_ids[:10])
+    a_id = tree.create_node(project_id, parent_id=root_id, object_ids=object_ids[10:20])
+    b_id = tree.create_node(project_id, parent_id=root_id, object_ids=object_ids[20:])
+
+    tree.consolidate_node(root_id, depth="full")
+
+    # Reloading unchanged vectors keeps the cached values
+    load_vectors(connection, object_ids, vectors)
+    stmt = select(nodes.c.node_id, nodes.c.cache_valid, nodes.c.prototypes_valid).where(
+        nodes.c.project_id == project_id
+    )
+    assert all(r.cache_valid and r.prototypes_valid for r in connection.execute(stmt))
+
+    # Change the vectors of objects in a
+    vectors[10:15] += 1
+    load_vectors(connection, object_ids, vectors)
+
+    valid = {
+        r.node_id: (r.cache_valid, r.prototypes_valid) for r in connection.execute(stmt)
+    }
+    assert valid == {
+        root_id: (False, False),
+        a_id: (False, False),
+        b_id: (True, True),
+    }
+
+    tree.consolidate_node(root_id, depth="full")
+    root = _aggregates(connection, project_id)[root_id]
+    np.testing.assert_allclose(
+        root._vector_sum, vectors.sum(axis=0, dtype=float), rtol=1e-9, atol=1e-9
+    )
+
+
+def test_load_vectors_advances_version(connection):
+    rng = np.random.default_rng(3)
+    prefix = uuid.uuid4().hex
+
+    object_ids = [f"{prefix}_{i}" for i in range(10)]
+    vectors = rng.normal(size=(len(object_ids), 8)).astype(np.float32)
+
+    version = get_vectors_version(connection)
+
+    # Inserting objects does not change existing vectors
+    insert_objects(connection, object_ids, object_ids, vectors)
+    assert get_vectors_version(connection) == version
+
+    load_vectors(connection, object_ids, vectors + 1)
+    assert get_vectors_version(connection) > version
+
+
+def test_recommend_objects_after_load_vectors(connection):
+    rng = np.random.default_rng(2)
+    prefix = uuid.uuid4().hex
+
+    object_ids = [f"{prefix}_{i}" for i in range(400)]
+    vectors = rng.normal(size=(len(object_ids), 8)).astype(np.float32)
+    insert_objects(connection, object_ids, object_ids, vectors)
+
+    tree = Tree(connection)
+    project_id = tree.create_project(prefix)
+    root_id = tree.create_node(project_id, object_ids=object_ids[:350])
+    child_id = tree.create_node(
+        project_id, parent_id=root_id, object_ids=object_ids[350:]
+    )
+
+    tree.consolidate_node(root_id, depth="full")
+
+    # Move objects of the root towards the child. The radii of the root become stale.
+    vectors[:350:2] = vectors[350:].mean(axis=0) + 0.01 * vectors[:350:2]
+    load_vectors(connection, object_ids, vectors)
+
+    prots = tree.get_node(child_id, refresh_prototypes=True)["_prototypes"]
+
+    # No bounds are derived from the stale prototypes of the root
+    bounds = tree._recommend_bounds([root_id], prots)
+    assert not bounds.any()
+
+    # Same result as without pruning
+    result = tree.recommend_objects(child_id, max_n=50)
+
+    distances = np.linalg.norm(
+        vectors[:350, np.newaxis].astype(float) - prots.prototypes_[np.newaxis],
+        axis=-1,
+    ).min(axis=1)
+    expected = np.sort(distances)[:50]
+
+    np.testing.assert_allclose(
+        [r["distance"] for r in result], expected, rtol=1e-5, atol=1e-5
+    )
+
+
+def test_recommend_limit(connection):
+    rng = np.random.default_rng(4)
+    prefix = uuid.uuid4().hex
+
+    object_ids = [f"{prefix}_{i}" for i in range(1200)]
+    vectors = rng.normal(size=(len(object_ids), 8)).astype(np.float32)
+    insert_objects(connection, object_ids, object_ids, vectors)
+
+    tree = Tree(connection)
+    project_id = tree.create_project(prefix)
+    root_id = tree.create_node(project_id, object_ids=object_ids[:600])
+    a_id = tree.create_node(project_id, parent_id=root_id, object_ids=object_ids[800:])
+    child_ids = [
+        tree.create_node(
+            project_id,
+            parent_id=a_id,
+            object_ids=object_ids[600 + 20 * i : 620 + 20 * i],
+        )
+        for i in range(10)
+    ]
+
+    tree.consolidate_node(root_id, depth="full")
+
+    # The limited result is a prefix of the full result,
+    # although fewer candidates would suffice for a smaller max_n
+    for method in ("exact", "ann"):
+        full = tree.recommend_objects(child_ids[0], max_n=1000, method=method)
+        limited = tree.recommend_objects(
+            child_ids[0], max_n=1000, method=method, limit=50
+        )
+        assert [o["object_id"] for o in limited] == [o["object_id"] for o in full[:50]]
+
+    full = tree.recommend_children(child_ids[0], max_n=1000)
+    limited = tree.recommend_children(child_ids[0], max_n=1000, limit=5)
+    assert [n["node_id"] for n in limited] == [n["node_id"] for n in full[:5]]
+
+
+def test_export_tree_unreachable_objects(connection, tmp_path):
+    rng = np.random.default_rng(5)
+    prefix = uuid.uuid4().hex
+
+    object_ids = [f"{prefix}_{i}" for i in range(30)]
+    vectors = rng.normal(size=(len(object_ids), 8)).astype(np.float32)
+    insert_objects(connection, object_ids, object_ids, vectors)
+
+    tree = Tree(connection)
+    project_id = tree.create_project(prefix)
+    root_id = tree.create_node(project_id, object_ids=object_ids[:10])
+    tree.create_node(project_id, parent_id=root_id, object_ids=object_ids[10:20])
+
+    # A node without a parent is not reachable from the root
+    tree.create_node(project_id, object_ids=object_ids[20:])
+
+    tree_fn = str(tmp_path / "tree.zip")
+    with pytest.warns(UserWarning, match="10 objects"):
+        tree.export_tree(root_id, tree_fn)
+
+    exported = processing.Tree.from_saved(tree_fn)
+    assert sorted(exported.objects["object_id"]) == sorted(object_ids[:20])
+
+    with pytest.warns(UserWarning, match="10 objects"):
+        tree.dump_tree(root_id)
+
+
+def test_relocate_objects_concurrently(flask_app):
+    rng = np.random.default_rng(0)
+    prefix = uuid.uuid4().hex
+
+    # The application engine shares a single connection
+    engine = create_engine(database.engine.url, poolclass=NullPool)
+
+    object_ids = [f"{prefix}_{i}" for i in range(30)]
+    vectors = rng.normal(size=(len(object_ids), 8)).astype(np.float32)
+
+    with engine.begin() as connection:
+        insert_objects(connection, object_ids, object_ids, vectors)
+
+        tree = Tree(connection)
+        project_id = tree.create_project(prefix)
+        root_id = tree.create_node(project_id, object_ids=object_ids)
+        a_id = tree.create_node(project_id, parent_id=root_id)
+        b_id = tree.create_node(project_id, parent_id=root_id)
+        tree.consolidate_node(root_id, depth="full")
+
+    def relocate_b():
+        with engine.begin() as connection_b:
+            Tree(connection_b).relocate_objects(object_ids[10:], b_id)
+
+    with engine.connect() as connection_a, ThreadPoolExecutor(1) as executor:
+        transaction_a = connection_a.begin()
+        Tree(connection_a).relocate_objects(object_ids[:20], a_id)
+
+        # The second relocation waits until the first is committed
+        future_b = executor.submit(relocate_b)
+        with pytest.raises(FutureTimeoutError):
+            future_b.result(timeout=1.0)
+
+        transaction_a.commit()
+        future_b.result(timeout=30)
+
+    with engine.connect() as connection:
+        aggregates = _aggregates(connection, project_id)
+
+    vectors = vectors.astype(float)
+    for node_id, node_vectors in [
+        (root_id, vectors),
+        (a_id, vectors[:10]),
+        (b_id, vectors[10:]),
+    ]:
+        assert aggregates[node_id]._n_objects_deep == len(node_vectors)
+        np.testing.assert_allclose(
+            aggregates[node_id]._vector_sum, node_vectors.sum(axis=0), rtol=1e-6
+        )
+
+    engine.dispose()
+
+
+def test_topology_changed_by_other_connection(flask_app):
+    prefix = uuid.uuid4().hex
+
+    with database.engine.connect() as connection:
+        tree = Tree(connection)
+
+        with connection.begin():
+            project_id = tree.create_project(prefix)
+            root_id = tree.create_node(project_id)
+
+        assert tree.get_path_ids(root_id) == [root_id]
+
+        # Another connection changes the tree
+        with database.engine.begin() as other_connection:
+            child_id = Tree(other_connection).create_node(project_id, parent_id=root_id)
+
+        # The long-lived tree sees the change
+        assert tree.get_path_ids(child_id) == [root_id, child_id]
+        assert tree.get_children_ids(root_id) == [child_id]
+
+        with pytest.raises(TreeError):
+            tree.get_path_ids(-1)
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from morphocluster.vector_index import VectorIndex, _hnswlib
+
+
+@pytest.mark.parametrize("backend", ["sklearn", "hnswlib"])
+def test_vector_index_search(backend):
+    if backend == "hnswlib" and _hnswlib() is None:
+        pytest.skip("hnswlib is not installed")
+
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(500, 8))
+    object_ids = ["o{}".format(i) for i in range(len(vectors))]
+
+    index = VectorIndex(1, 0, object_ids, vectors, backend=backend)
+
+    prototypes = vectors[[3, 7]] + 0.01
+    found_ids, distances = index.search(prototypes, 5)
+
+    # Sorted by distance and containing the objects next to the prototypes
+    assert np.all(np.diff(distances) >= 0)
+    assert set(found_ids[:2]) == {"o3", "o7"}
+
+    # Minimum distance to any prototype
+    i = object_ids.index(found_ids[-1])
+    expected = np.linalg.norm(vectors[i] - prototypes, axis=1).min()
+    np.testing.assert_allclose(distances[-1], expected, rtol=1e-4)
+
+    # k larger than the index
+    found_ids, _ = index.search(prototypes, 1000)
+    assert len(found_ids) == len(object_ids)
@@ -1,6 +1,17 @@
+import contextlib
 import time
-from morphocluster import background as jobs
+import uuid
+
+import numpy as np
+import pytest
 from rq.job import JobStatus
+from sqlalchemy import select
+
+from morphocluster import background as jobs
+from morphocluster.extensions import database, rq
+from morphocluster.loading import insert_objects
+from morphocluster.models import nodes
+from morphocluster.tree import Tree
 
 
 def test_worker(flask_rq_worker):
@@ -17,3 +28,65 @@ def test_worker(flask_rq_worker):
             break
 
         time.sleep(1.0)
+
+
+@pytest.fixture
+def connection(flask_app):
+    with database.engine.connect() as connection:
+        transaction = connection.begin()
+        yield connection
+        transaction.rollback()
+
+
+def test_consolidate_dirty_keeps_failed_nodes(connection, monkeypatch):
+    rng = np.random.default_rng(0)
+    prefix = uuid.uuid4().hex
+
+    object_ids = [f"{prefix}_{i}" for i in range(30)]
+    vectors = rng.normal(size=(len(object_ids), 8)).astype(np.float32)
+    insert_objects(connection, object_ids, object_ids, vectors)
+
+    tree = Tree(connection)
+    project_id = tree.create_project(prefix)
+    root_id = tree.create_node(project_id, object_ids=object_ids[:10])
+    node_ids = [
+        root_id,
+        tree.create_node(project_id, parent_id=root_id, object_ids=object_ids[10:20]),
+        tree.create_node(project_id, parent_id=root_id, object_ids=object_ids[20:]),
+    ]
+
+    # The job works inside of the transaction of the test
+    monkeypatch.setattr(
+        database.engine, "connect", lambda: contextlib.nullcontext(connection)
+    )
+    queued = []
+    monkeypatch.setattr(
+        jobs.consolidate_dirty, "queue", lambda *args, **kwargs: queued.append(args)
+    )
+
+    redis_connection = rq.connection
+    redis_connection.delete(jobs.CONSOLIDATION_DIRTY_KEY, jobs.CONSOLIDATION_QUEUED_KEY)
+    redis_connection.sadd(jobs.CONSOLIDATION_DIRTY_KEY, *node_ids)
+
+    def fail(self, node_id, **kwargs):
+        raise RuntimeError("Consolidation failed")
+
+    with monkeypatch.context() as m:
+        m.setattr(Tree, "consolidate_node", fail)
+        with pytest.raises(RuntimeError):
+            jobs.consolidate_dirty()
+
+    # The node_ids were not lost and a retry was queued
+    dirty = {int(n) for n in redis_connection.smembers(jobs.CONSOLIDATION_DIRTY_KEY)}
+    assert dirty == set(node_ids)
+    assert queued == [(1,)]
+
+    redis_connection.delete(jobs.CONSOLIDATION_QUEUED_KEY)
+    jobs.consolidate_dirty()
+
+    assert not redis_connection.smembers(jobs.CONSOLIDATION_DIRTY_KEY)
+
+    stmt = select(nodes.c.cache_valid, nodes.c.prototypes_valid).where(
+        nodes.c.node_id.in_(node_ids)
+    )
+    assert all(r.cache_valid and r.prototypes_valid for r in connection.execute(stmt))